@@ -0,0 +1,216 @@
+"""Payroll backfill from the command line, outside the Flask app.
+
+Runs every (month, category) payroll job of a year in parallel: the
+BigQuery aggregate queries run concurrently on a thread pool and each
+result is handed to a process pool that calculates the salaries and writes
+a Parquet partition:
+
+    <output>/year=YYYY/month=MM/category=<category>/part-0.parquet
+
+Usage, from the repository root:
+
+    python backfill.py --year 2024 --output payroll_backfill
+    python backfill.py --year 2024 --months 1 2 3 --categories Ecommerce
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
+from datetime import date
+from decimal import Decimal
+from urllib.parse import quote
+
+import pandas as pd
+
+from salary import (ALL_CATEGORIES, CATEGORY_QUERIES, get_period,
+                    generate_query, target_schedule, apply_targets,
+                    calculate_salary_details_batch)
+
+# Concurrent BigQuery jobs; each one is mostly waiting on the service
+DEFAULT_QUERY_WORKERS = 8
+
+PARQUET_FILE = "part-0.parquet"
+
+
+def partition_path(output_dir, year, month, category):
+    """Hive-style partition directory of one (month, category) job."""
+    return os.path.join(output_dir, f"year={year}", f"month={month:02d}",
+                        f"category={quote(category, safe='')}")
+
+
+def fetch_job(client, category, month, year):
+    """Run the aggregate query of one (month, category) job."""
+    start_date, end_date = get_period(category, month, year)
+    target = target_schedule.target(client, category, end_date)
+    query = generate_query(category, start_date, end_date)
+    started = time.monotonic()
+    rows = apply_targets([dict(row) for row in client.query(query).result()],
+                         target)
+    logging.info(f"Fetched {len(rows)} rows for {category} {year}-{month:02d} "
+                 f"in {time.monotonic() - started:.1f}s.")
+    return start_date, end_date, rows
+
+
+def _parquet_frame(records):
+    # category comes from the partition path, not the file
+    frame = pd.DataFrame([
+        dict(record,
+             period_start=record["period"]["start_date"],
+             period_end=record["period"]["end_date"])
+        for record in records
+    ]).drop(columns=["period", "category"])
+    for column in frame.columns:
+        if frame[column].map(lambda value: isinstance(value, Decimal)).any():
+            frame[column] = pd.to_numeric(frame[column], errors='coerce')
+    return frame
+
+
+def calculate_job(rows, category, start_date, end_date, custom_params,
+                  directory):
+    """Calculate one job's salaries and write its Parquet partition.
+
+    Runs in a worker process; returns the number of records written.
+    days_since_joining is counted to the end of the period, so a backfill
+    gives the same result whenever it runs.
+    """
+    records = calculate_salary_details_batch(
+        rows, category, start_date, end_date, custom_params,
+        today=date.fromisoformat(end_date))
+    if not records:
+        return 0
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, PARQUET_FILE)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    _parquet_frame(records).to_parquet(temp_path, index=False)
+    os.replace(temp_path, path)
+    return len(records)
+
+
+def run_backfill(client, year, months, categories, output_dir,
+                 custom_params=None, query_workers=DEFAULT_QUERY_WORKERS,
+                 calc_workers=None, overwrite=False):
+    """Backfill payroll for every (month, category) pair.
+
+    Partitions that already exist are skipped unless overwrite is set, so
+    an interrupted backfill can be resumed. Returns a list of per-job
+    summaries.
+    """
+    custom_params = custom_params or {}
+    jobs = []
+    for month in months:
+        for category in categories:
+            directory = partition_path(output_dir, year, month, category)
+            if not overwrite and os.path.exists(
+                    os.path.join(directory, PARQUET_FILE)):
+                logging.info(f"Skipping {category} {year}-{month:02d}, "
+                             f"partition exists.")
+                continue
+            jobs.append((month, category, directory))
+
+    summary = []
+    # Spawned, not forked: the query threads are already running and may
+    # hold the logging or BigQuery client locks
+    with ThreadPoolExecutor(max_workers=query_workers) as query_pool, \
+            ProcessPoolExecutor(
+                max_workers=calc_workers,
+                mp_context=multiprocessing.get_context("spawn")) as calc_pool:
+        fetches = {
+            query_pool.submit(fetch_job, client, category, month, year):
+            (month, category, directory)
+            for month, category, directory in jobs
+        }
+        calculations = {}
+        for future in as_completed(fetches):
+            month, category, directory = fetches[future]
+            try:
+                start_date, end_date, rows = future.result()
+            except Exception as e:
+                logging.error(f"Query failed for {category} "
+                              f"{year}-{month:02d}: {e}")
+                summary.append({"month": month, "category": category,
+                                "status": "error", "error": str(e)})
+                continue
+            calculation = calc_pool.submit(
+                calculate_job, rows, category, start_date, end_date,
+                custom_params.get(category, {}), directory)
+            calculations[calculation] = (month, category)
+
+        for future in as_completed(calculations):
+            month, category = calculations[future]
+            try:
+                count = future.result()
+            except Exception as e:
+                logging.error(f"Calculation failed for {category} "
+                              f"{year}-{month:02d}: {e}")
+                summary.append({"month": month, "category": category,
+                                "status": "error", "error": str(e)})
+                continue
+            logging.info(f"Wrote {count} records for {category} "
+                         f"{year}-{month:02d}.")
+            summary.append({"month": month, "category": category,
+                            "status": "ok", "count": count})
+
+    summary.sort(key=lambda job: (job["month"], job["category"]))
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--year", type=int, required=True)
+    parser.add_argument("--months", type=int, nargs="+",
+                        default=list(range(1, 13)),
+                        choices=range(1, 13), metavar="MONTH")
+    parser.add_argument("--categories", nargs="+",
+                        default=ALL_CATEGORIES + ["Ajeer"],
+                        choices=list(CATEGORY_QUERIES), metavar="CATEGORY")
+    parser.add_argument("--output", default="payroll_backfill",
+                        help="root directory of the Parquet dataset")
+    parser.add_argument("--params",
+                        help="JSON file with customParams per category")
+    parser.add_argument("--query-workers", type=int,
+                        default=DEFAULT_QUERY_WORKERS)
+    parser.add_argument("--calc-workers", type=int, default=None,
+                        help="calculation processes (default: CPU count)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="recompute partitions that already exist")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(processName)s : %(message)s')
+
+    custom_params = {}
+    if args.params:
+        with open(args.params) as f:
+            custom_params = json.load(f)
+
+    from fetch_data import get_bigquery_client
+    client = get_bigquery_client()
+    if not client:
+        raise SystemExit("Failed to initialize Google Cloud BigQuery client")
+
+    started = time.monotonic()
+    summary = run_backfill(client, args.year, args.months, args.categories,
+                           args.output, custom_params,
+                           query_workers=args.query_workers,
+                           calc_workers=args.calc_workers,
+                           overwrite=args.overwrite)
+    failed = [job for job in summary if job["status"] != "ok"]
+    logging.info(f"Backfill finished: {len(summary) - len(failed)} jobs ok, "
+                 f"{len(failed)} failed, "
+                 f"{sum(job.get('count', 0) for job in summary)} records in "
+                 f"{time.monotonic() - started:.1f}s.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
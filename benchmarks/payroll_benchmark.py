@@ -0,0 +1,392 @@
+"""Payroll pipeline benchmark on synthetic master_saned data.
+
+Generates synthetic ``ultimate`` (one row per courier per day) and
+``targets`` tables, serves the SQL from ``generate_query`` /
+``generate_all_query`` and the target schedule through
+SyntheticBigQueryClient, and times each salary stage separately.
+
+Usage, from the repository root:
+
+    python -m benchmarks.payroll_benchmark --sizes 1000 10000 100000 \
+        --output benchmarks/results/current.json \
+        --compare benchmarks/results/previous.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from salary import (ALL_CATEGORIES, CATEGORY_QUERIES, get_period,  # noqa: E402
+                    generate_query, generate_all_query, fetch_payroll_rows,
+                    calculate_salary_details, calculate_salary_details_batch)
+import salary  # noqa: E402
+
+# Share of synthetic couriers per category, roughly like production
+CATEGORY_MIX = {
+    "Motorcycle": 0.15,
+    "Food Trial": 0.10,
+    "Food In-House New": 0.20,
+    "Food In-House Old": 0.20,
+    "Ecommerce WH": 0.10,
+    "Ecommerce": 0.20,
+    "Ajeer": 0.05
+}
+
+# Target column in master_saned.targets for each category
+TARGET_COLUMNS = {
+    category: parts["target"].split(".", 1)[1]
+    for category, parts in CATEGORY_QUERIES.items()
+}
+
+SCALAR_CALCULATORS = {
+    "Motorcycle": salary.calculate_motorcycle_salary,
+    "Food Trial": salary.calculate_food_trial_salary,
+    "Food In-House New": salary.calculate_food_inhouse_new_salary,
+    "Food In-House Old": salary.calculate_food_inhouse_old_salary,
+    "Ecommerce WH": salary.calculate_ecommerce_wh_salary,
+    "Ecommerce": salary.calculate_ecommerce_salary,
+    "Ajeer": salary.calculate_ajeer_salary
+}
+
+
+def synthetic_tables(couriers, month, year, seed=0):
+    """Synthetic couriers, daily ultimate rows and a targets table.
+
+    The daily rows only carry BARQ_ID, the date ordinal and the summed
+    metrics; courier attributes are joined back when a query is answered.
+    """
+    rng = np.random.default_rng(seed)
+    categories = rng.choice(list(CATEGORY_MIX), size=couriers,
+                            p=list(CATEGORY_MIX.values()))
+    project = {
+        "Motorcycle": "Motorcycle", "Food Trial": "Food",
+        "Food In-House New": "Food", "Food In-House Old": "Food",
+        "Ecommerce WH": "Ecommerce WH", "Ecommerce": "Ecommerce",
+        "Ajeer": "Food"
+    }
+    sponsorship = {
+        "Food Trial": "Trial", "Food In-House New": "Inhouse",
+        "Food In-House Old": "Inhouse", "Ajeer": "Ajeer"
+    }
+    joined = np.where(
+        categories == "Food In-House New",
+        rng.integers(0, 500, couriers) + date(2024, 1, 1).toordinal(),
+        rng.integers(0, 2500, couriers) + date(2017, 1, 1).toordinal())
+    joined = np.where(categories == "Food In-House Old",
+                      np.minimum(joined, date(2023, 12, 31).toordinal()),
+                      joined)
+    couriers_frame = pd.DataFrame({
+        "BARQ_ID": np.arange(100000, 100000 + couriers),
+        "iban": [f"SA{n:022d}" for n in range(couriers)],
+        "id_number": rng.integers(1_000_000_000, 2_999_999_999, couriers),
+        "joining_Date": [date.fromordinal(int(n)) for n in joined],
+        "Name": [f"Courier {n}" for n in range(couriers)],
+        "Status": "Active",
+        "Sponsorshipstatus": [sponsorship.get(c, "Freelancer")
+                              for c in categories],
+        "PROJECT": [project[c] for c in categories],
+        "Supervisor": [f"Supervisor {n % 40}" for n in range(couriers)]
+    })
+
+    periods = [get_period(category, month, year) for category in CATEGORY_MIX]
+    start = date.fromisoformat(min(period[0] for period in periods))
+    end = date.fromisoformat(max(period[1] for period in periods))
+    days = np.arange(start.toordinal(), end.toordinal() + 1)
+    rows = couriers * len(days)
+    ultimate = pd.DataFrame({
+        "BARQ_ID": np.repeat(couriers_frame["BARQ_ID"].to_numpy(), len(days)),
+        "Date": np.tile(days, couriers),
+        "total_Orders": rng.poisson(14, rows),
+    })
+    ultimate["Total_revenue"] = np.round(
+        ultimate["total_Orders"] * rng.uniform(8, 30, rows), 2)
+    ultimate["Gas_Usage_without_vat"] = np.round(rng.uniform(0, 30, rows), 2)
+
+    targets = pd.DataFrame({"Day": np.arange(1, 32)})
+    for category, column in TARGET_COLUMNS.items():
+        per_day = {"Ecommerce": 221}.get(category, 15)
+        targets[column] = targets["Day"] * per_day
+    return couriers_frame, ultimate, targets
+
+
+class _Page(list):
+    pass
+
+
+class _RowIterator:
+    def __init__(self, rows, page_size):
+        self.rows = rows
+        self.page_size = page_size or len(rows) or 1
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    @property
+    def pages(self):
+        for start in range(0, len(self.rows), self.page_size):
+            yield _Page(self.rows[start:start + self.page_size])
+
+
+class _QueryJob:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self, page_size=None):
+        return _RowIterator(self.rows, page_size)
+
+
+class _Table:
+    def __init__(self, modified):
+        self.modified = modified
+
+
+class SyntheticBigQueryClient:
+    """Local stand-in for bigquery.Client answering the payroll SQL.
+
+    Only understands queries built by generate_query / generate_all_query
+    and the target schedule's load: it applies the category filters and
+    period to the synthetic ultimate rows in pandas and returns the
+    aggregated rows as dicts.
+    """
+
+    def __init__(self, couriers, ultimate, targets):
+        self.couriers = couriers
+        self.ultimate = ultimate
+        self.targets = targets
+        self.masks = self._category_masks(couriers)
+        self.modified = datetime.now()
+        self.queries = 0
+
+    def get_table(self, table_id):
+        return _Table(self.modified)
+
+    def _category_masks(self, frame):
+        joined_2024 = pd.to_datetime(frame["joining_Date"]) >= "2024-01-01"
+        food = frame["PROJECT"] == "Food"
+        return {
+            "Motorcycle": frame["PROJECT"] == "Motorcycle",
+            "Food Trial": food & (frame["Sponsorshipstatus"] == "Trial"),
+            "Food In-House New": (food & (frame["Sponsorshipstatus"]
+                                          == "Inhouse") & joined_2024),
+            "Food In-House Old": (food & (frame["Sponsorshipstatus"]
+                                          == "Inhouse") & ~joined_2024),
+            "Ecommerce WH": frame["PROJECT"] == "Ecommerce WH",
+            "Ecommerce": frame["PROJECT"] == "Ecommerce",
+            "Ajeer": frame["Sponsorshipstatus"] == "Ajeer"
+        }
+
+    def query(self, sql):
+        self.queries += 1
+        if f"FROM {salary.TARGETS_TABLE}" in sql:
+            return _QueryJob(self.targets.to_dict("records"))
+        start, end = [date.fromisoformat(value) for value in re.search(
+            r"u\.Date BETWEEN DATE '([\d-]+)' AND DATE '([\d-]+)'",
+            sql).groups()]
+        combined = "END AS category" in sql
+        if combined:
+            categories = [category for category in ALL_CATEGORIES
+                          if f"THEN '{category}'" in sql]
+        else:
+            categories = [category for category, parts
+                          in CATEGORY_QUERIES.items()
+                          if f"WHERE {parts['condition']}\n" in sql]
+
+        dates = self.ultimate["Date"].to_numpy()
+        period = self.ultimate[(dates >= start.toordinal())
+                               & (dates <= end.toordinal())]
+        totals = period.groupby("BARQ_ID", sort=False).agg(
+            Total_Orders=("total_Orders", "sum"),
+            Total_Revenue=("Total_revenue", "sum"),
+            Gas_Usage=("Gas_Usage_without_vat", "sum"))
+        rows = []
+        for category in categories:
+            grouped = self.couriers[self.masks[category]].join(
+                totals, on="BARQ_ID", how="inner")
+            grouped["joining_Date"] = [value.strftime("%Y-%m-%d")
+                                       for value in grouped["joining_Date"]]
+            grouped["Total_Orders"] = grouped["Total_Orders"].astype(int)
+            if combined:
+                grouped["category"] = category
+            rows.extend(grouped.to_dict("records"))
+        return _QueryJob(rows)
+
+
+def measure(func, repeat):
+    """Best wall time over repeat runs and peak traced memory of one run."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak
+
+
+def benchmark_size(couriers, month, year, repeat):
+    client = SyntheticBigQueryClient(
+        *synthetic_tables(couriers, month, year))
+    salary.target_schedule.refresh(client, force=True)
+    month_rows = {
+        category: rows for category, _, _, rows in fetch_payroll_rows(
+            client, ALL_CATEGORIES + ["Ajeer"], month, year,
+            single_scan=False)
+    }
+    periods = {category: get_period(category, month, year)
+               for category in month_rows}
+    total_rows = sum(len(rows) for rows in month_rows.values())
+
+    def run_get_period():
+        for _ in range(1000):
+            for category in month_rows:
+                get_period(category, month, year)
+
+    def run_generate_query():
+        for _ in range(100):
+            for category, (start, end) in periods.items():
+                generate_query(category, start, end)
+            generate_all_query(*periods["Motorcycle"])
+
+    def run_query_per_category():
+        fetch_payroll_rows(client, ALL_CATEGORIES, month, year,
+                           single_scan=False)
+
+    def run_query_single_scan():
+        fetch_payroll_rows(client, ALL_CATEGORIES, month, year,
+                           single_scan=True)
+
+    def run_details(func):
+        def run():
+            for category, rows in month_rows.items():
+                start, end = periods[category]
+                func([dict(row) for row in rows], category, start, end, {})
+        return run
+
+    def run_calculators():
+        for category, rows in month_rows.items():
+            calculator = SCALAR_CALCULATORS[category]
+            for row in rows:
+                calculator(row["Total_Orders"], row["TARGET"],
+                           row["Gas_Usage"], 400, row["Total_Revenue"], {})
+
+    stages = {
+        "get_period": (run_get_period, 1000 * len(month_rows)),
+        "generate_query": (run_generate_query, 100 * (len(periods) + 1)),
+        "query_per_category (stand-in)": (run_query_per_category,
+                                          total_rows),
+        "query_single_scan (stand-in)": (run_query_single_scan, total_rows),
+        "calculate_salary_details": (run_details(calculate_salary_details),
+                                     total_rows),
+        "calculate_salary_details_batch": (
+            run_details(calculate_salary_details_batch), total_rows),
+        "calculate_*_salary": (run_calculators, total_rows)
+    }
+
+    results = {}
+    for name, (func, items) in stages.items():
+        seconds, peak = measure(func, repeat)
+        results[name] = {
+            "seconds": round(seconds, 6),
+            "items": items,
+            "items_per_second": round(items / seconds, 1) if seconds else None,
+            "peak_memory_bytes": peak
+        }
+    return {"couriers": couriers, "rows": total_rows, "stages": results}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(current, previous, threshold):
+    """Print stage time ratios; return the stages slower than threshold."""
+    regressions = []
+    previous_sizes = {run["couriers"]: run for run in previous["runs"]}
+    for run in current["runs"]:
+        old_run = previous_sizes.get(run["couriers"])
+        if not old_run:
+            continue
+        for name, stage in run["stages"].items():
+            old_stage = old_run["stages"].get(name)
+            if not old_stage or not old_stage["seconds"]:
+                continue
+            ratio = stage["seconds"] / old_stage["seconds"]
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  <-- slower"
+                regressions.append((run["couriers"], name, ratio))
+            print(f"{run['couriers']:>8} {name:<34} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="numbers of synthetic couriers")
+    parser.add_argument("--month", type=int, default=1)
+    parser.add_argument("--year", type=int, default=2025)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs per stage; the best is kept")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare",
+                        help="previous results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "month": args.month,
+        "year": args.year,
+        "runs": []
+    }
+    for couriers in args.sizes:
+        run = benchmark_size(couriers, args.month, args.year, args.repeat)
+        report["runs"].append(run)
+        print(f"{couriers} couriers ({run['rows']} payroll rows)")
+        for name, stage in run["stages"].items():
+            print(f"  {name:<34} {stage['seconds']:10.4f}s "
+                  f"{stage['items_per_second'] or 0:14.1f}/s "
+                  f"{stage['peak_memory_bytes'] / 2 ** 20:9.1f} MiB")
+
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            previous = json.load(handle)
+        regressions = compare(report, previous, args.threshold)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
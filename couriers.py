@@ -0,0 +1,221 @@
+"""Keyset pagination over master_saned.courier.
+
+Pages are ordered by BARQ_ID and addressed by cursors (the BARQ_ID before
+or after a page) instead of OFFSET, so every page costs the same. Pages
+are served from an in-process snapshot of the courier table once it has
+been loaded in the background; until then they are read from BigQuery
+with a keyset query. The total count is cached and refreshed in the
+background as well.
+
+Every worker process holds its own snapshot, a few hundred bytes to a
+couple of KB per courier. Tables larger than COURIER_SNAPSHOT_MAX_ROWS
+are not loaded and always paged with keyset queries.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from google.cloud import bigquery
+
+COURIER_TABLE = "master_saned.courier"
+
+# How often the courier table's last-modified time is checked
+COURIER_SNAPSHOT_CHECK_SECONDS = 300
+
+# Age after which the cached total count is refreshed
+COURIER_COUNT_REFRESH_SECONDS = 300
+
+# Largest courier table kept in memory by each worker
+COURIER_SNAPSHOT_MAX_ROWS = 200000
+
+# Couriers without a BARQ_ID can't be addressed by a cursor and are left
+# out of pages and the total alike
+COURIER_COUNT_QUERY = (f"SELECT COUNT(BARQ_ID) AS total "
+                       f"FROM {COURIER_TABLE}")
+
+
+def _keyset_query(per_page, after=None, before=None):
+    """Query for one page with flags for rows before and after it.
+
+    A page never splits couriers sharing a BARQ_ID.
+    """
+    if before is not None:
+        where, order, bound = "BARQ_ID < @cursor", "DESC", "MIN"
+        edge = ">="
+    else:
+        where = "BARQ_ID > @cursor" if after is not None \
+            else "BARQ_ID IS NOT NULL"
+        order, bound, edge = "ASC", "MAX", "<="
+    return f"""
+        WITH page AS (
+            SELECT * FROM {COURIER_TABLE}
+            WHERE {where} AND BARQ_ID {edge} (
+                SELECT {bound}(BARQ_ID) FROM (
+                    SELECT BARQ_ID FROM {COURIER_TABLE}
+                    WHERE {where}
+                    ORDER BY BARQ_ID {order} LIMIT {per_page}))
+        )
+        SELECT page.*,
+            EXISTS(SELECT 1 FROM {COURIER_TABLE} WHERE BARQ_ID <
+                   (SELECT MIN(BARQ_ID) FROM page)) AS _has_prev,
+            EXISTS(SELECT 1 FROM {COURIER_TABLE} WHERE BARQ_ID >
+                   (SELECT MAX(BARQ_ID) FROM page)) AS _has_next
+        FROM page
+        ORDER BY BARQ_ID
+    """
+
+
+class CourierDirectory:
+    """Courier rows ordered by BARQ_ID for keyset pages and a total count.
+
+    The snapshot is only reloaded when the table's last-modified time
+    changes. Reloads and count refreshes run on a background thread;
+    requests keep using the previous copy meanwhile.
+    """
+
+    def __init__(self, check_seconds=COURIER_SNAPSHOT_CHECK_SECONDS,
+                 count_seconds=COURIER_COUNT_REFRESH_SECONDS,
+                 max_rows=COURIER_SNAPSHOT_MAX_ROWS):
+        self.check_seconds = check_seconds
+        self.count_seconds = count_seconds
+        self.max_rows = max_rows
+        self.version = None
+        self.rows = None
+        self.ids = []
+        self.checked_at = None
+        self.count = None
+        self.counted_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _refresh(self, client):
+        try:
+            table = client.get_table(COURIER_TABLE)
+            version = table.modified.isoformat()
+            if version != self.version and (table.num_rows or 0) > self.max_rows:
+                count = client.query(COURIER_COUNT_QUERY).result()
+                with self._lock:
+                    self.rows = None
+                    self.ids = []
+                    self.version = version
+                    self.count = next(iter(count))['total']
+                    self.counted_at = time.monotonic()
+                logging.warning(f"Courier table has {table.num_rows} rows, "
+                                f"over the {self.max_rows} snapshot limit; "
+                                f"paging with keyset queries.")
+            elif version != self.version:
+                rows = [dict(row) for row in client.query(
+                    f"SELECT * FROM {COURIER_TABLE} "
+                    f"WHERE BARQ_ID IS NOT NULL ORDER BY BARQ_ID").result()]
+                with self._lock:
+                    self.rows = rows
+                    self.ids = [row['BARQ_ID'] for row in rows]
+                    self.version = version
+                    self.count = len(rows)
+                    self.counted_at = time.monotonic()
+                logging.info(f"Loaded courier snapshot {version} "
+                             f"({len(rows)} couriers).")
+            else:
+                with self._lock:
+                    # An unchanged table still has the cached count
+                    self.counted_at = time.monotonic()
+        except Exception as e:
+            logging.error(f"Error refreshing courier snapshot, keeping "
+                          f"version {self.version}: {e}")
+        finally:
+            with self._lock:
+                self.checked_at = time.monotonic()
+                self._refreshing = False
+
+    def refresh_in_background(self, client, force=False):
+        """Start a snapshot check unless one ran recently or is running."""
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshing or (
+                    not force and self.checked_at is not None
+                    and now - self.checked_at < self.check_seconds):
+                return False
+            self._refreshing = True
+        threading.Thread(target=self._refresh, args=(client,),
+                         name="courier-snapshot", daemon=True).start()
+        return True
+
+    def total(self, client):
+        """Cached number of couriers; only the first call waits for it."""
+        self.refresh_in_background(client)
+        if self.count is None:
+            rows = client.query(COURIER_COUNT_QUERY).result()
+            with self._lock:
+                if self.count is None:
+                    self.count = next(iter(rows))['total']
+                    self.counted_at = time.monotonic()
+        elif time.monotonic() - self.counted_at >= self.count_seconds:
+            # The snapshot check reloads the count when the table changed
+            self.refresh_in_background(client, force=True)
+        return self.count
+
+    def _snapshot_page(self, per_page, after, before):
+        with self._lock:
+            rows, ids = self.rows, self.ids
+        if before is not None:
+            end = bisect.bisect_left(ids, before)
+            start = bisect.bisect_left(ids, ids[max(end - per_page, 0)]) \
+                if end else 0
+        else:
+            start = bisect.bisect_right(ids, after) if after is not None else 0
+            end = min(start + per_page, len(ids))
+            if end > start:
+                end = bisect.bisect_right(ids, ids[end - 1])
+        return rows[start:end], start > 0, end < len(ids)
+
+    def _query_page(self, client, per_page, after, before):
+        cursor = before if before is not None else after
+        params = []
+        if cursor is not None:
+            params = [bigquery.ScalarQueryParameter('cursor', 'INT64', cursor)]
+        config = bigquery.QueryJobConfig(query_parameters=params)
+        rows = [dict(row) for row in client.query(
+            _keyset_query(per_page, after, before), job_config=config).result()]
+        has_prev = has_next = False
+        for row in rows:
+            has_prev = row.pop('_has_prev')
+            has_next = row.pop('_has_next')
+        return rows, has_prev, has_next
+
+    def offset_page(self, client, per_page=10, page=1):
+        """Page number `page` of couriers, for clients that predate cursors.
+
+        Cheap once the snapshot is loaded; otherwise it falls back to a
+        LIMIT/OFFSET query, which scans every row before the page.
+        """
+        self.refresh_in_background(client)
+        offset = (page - 1) * per_page
+        with self._lock:
+            rows = self.rows
+        if rows is not None:
+            return rows[offset:offset + per_page]
+        query = (f"SELECT * FROM {COURIER_TABLE} WHERE BARQ_ID IS NOT NULL "
+                 f"ORDER BY BARQ_ID LIMIT {per_page} OFFSET {offset}")
+        return [dict(row) for row in client.query(query).result()]
+
+    def page(self, client, per_page=10, after=None, before=None):
+        """One page of couriers after or before a BARQ_ID cursor.
+
+        Returns (couriers, prev_cursor, next_cursor); a cursor is None at
+        either end of the table.
+        """
+        self.refresh_in_background(client)
+        if self.rows is not None:
+            rows, has_prev, has_next = self._snapshot_page(per_page, after,
+                                                           before)
+        else:
+            rows, has_prev, has_next = self._query_page(client, per_page,
+                                                        after, before)
+        prev_cursor = rows[0]['BARQ_ID'] if rows and has_prev else None
+        next_cursor = rows[-1]['BARQ_ID'] if rows and has_next else None
+        return rows, prev_cursor, next_cursor
+
+
+# Shared by every request of the process
+courier_directory = CourierDirectory()
@@ -1,48 +1,478 @@
-from flask import Blueprint, Flask, request, jsonify, render_template
-from google.cloud import bigquery
+import io
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+
+import pyarrow.csv as pa_csv
+from flask import Blueprint, Flask, request, jsonify, render_template, session, url_for
+from google.api_core.exceptions import GoogleAPIError
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.cloud import bigquery, exceptions
 from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:  # Large results fall back to the REST API
+    bigquery_storage = None
+
+import query_cache
+from query_jobs import QueryJobStore
+from query_cache import METADATA_TTL, cache_key, estimate_size, is_write, is_write_statement, query_class, query_tables
 
 fetch_data_bp = Blueprint('fetch_data', __name__)
 
 # Configuration
 PROJECT_ID = "looker-barqdata-2030"
 KEY_PATH = "iamsmarter.json"
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform", "https://www.googleapis.com/auth/drive"]
+
+# Keep-alive connections per process; covers the payroll query pools
+HTTP_POOL_SIZE = 32
+
+# Refresh the access token this long before it expires
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+
+# Results with at least this many rows are read with the Storage Read API
+ARROW_ROW_THRESHOLD = 20000
+
+# Rows per page when streaming a query result
+STREAM_PAGE_SIZE = 5000
+
+# Rows per page returned by the ad hoc query routes, and the most a
+# caller may ask for
+RESULT_PAGE_SIZE = 500
+MAX_RESULT_PAGE_SIZE = 5000
+
+
+class BigQueryClientManager:
+    """One BigQuery client per process, shared by all threads.
+
+    Credentials are read once and requests go through an AuthorizedSession
+    with a pooled HTTPAdapter, so connections and TLS sessions are reused
+    across requests. The client is rebuilt in a forked child (gunicorn
+    workers) since sockets must not be shared between processes.
+    """
+
+    def __init__(self, key_path=KEY_PATH, project=PROJECT_ID,
+                 pool_size=HTTP_POOL_SIZE):
+        self.key_path = key_path
+        self.project = project
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._credentials = None
+        self._auth_request = None
+        self._storage = None
+        self._storage_pid = None
+
+    def _build(self):
+        credentials = service_account.Credentials.from_service_account_file(
+            self.key_path, scopes=SCOPES)
+        http = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size)
+        http.mount("https://", adapter)
+        client = bigquery.Client(credentials=credentials, project=self.project,
+                                 _http=http)
+        logging.info(f"BigQuery client created for process {os.getpid()}.")
+        return client, credentials, Request()
+
+    def _token_expiring(self):
+        expiry = self._credentials.expiry
+        if not self._credentials.token or expiry is None:
+            return True
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds() < TOKEN_REFRESH_MARGIN_SECONDS
+
+    def get(self):
+        """The shared client, created on first use in this process."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    (self._client, self._credentials,
+                     self._auth_request) = self._build()
+                    self._pid = os.getpid()
+        if self._token_expiring():
+            # Refresh once under the lock instead of in every thread
+            with self._lock:
+                if self._token_expiring():
+                    self._credentials.refresh(self._auth_request)
+        return self._client
+
+    def storage_client(self):
+        """Shared BigQuery Storage read client, or None if not installed."""
+        if bigquery_storage is None:
+            return None
+        credentials = self.credentials
+        if self._storage_pid != os.getpid():
+            with self._lock:
+                if self._storage_pid != os.getpid():
+                    self._storage = bigquery_storage.BigQueryReadClient(
+                        credentials=credentials)
+                    self._storage_pid = os.getpid()
+        return self._storage
+
+    @property
+    def credentials(self):
+        self.get()
+        return self._credentials
+
+    def reset(self):
+        """Drop the client; the next get() builds a new one."""
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._credentials = None
+            self._pid = None
+            self._storage = None
+            self._storage_pid = None
+
+
+bigquery_clients = BigQueryClientManager()
+
+if hasattr(os, "register_at_fork"):
+    # The lock may be held by another thread at fork time
+    def _reset_after_fork():
+        bigquery_clients._lock = threading.Lock()
+        bigquery_clients._pid = None
+        bigquery_clients._storage_pid = None
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
 
 def get_bigquery_client():
     try:
-        scopes = ["https://www.googleapis.com/auth/cloud-platform", "https://www.googleapis.com/auth/drive"]
-        credentials = service_account.Credentials.from_service_account_file(KEY_PATH, scopes=scopes)
-        client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
-        return client
+        return bigquery_clients.get()
     except Exception as e:
         print(f"Error configuring Google Cloud: {e}")
         return None
 
 # Functions for fetching data
 def fetch_tables(client, dataset_id):
+    key = f"tables:{dataset_id}"
+    tables = query_cache.lookup(key)
+    if tables is not None:
+        return tables
     try:
         tables = client.list_tables(dataset_id)
-        return [table.table_id for table in tables]
+        tables = [table.table_id for table in tables]
     except Exception as e:
         print(f"Error fetching tables: {e}")
         return []
+    query_cache.store(key, tables, METADATA_TTL, (), "metadata")
+    return tables
 
 def fetch_columns(client, dataset_id, table_id):
+    key = f"columns:{dataset_id}.{table_id}"
+    columns = query_cache.lookup(key)
+    if columns is not None:
+        return columns
     try:
         table_ref = client.dataset(dataset_id).table(table_id)
         table = client.get_table(table_ref)
-        return [field.name for field in table.schema]
+        columns = [field.name for field in table.schema]
     except Exception as e:
         print(f"Error fetching columns: {e}")
         return []
+    query_cache.store(key, columns, METADATA_TTL,
+                      [f"{dataset_id}.{table_id}".lower()], "metadata")
+    return columns
 
-def execute_query(client, query):
+def execute_query(client, query, params=None, use_cache=False):
+    """Rows of a query.
+
+    use_cache is for the app's own read queries, never for user-supplied
+    SQL: results are then served from the result cache, shared with the
+    other workers through the on-disk cache, and identical queries already
+    running are joined instead of re-sent. Writes, as parsed or as
+    reported by BigQuery, are never cached; they drop the cached results
+    of every table they touch.
+    """
+    key = cache_key(query, params)
+    cacheable = use_cache and not is_write(query)
+    if cacheable:
+        rows = query_cache.lookup(key)
+        if rows is not None:
+            return rows
     try:
-        query_job = client.query(query)
-        return list(query_job.result())
+        job_config = bigquery.QueryJobConfig(query_parameters=params) if params else None
+        if cacheable:
+            statement_type, rows = query_cache.single_flight.run(
+                client, key, query, job_config)
+        else:
+            job = client.query(query, job_config=job_config)
+            rows = list(job.result())
+            statement_type = job.statement_type
     except Exception as e:
         print(f"Error executing query: {e}")
         return []
+    if is_write_statement(statement_type, query):
+        query_cache.invalidate(query_tables(query))
+    elif cacheable:
+        name, ttl = query_class(query)
+        query_cache.store(key, rows, ttl, query_tables(query), name)
+    return rows
+
+def run_query_job(client, query, params=None):
+    """Run a query and wait for it; returns the finished QueryJob.
+
+    The job's destination table holds the result for about a day, so
+    later reads can page through it without running the query again.
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=params) if params else None
+    job = client.query(query, job_config=job_config)
+    job.result()
+    if is_write_statement(job.statement_type, query):
+        query_cache.invalidate(query_tables(query))
+    return job
+
+def _query_rows(client, query, params, page_size, max_rows):
+    return run_query_job(client, query, params).result(
+        page_size=page_size, max_results=max_rows)
+
+def iter_query_pages(client, query, params=None, page_size=STREAM_PAGE_SIZE,
+                     max_rows=None, max_bytes=None):
+    """Yield a query result lazily, one page (list of Rows) at a time.
+
+    Only the current page is held in memory. Reading stops after max_rows
+    rows or once about max_bytes of rows have been yielded.
+    """
+    rows = _query_rows(client, query, params, page_size, max_rows)
+    remaining = max_bytes
+    for page in rows.pages:
+        page = list(page)
+        if remaining is not None:
+            for count, row in enumerate(page):
+                remaining -= estimate_size([row])
+                if remaining <= 0:
+                    page = page[:count + 1]
+                    break
+        yield page
+        if remaining is not None and remaining <= 0:
+            logging.info(f"Query stream stopped at the {max_bytes} byte cap.")
+            return
+
+def iter_query_rows(client, query, params=None, page_size=STREAM_PAGE_SIZE,
+                    max_rows=None, max_bytes=None):
+    """Rows of iter_query_pages one at a time."""
+    for page in iter_query_pages(client, query, params, page_size, max_rows,
+                                 max_bytes):
+        yield from page
+
+def iter_query_batches(client, query, params=None, page_size=STREAM_PAGE_SIZE,
+                       max_rows=None, max_bytes=None):
+    """Yield a query result lazily as Arrow record batches.
+
+    Results of ARROW_ROW_THRESHOLD rows or more are streamed over the
+    Storage Read API when it is available, otherwise page by page over
+    REST. The caps work as in iter_query_pages.
+    """
+    rows = _query_rows(client, query, params, page_size, max_rows)
+    return _iter_row_batches(rows, max_rows is None, max_bytes)
+
+def iter_table_batches(client, table, page_size=STREAM_PAGE_SIZE,
+                       max_bytes=None):
+    """Yield the rows of a table, e.g. a job's destination, as batches.
+
+    Raises google.cloud.exceptions.NotFound once the table has expired.
+    """
+    rows = client.list_rows(table, page_size=page_size)
+    return _iter_row_batches(rows, True, max_bytes)
+
+def _iter_arrow(rows, storage):
+    """Arrow batches of rows, over the Storage Read API when given.
+
+    A Storage API error before the first batch (no read session
+    permission, quota) falls back to REST. Once batches were sent a
+    fallback would duplicate rows, so a later error is raised instead of
+    ending the stream with a truncated result.
+    """
+    if storage is None:
+        yield from rows.to_arrow_iterable()
+        return
+    batches = iter(rows.to_arrow_iterable(bqstorage_client=storage))
+    try:
+        first = next(batches, None)
+    except GoogleAPIError as e:
+        logging.warning(f"Storage Read API failed, reading over REST: {e}")
+        yield from rows.to_arrow_iterable(bqstorage_client=None)
+        return
+    if first is None:
+        return
+    yield first
+    sent = first.num_rows
+    try:
+        for batch in batches:
+            yield batch
+            sent += batch.num_rows
+    except GoogleAPIError as e:
+        logging.error(f"Storage Read API failed after {sent} rows: {e}")
+        raise RuntimeError(f"Result stream failed after {sent} rows; "
+                           f"the output is incomplete.") from e
+
+def _iter_row_batches(rows, use_storage, max_bytes):
+    storage = None
+    if use_storage and (rows.total_rows or 0) >= ARROW_ROW_THRESHOLD:
+        try:
+            storage = bigquery_clients.storage_client()
+        except Exception as e:
+            logging.warning(f"BigQuery Storage client unavailable: {e}")
+    remaining = max_bytes
+    for batch in _iter_arrow(rows, storage):
+        if remaining is not None:
+            if batch.nbytes >= remaining and batch.num_rows:
+                keep = max(1, int(batch.num_rows * remaining / batch.nbytes))
+                yield batch.slice(0, keep)
+                logging.info(f"Query stream stopped at the {max_bytes} "
+                             f"byte cap.")
+                return
+            remaining -= batch.nbytes
+        yield batch
+
+def result_page_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return RESULT_PAGE_SIZE
+    return max(1, min(size, MAX_RESULT_PAGE_SIZE))
+
+# Query jobs whose results can be paged, shared by every worker
+query_jobs = QueryJobStore()
+
+# Builders of the results pages of job kinds other than ad hoc queries
+result_page_builders = {}
+
+def register_result_pages(kind, build):
+    """Serve results pages of jobs remembered with kind through build.
+
+    build(client, saved, rows, page_token, total_rows) returns the JSON
+    body of one page.
+    """
+    result_page_builders[kind] = build
+
+def job_owner():
+    """Whose jobs a request may read: the signed-in user, or the session."""
+    owner = session.get('email')
+    if not owner:
+        owner = session.get('job_owner')
+        if not owner:
+            owner = session['job_owner'] = uuid.uuid4().hex
+    return owner
+
+def remember_query_job(job, **details):
+    """Record a job for the current user so its status and result can be read.
+
+    details (the SQL, or what a salary job needs to calculate its pages)
+    are stored with it.
+    """
+    return query_jobs.save(job, job_owner(), **details)
+
+def find_query_job(job_id):
+    """A job the current user started, or None."""
+    return query_jobs.get(job_id, job_owner())
+
+def submit_query_job(client, query, params=None):
+    """Start a query and return its QueryJob without waiting for it."""
+    job_config = bigquery.QueryJobConfig(query_parameters=params) if params else None
+    return client.query(query, job_config=job_config)
+
+def refresh_query_job(client, saved):
+    """Reload a remembered job from BigQuery.
+
+    The first time it is seen finished, its destination table is recorded
+    (also for download_csv) and a write drops the cached results of the
+    tables it touched.
+    """
+    job = client.get_job(saved['job_id'], location=saved['location'])
+    if job.state == 'DONE' and not saved.get('finished'):
+        saved['finished'] = True
+        saved['destination'] = str(job.destination) if job.destination else None
+        sql_query = saved.get('sql_query')
+        if query_jobs.finish(saved['job_id'], saved['destination']) and \
+                sql_query and not job.error_result and is_write_statement(
+                    job.statement_type, sql_query):
+            query_cache.invalidate(query_tables(sql_query))
+        last_query = session.get('last_query')
+        if last_query and last_query.get('job_id') == saved['job_id']:
+            session['last_query'] = dict(last_query,
+                                         destination=saved['destination'])
+    return job
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+def query_job_status(job):
+    """State, progress and cost of a query job for the status endpoints.
+
+    progress is the share of completed query plan stages; BigQuery only
+    reports the plan while a job runs, so it is 0 before and 1 after.
+    """
+    done = job.state == 'DONE'
+    stages = job.query_plan or []
+    if done:
+        progress = 1.0
+    elif stages:
+        progress = sum(stage.status == 'COMPLETE' for stage in stages) / len(stages)
+    else:
+        progress = 0.0
+    return {
+        'job_id': job.job_id,
+        'state': job.state,
+        'done': done,
+        'error': job.error_result.get('message') if job.error_result else None,
+        'progress': round(progress, 3),
+        'bytes_processed': job.total_bytes_processed,
+        'bytes_billed': job.total_bytes_billed,
+        'slot_millis': job.slot_millis,
+        'cache_hit': job.cache_hit,
+        'created': _isoformat(job.created),
+        'started': _isoformat(job.started),
+        'ended': _isoformat(job.ended)
+    }
+
+def fetch_result_page(client, job, page_token=None, page_size=RESULT_PAGE_SIZE):
+    """One page of a job's destination table.
+
+    Returns (records, next page token, total rows); the token is None on
+    the last page. Raises google.cloud.exceptions.NotFound once the table
+    has expired.
+    """
+    if not job.get('destination'):
+        # DML and scripts have no result table
+        return [], None, 0
+    rows = client.list_rows(job['destination'], page_size=page_size,
+                            page_token=page_token)
+    page = next(iter(rows.pages), [])
+    return [dict(row) for row in page], rows.next_page_token, rows.total_rows
+
+def result_page_json(job, records, page_token, total_rows):
+    return {
+        'message': f"Query executed successfully. Fetched {total_rows} rows.",
+        'results': records,
+        'job_id': job['job_id'],
+        'page_token': page_token,
+        'total_rows': total_rows
+    }
+
+def iter_csv_batches(batches):
+    """CSV bytes of record batches, one chunk per batch, header first."""
+    buffer = io.BytesIO()
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pa_csv.CSVWriter(buffer, batch.schema)
+            writer.write_batch(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    finally:
+        if writer is not None:
+            writer.close()
 
 # Functions for performance data
 def fetch_performance_data(client, time_frame):
@@ -91,7 +521,7 @@ def fetch_performance_data(client, time_frame):
     else:
         raise ValueError("Invalid time frame")
 
-    return execute_query(client, query)
+    return execute_query(client, query, use_cache=True)
 
 # Functions for vehicle logs
 def insert_vehicle_log(client, data):
@@ -115,7 +545,7 @@ def delete_vehicle_log(client, date):
 
 def fetch_vehicle_logs(client):
     query = "SELECT * FROM master_saned.vehicle_logs"
-    return execute_query(client, query)
+    return execute_query(client, query, use_cache=True)
 
 def fetch_vehicle_charts(client, time_frame):
     query = f"""
@@ -124,7 +554,7 @@ def fetch_vehicle_charts(client, time_frame):
     GROUP BY period
     ORDER BY period
     """
-    return execute_query(client, query)
+    return execute_query(client, query, use_cache=True)
 
 def fetch_vehicle_insights(client, start_date, end_date):
     query = f"""
@@ -134,7 +564,7 @@ def fetch_vehicle_insights(client, start_date, end_date):
     GROUP BY Movement_Type
     ORDER BY count DESC
     """
-    return execute_query(client, query)
+    return execute_query(client, query, use_cache=True)
 
 # Flask routes
 @fetch_data_bp.route('/')
@@ -183,15 +613,118 @@ def execute_query_route():
     client = get_bigquery_client()
     if client:
         try:
-            results = execute_query(client, sql_query)
-            serialized_results = [dict(row) for row in results]  # Convert each row to a dictionary
-
-            return jsonify(message=f"Query executed successfully. Fetched {len(results)} rows.", results=serialized_results)
+            job = remember_query_job(run_query_job(client, sql_query))
+            records, page_token, total_rows = fetch_result_page(
+                client, job, page_size=result_page_size(data.get('pageSize')))
+            return jsonify(result_page_json(job, records, page_token, total_rows))
         except Exception as e:
             return jsonify(error="An error occurred while executing the query."), 500
     else:
         return jsonify(error="Failed to get BigQuery client"), 500
 
+def _results_page(client, saved, page_token):
+    records, page_token, total_rows = fetch_result_page(
+        client, saved, page_token,
+        result_page_size(request.args.get('page_size')))
+    build = result_page_builders.get(saved.get('kind'))
+    if build:
+        return jsonify(build(client, saved, records, page_token, total_rows))
+    return jsonify(result_page_json(saved, records, page_token, total_rows))
+
+@fetch_data_bp.route('/results', methods=['GET'])
+def query_results_page():
+    job_id = request.args.get('job_id')
+    page_token = request.args.get('page_token')
+    if not job_id or not page_token:
+        return jsonify(error="job_id and page_token are required"), 400
+
+    job = find_query_job(job_id)
+    if not job:
+        return jsonify(error="Unknown query job"), 404
+
+    client = get_bigquery_client()
+    if client:
+        try:
+            return _results_page(client, job, page_token)
+        except exceptions.NotFound:
+            return jsonify(error="Query results have expired, please run the query again."), 410
+        except Exception as e:
+            logging.exception(f"Error fetching results of job {job_id}.")
+            return jsonify(error="An error occurred while fetching results."), 500
+    else:
+        return jsonify(error="Failed to get BigQuery client"), 500
+
+@fetch_data_bp.route('/jobs', methods=['POST'])
+def submit_query():
+    """Start a query and return its job handle without waiting for it."""
+    data = request.json
+    sql_query = data.get('sqlQuery')
+
+    if not sql_query:
+        return jsonify(error="SQL query is missing"), 400
+
+    client = get_bigquery_client()
+    if client:
+        try:
+            job = submit_query_job(client, sql_query)
+        except Exception as e:
+            return jsonify(error="An error occurred while submitting the query."), 500
+        saved = remember_query_job(job, sql_query=sql_query)
+        session['last_query'] = dict(saved)
+        return jsonify(query_job_handle(job)), 202
+    else:
+        return jsonify(error="Failed to get BigQuery client"), 500
+
+def query_job_handle(job):
+    """Status of a just-submitted job with the URLs to poll and read it."""
+    return dict(query_job_status(job),
+                status_url=url_for('fetch_data.query_job', job_id=job.job_id),
+                results_url=url_for('fetch_data.query_job_results', job_id=job.job_id))
+
+@fetch_data_bp.route('/jobs/<job_id>', methods=['GET'])
+def query_job(job_id):
+    saved = find_query_job(job_id)
+    if not saved:
+        return jsonify(error="Unknown query job"), 404
+
+    client = get_bigquery_client()
+    if client:
+        try:
+            job = refresh_query_job(client, saved)
+            return jsonify(query_job_status(job))
+        except Exception as e:
+            return jsonify(error="An error occurred while reading the job status."), 500
+    else:
+        return jsonify(error="Failed to get BigQuery client"), 500
+
+@fetch_data_bp.route('/jobs/<job_id>/results', methods=['GET'])
+def query_job_results(job_id):
+    """First or next page of a finished job; 409 while it still runs."""
+    saved = find_query_job(job_id)
+    if not saved:
+        return jsonify(error="Unknown query job"), 404
+
+    client = get_bigquery_client()
+    if client:
+        try:
+            job = refresh_query_job(client, saved)
+            if job.state != 'DONE':
+                return jsonify(dict(query_job_status(job), error="Query job is not finished")), 409
+            if job.error_result:
+                return jsonify(error=job.error_result.get('message')), 500
+            return _results_page(client, saved, request.args.get('page_token'))
+        except exceptions.NotFound:
+            return jsonify(error="Query results have expired, please run the query again."), 410
+        except Exception as e:
+            logging.exception(f"Error fetching results of job {job_id}.")
+            return jsonify(error="An error occurred while fetching results."), 500
+    else:
+        return jsonify(error="Failed to get BigQuery client"), 500
+
+@fetch_data_bp.route('/query_stats', methods=['GET'])
+def query_stats():
+    return jsonify(query_cache.stats())
+
 # Function to create app (if needed)
 def create_app():
     app = Flask(__name__)
@@ -1,20 +1,24 @@
-from flask import Flask, session, redirect, url_for, request, jsonify, render_template, send_file, make_response
+from flask import Flask, Response, session, redirect, url_for, request, jsonify, render_template, send_file, make_response
 from flask_session import Session
 from authlib.integrations.flask_client import OAuth
 from flask_login import LoginManager, login_user, logout_user, login_required, UserMixin
 import os
 import logging
 from google.cloud import bigquery, storage, exceptions
-import io
-import csv
-import math
+import itertools
 from saned import saned_bp  # Import the Blueprint
 import pdfkit
 import sys
 import calendar
-from datetime import datetime
 from fetch_data import fetch_data_bp  # Import the Blueprint
-from fetch_data import get_bigquery_client, execute_query, fetch_tables, fetch_columns, fetch_performance_data, fetch_vehicle_charts, fetch_vehicle_insights, fetch_vehicle_logs, insert_vehicle_log, update_vehicle_log, delete_vehicle_log
+from fetch_data import get_bigquery_client, execute_query, run_query_job, job_owner, remember_query_job, register_result_pages, query_job_handle, fetch_result_page, result_page_size, result_page_json, iter_query_rows, iter_query_batches, iter_table_batches, iter_csv_batches, fetch_tables, fetch_columns, fetch_performance_data, fetch_vehicle_charts, fetch_vehicle_insights, fetch_vehicle_logs, insert_vehicle_log, update_vehicle_log, delete_vehicle_log
+from salary import ALL_CATEGORIES, evaluate_scenarios, iter_payroll_pages, calculate_salary_details_batch, fetch_pushdown_payroll, cross_check_salary_records, SUMMARY_COLUMNS, summarize_payroll, DIFF_COLUMNS, diff_payroll, parse_snapshot, submit_payroll_query, calculate_payroll_page
+from payroll_store import PayrollRunStore, run_payroll
+from payroll_export import EXPORT_FORMATS
+from payslips import PayslipJobStore, PayslipQueueFull, start_payslip_job
+from provisional import run_provisional_payroll
+from couriers import courier_directory
+from query_cache import estimate_size
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Ensure a secure secret key for session management
@@ -72,6 +76,29 @@ if not client:
 
 storage_client = storage.Client(project_id)
 
+# Stored payroll runs, shared by all workers through SQLite
+payroll_store = PayrollRunStore(os.path.join(session_dir, "payroll_runs.sqlite"))
+
+# Bulk payslip job status files and ZIP archives
+payslip_jobs = PayslipJobStore(os.path.join(session_dir, "payslip_jobs"))
+
+# Content type of streamed /calculate_salary responses
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Upper bound on parameter sets per /calculate_salary/scenarios request
+MAX_SALARY_SCENARIOS = 50
+
+# Largest query result exported by /download_pdf, which renders in memory
+PDF_MAX_ROWS = 5000
+PDF_MAX_BYTES = 20 * 1024 * 1024
+
+# Records per /payroll_runs/records page, and the most a caller may ask for
+RUN_RECORDS_PAGE_SIZE = 1000
+MAX_RUN_RECORDS_PAGE_SIZE = 5000
+
+# Upper bound on per_page for /get_couriers_paginated
+MAX_COURIERS_PER_PAGE = 1000
+
 # OAuth setup using Authlib
 oauth = OAuth(app)
 login_manager = LoginManager()
@@ -105,7 +132,7 @@ def preload_couriers():
     if 'couriers' not in session:
         try:
             query = "SELECT DISTINCT Name FROM master_saned.courier"
-            results = execute_query(client, query)
+            results = execute_query(client, query, use_cache=True)
             couriers = [row["Name"] for row in results]
             session['couriers'] = couriers
             app.logger.debug(f"Couriers preloaded: {couriers}")
@@ -116,7 +143,7 @@ def preload_couriers():
 
 def fetch_distinct_values(column):
     query = f"SELECT DISTINCT {column} FROM master_saned.ultimate"
-    results = execute_query(client, query)
+    results = execute_query(client, query, use_cache=True)
     return [row[column] for row in results]
 
 @app.route("/login")
@@ -166,7 +193,7 @@ def get_scorecards_data():
 def get_all_couriers():
     try:
         query = "SELECT * FROM master_saned.courier"
-        results = execute_query(client, query)
+        results = execute_query(client, query, use_cache=True)
         couriers = [dict(row) for row in results]
         return jsonify({'couriers': couriers})
     except Exception as e:
@@ -221,7 +248,7 @@ def get_ajeer_couriers():
 
 def fetch_metric(query):
     client = get_bigquery_client()
-    results = execute_query(client, query)
+    results = execute_query(client, query, use_cache=True)
     return results[0][0] if results else 0
 
 @app.route("/")
@@ -272,9 +299,9 @@ def fetch_distinct_values_route():
         project_query = "SELECT DISTINCT PROJECT FROM master_saned.ultimate"
         status_query = "SELECT DISTINCT Status FROM master_saned.ultimate"
 
-        sponsorship_results = execute_query(client, sponsorship_query)
-        project_results = execute_query(client, project_query)
-        status_results = execute_query(client, status_query)
+        sponsorship_results = execute_query(client, sponsorship_query, use_cache=True)
+        project_results = execute_query(client, project_query, use_cache=True)
+        status_results = execute_query(client, status_query, use_cache=True)
 
         sponsorship_status = [
             row['Sponsorshipstatus'] for row in sponsorship_results
@@ -307,17 +334,18 @@ def fetch_data():
             return jsonify(error="SQL query is missing"), 400
 
         try:
-            results = execute_query(client, sql_query)
-            serialized_results = [dict(row) for row in results]  # Convert each row to a dictionary
-
-            session['last_query'] = {
-                'sql_query': sql_query
-            }
-            return jsonify(message=f"Query executed successfully. Fetched {len(results)} rows.", results=serialized_results)
+            job = remember_query_job(run_query_job(client, sql_query))
+            records, page_token, total_rows = fetch_result_page(
+                client, job, page_size=result_page_size(data.get('pageSize')))
         except Exception as e:
             app.logger.error(f"Error executing export data query: {e}")
             return jsonify(error="An error occurred while executing the query."), 500
 
+        # download_csv reads the result from the job's destination table;
+        # further pages come from /fetch_data/results
+        session['last_query'] = dict(job, sql_query=sql_query)
+        return jsonify(result_page_json(job, records, page_token, total_rows))
+
 # NEW ROUTE: download_csv
 @app.route('/download_csv')
 @login_required
@@ -326,32 +354,33 @@ def download_csv():
     if not last_query:
         return "No query to download", 400
 
-    sql_query = last_query['sql_query']
+    sql_query = last_query.get('sql_query')
     if not sql_query:
         return "Query is missing", 400
 
     try:
-        results = execute_query(client, sql_query)
-
-        si = io.StringIO()
-        cw = csv.writer(si)
-        if results:
-            cw.writerow(results[0].keys())
-            for row in results:
-                cw.writerow(row.values())
-
-        output = io.BytesIO()
-        output.write(si.getvalue().encode('utf-8'))
-        output.seek(0)
-
-        return send_file(output,
-                         mimetype='text/csv',
-                         as_attachment=True,
-                         download_name='results.csv')
+        batches = None
+        if last_query.get('destination'):
+            try:
+                batches = iter_table_batches(client, last_query['destination'])
+                first_batch = next(batches, None)
+            except exceptions.NotFound:
+                # Query result tables expire after about a day
+                app.logger.info(f"Result of job {last_query.get('job_id')} expired, re-running the query")
+                batches = None
+        if batches is None:
+            batches = iter_query_batches(client, sql_query)
+            first_batch = next(batches, None)
     except Exception as e:
         app.logger.error(f"Error downloading CSV: {e}")
         return str(e), 500
 
+    if first_batch is not None:
+        batches = itertools.chain([first_batch], batches)
+    response = Response(iter_csv_batches(batches), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=results.csv'
+    return response
+
 @app.route('/export_data', methods=['POST'])
 @login_required
 def export_data():
@@ -454,7 +483,7 @@ def get_courier_details():
         return jsonify({"error": "BARQ ID is required"}), 400
     try:
         query = f"SELECT * FROM master_saned.courier WHERE BARQ_ID = {barq_id}"
-        results = execute_query(client, query)
+        results = execute_query(client, query, use_cache=True)
         if results:
             courier = dict(results[0])
             return jsonify({"courier": courier})
@@ -506,16 +535,21 @@ def get_courier_data():
 @login_required
 def get_couriers_paginated():
     try:
-        page = int(request.args.get('page', 1))
-        per_page = int(request.args.get('per_page', 10))
-        offset = (page - 1) * per_page
-        query = f"SELECT * FROM master_saned.courier LIMIT {per_page} OFFSET {offset}"
-        results = execute_query(client, query)
-        couriers = [dict(row) for row in results]
-        total_count_query = "SELECT COUNT(*) as total FROM master_saned.courier"
-        total_count_result = execute_query(client, total_count_query)
-        total_count = total_count_result[0]['total']
-        return jsonify({'couriers': couriers, 'total': total_count})
+        per_page = max(1, min(int(request.args.get('per_page', 10)), MAX_COURIERS_PER_PAGE))
+        page = request.args.get('page', type=int)
+        if page is not None:
+            # Deprecated: page numbers scan every row before the page
+            app.logger.info("get_couriers_paginated called with page; use after/before cursors")
+            couriers = courier_directory.offset_page(client, per_page, max(page, 1))
+            total_count = courier_directory.total(client)
+            return jsonify({'couriers': couriers, 'total': total_count})
+        after = request.args.get('after', type=int)
+        before = request.args.get('before', type=int)
+        couriers, prev_cursor, next_cursor = courier_directory.page(
+            client, per_page, after=after, before=before)
+        total_count = courier_directory.total(client)
+        return jsonify({'couriers': couriers, 'total': total_count,
+                        'prev_cursor': prev_cursor, 'next_cursor': next_cursor})
     except Exception as e:
         app.logger.error(f"Error fetching paginated couriers: {e}")
         return jsonify(error="An error occurred while fetching couriers."), 500
@@ -540,7 +574,11 @@ def download_pdf():
         query = f"SELECT {columns} FROM master_saned.{selected_table}"
         if limit.isdigit():
             query += f" LIMIT {limit}"
-        results = execute_query(client, query)
+        # The HTML and the PDF are built in memory, so the export is capped
+        results = list(iter_query_rows(client, query, max_rows=PDF_MAX_ROWS + 1))
+        if len(results) > PDF_MAX_ROWS or estimate_size(results) > PDF_MAX_BYTES:
+            return (f"The result is too large for a PDF export (at most {PDF_MAX_ROWS} rows "
+                    f"and {PDF_MAX_BYTES // (1024 * 1024)} MB). Add a LIMIT or download it as CSV."), 413
 
         html = render_template('results_template.html',
                                results=results,
@@ -582,49 +620,101 @@ def calculate_salary():
             return jsonify({"error": "Missing required fields"}), 400
 
         if category == "All":
-            categories = [
-                "Motorcycle", "Food Trial", "Food In-House New",
-                "Food In-House Old", "Ecommerce WH", "Ecommerce"
-            ]
+            categories = ALL_CATEGORIES
         else:
             categories = [category]
 
-        all_results = []
-        for cat in categories:
-            start_date, end_date = get_period(cat, int(month), int(year))
-            query = generate_query(cat, start_date, end_date)
+        # Pin the source tables to a BigQuery time-travel snapshot
+        snapshot = None
+        if data.get('snapshot'):
             try:
-                query_job = client.query(query)
-                results = [dict(row) for row in query_job.result()]
-            except Exception as e:
-                logging.error(f"BigQuery execution failed: {e}")
-                return jsonify({"error": "Failed to execute query",
-                                "details": str(e)}), 500
-
-            if not results:
-                logging.info(f"No results found for category {cat}.")
+                snapshot = parse_snapshot(data['snapshot'])
+            except ValueError as e:
+                return jsonify({"error": "Invalid snapshot",
+                                "details": str(e)}), 400
+
+        if data.get('stream') or request.accept_mimetypes.best == NDJSON_MIMETYPE:
+            return stream_salary(categories, month, year, custom_params,
+                                 data.get('singleScan', True), snapshot)
+
+        pushdown = data.get('pushdown', False)
+        provisional = data.get('provisional', False)
+        try:
+            if provisional:
+                payroll = run_provisional_payroll(
+                    client, payroll_store, categories, int(month), int(year),
+                    custom_params, as_of=data.get('asOf'),
+                    rebuild=data.get('rebuild', False)
+                )
+            elif pushdown:
+                payroll = fetch_pushdown_payroll(
+                    client, categories, int(month), int(year), custom_params,
+                    single_scan=data.get('singleScan', True),
+                    snapshot=snapshot
+                )
+            else:
+                payroll = run_payroll(
+                    client, payroll_store, categories, int(month), int(year),
+                    custom_params, single_scan=data.get('singleScan', True),
+                    refresh=data.get('refresh', False), snapshot=snapshot
+                )
+        except Exception as e:
+            logging.error(f"BigQuery execution failed: {e}")
+            return jsonify({"error": "Failed to execute query",
+                            "details": str(e)}), 500
+
+        all_results = []
+        runs = []
+        cross_checks = []
+        for entry in payroll:
+            if not entry["records"]:
+                logging.info(f"No results found for category "
+                             f"{entry['category']}.")
                 continue
 
-            processed_results = calculate_salary_details(
-                results, cat, start_date, end_date,
-                custom_params.get(cat, {})
-            )
-            all_results.extend(processed_results)
+            all_results.extend(entry["records"])
+            if entry.get("run"):
+                runs.append(dict(entry["run"], category=entry["category"]))
+            if pushdown and data.get('crossCheck'):
+                # Recalculate the BigQuery results with the Python engine
+                cross_checks.append(dict(
+                    cross_check_salary_records(
+                        entry["records"], entry["category"],
+                        custom_params.get(entry["category"], {})),
+                    category=entry["category"]))
 
         if not all_results:
             return jsonify({"message": "No results found for the given query."
                             }), 404
 
+        meta = {
+            "categories": categories,
+            "period": {
+                "month": month,
+                "year": year
+            },
+            "count": len(all_results),
+            "runs": runs,
+            "snapshot": snapshot.isoformat() if snapshot and not provisional
+            else None
+        }
+        if data.get('metaOnly') and len(runs) == len(
+                [entry for entry in payroll if entry["records"]]):
+            # The rows are read later from /payroll_runs/records and the
+            # dashboard from /payroll_runs/summary
+            all_results = []
+        if provisional:
+            meta["provisional"] = [dict(entry["provisional"],
+                                        category=entry["category"])
+                                   for entry in payroll]
+        if pushdown:
+            meta["pushdown"] = True
+            if data.get('crossCheck'):
+                meta["crossCheck"] = cross_checks
+
         return jsonify({
             "data": all_results,
-            "meta": {
-                "categories": categories,
-                "period": {
-                    "month": month,
-                    "year": year
-                },
-                "count": len(all_results)
-            }
+            "meta": meta
         })
 
     except Exception as e:
@@ -632,440 +722,421 @@ def calculate_salary():
         return jsonify({"error": "Internal server error",
                         "details": str(e)}), 500
 
-def get_period(category, month, year):
-    """Calculate start and end dates based on category."""
-    if category == "Ajeer":
-        if month == 12:
-            start_date = f"{year}-12-15"
-            end_date = f"{year + 1}-01-14"
-        else:
-            start_date = f"{year}-{month:02d}-15"
-            end_date = f"{year}-{(month % 12) + 1:02d}-14"
-    else:
-        if month == 1:
-            start_date = f"{year - 1}-12-25"
-            end_date = f"{year}-{month:02d}-24"
-        else:
-            start_date = f"{year}-{month - 1:02d}-25"
-            end_date = f"{year}-{month:02d}-24"
-    logging.debug(f"Period for category '{category}' from {start_date} "
-                  f"to {end_date}.")
-    return start_date, end_date
-
-def generate_query(category, start_date, end_date):
-    """Build BigQuery SQL based on category."""
-    base_query = f"""
-    WITH CurrentPeriod AS (
-        SELECT DATE '{start_date}' AS StartPeriod,
-               DATE '{end_date}' AS EndPeriod
-    )
-    SELECT 
-        u.BARQ_ID,
-        u.iban,
-        u.id_number,
-        FORMAT_DATE('%Y-%m-%d', u.joining_Date) AS joining_Date,
-        u.Name,
-        u.Status,
-        u.Sponsorshipstatus,
-        u.PROJECT,
-        u.Supervisor,
-        SUM(u.total_Orders) AS Total_Orders,
-        SUM(u.Total_revenue) AS Total_Revenue,
-        SUM(u.Gas_Usage_without_vat) AS Gas_Usage,"""
-
-    category_queries = {
-        "Motorcycle": {
-            "target": "t.motorcycle AS TARGET",
-            "condition": "WHERE u.PROJECT = 'Motorcycle'"
-        },
-        "Food Trial": {
-            "target": "t.Food_Trial AS TARGET",
-            "condition": ("WHERE u.PROJECT = 'Food' AND "
-                          "u.Sponsorshipstatus = 'Trial'")
-        },
-        "Food In-House New": {
-            "target": "t.Food_Inhouse AS TARGET",
-            "condition": ("WHERE u.PROJECT = 'Food' AND "
-                          "u.Sponsorshipstatus = 'Inhouse' AND "
-                          "u.joining_Date >= '2024-01-01'")
-        },
-        "Food In-House Old": {
-            "target": "t.Food_Inhouse AS TARGET",
-            "condition": ("WHERE u.PROJECT = 'Food' AND "
-                          "u.Sponsorshipstatus = 'Inhouse' AND "
-                          "u.joining_Date < '2024-01-01'")
-        },
-        "Ecommerce WH": {
-            "target": "t.Ecommerce_WH AS TARGET",
-            "condition": "WHERE u.PROJECT = 'Ecommerce WH'"
-        },
-        "Ecommerce": {
-            "target": "t.Ecommerce AS TARGET",
-            "condition": "WHERE u.PROJECT = 'Ecommerce'"
-        },
-        "Ajeer": {
-            "target": "t.Ajeer AS TARGET",
-            "condition": "WHERE u.Sponsorshipstatus = 'Ajeer'"
-        }
-    }
 
-    if category not in category_queries:
-        logging.error(f"Invalid category provided: {category}")
-        raise ValueError(f"Invalid category: {category}")
-
-    query_parts = category_queries[category]
-
-    query = f"""
-    {base_query}
-        {query_parts['target']}
-    FROM master_saned.ultimate AS u
-    LEFT JOIN master_saned.targets AS t 
-        ON EXTRACT(DAY FROM DATE '{end_date}') = t.Day
-    {query_parts['condition']}
-    AND u.Date BETWEEN DATE '{start_date}' AND DATE '{end_date}'
-    GROUP BY 
-        u.BARQ_ID,
-        u.iban,
-        u.id_number,
-        u.joining_Date,
-        u.Name,
-        u.Status,
-        u.Sponsorshipstatus,
-        u.PROJECT,
-        u.Supervisor,
-        TARGET
+def stream_salary(categories, month, year, custom_params, single_scan,
+                  snapshot=None):
+    """Stream salary records as NDJSON, one BigQuery page at a time.
+
+    Each line is a salary record; the last line is {"meta": ...} as in the
+    JSON response, or {"error": ...} if the stream fails part way.
     """
-    logging.debug(f"Generated BigQuery:\n{query}")
-    return query
-
-def calculate_salary_details(results, category, start_date, end_date,
-                             custom_params):
-    """Calculate salary components based on category and query results."""
-    processed = []
-
-    for result in results:
-        total_orders = result.get('Total_Orders', 0)
-        target = result.get('TARGET', 0)
-        gas_usage = result.get('Gas_Usage', 0)
-        joining_date = result.get('joining_Date')
-        total_revenue = result.get('Total_Revenue', 0)
-        status = result.get('Status', '')
-
-        # Calculate days since joining
+    pages = iter_payroll_pages(client, categories, int(month), int(year),
+                               single_scan=single_scan, snapshot=snapshot)
+    today = snapshot.date() if snapshot else None
+    try:
+        first_page = next(pages, None)
+    except Exception as e:
+        logging.error(f"BigQuery execution failed: {e}")
+        return jsonify({"error": "Failed to execute query",
+                        "details": str(e)}), 500
+
+    if first_page is None:
+        return jsonify({"message": "No results found for the given query."
+                        }), 404
+
+    def generate():
+        count = 0
         try:
-            joining_date_obj = datetime.strptime(joining_date, '%Y-%m-%d')
-            days_since_joining = (datetime.now() - joining_date_obj).days + 1
+            for cat, start_date, end_date, results in itertools.chain(
+                    [first_page], pages):
+                processed_results = calculate_salary_details_batch(
+                    results, cat, start_date, end_date,
+                    custom_params.get(cat, {}), today
+                )
+                count += len(processed_results)
+                yield "".join(app.json.dumps(record) + "\n"
+                              for record in processed_results)
         except Exception as e:
-            logging.error(f"Error processing joining date '{joining_date}': "
-                          f"{e}")
-            continue  # Skip this record if date processing fails
-
-        # Initialize salary components
-        salary_components = {
-            "Basic_Salary": 0,
-            "Bonus_Amount": 0,
-            "Gas_Deserved": 0,
-            "Gas_Difference": 0,
-            "Total_Salary": 0
-        }
-
-        # Define calculation functions for each category
-        calculation_functions = {
-            "Motorcycle": calculate_motorcycle_salary,
-            "Food Trial": calculate_food_trial_salary,
-            "Food In-House New": calculate_food_inhouse_new_salary,
-            "Food In-House Old": calculate_food_inhouse_old_salary,
-            "Ecommerce WH": calculate_ecommerce_wh_salary,
-            "Ecommerce": calculate_ecommerce_salary,
-            "Ajeer": calculate_ajeer_salary
-        }
+            logging.exception("Salary stream failed.")
+            yield app.json.dumps({"error": "Internal server error",
+                                  "details": str(e)}) + "\n"
+            return
 
-        calc_func = calculation_functions.get(category)
-        if calc_func:
-            salary_components = calc_func(
-                total_orders, target, gas_usage, days_since_joining,
-                total_revenue, custom_params
-            )
-        else:
-            logging.warning(f"No calculation function defined for category: "
-                            f"{category}")
-            continue  # Skip if no calculation function is defined
+        yield app.json.dumps({
+            "meta": {
+                "categories": categories,
+                "period": {
+                    "month": month,
+                    "year": year
+                },
+                "count": count,
+                "runs": [],
+                "snapshot": snapshot.isoformat() if snapshot else None
+            }
+        }) + "\n"
 
-        # Update the result with calculated components
-        result.update(salary_components)
+    return Response(generate(), mimetype=NDJSON_MIMETYPE)
 
-        # Add period information
-        result.update({
-            "period": {
-                "start_date": start_date,
-                "end_date": end_date
-            },
-            "days_since_joining": days_since_joining,
-            "generated_date": datetime.now().strftime('%Y-%m-%d'),
-            "category": category
-        })
+@app.route('/calculate_salary/jobs', methods=['POST'])
+@login_required
+def submit_salary_job():
+    """Start the payroll query and return a job handle right away.
 
-        processed.append(result)
+    Takes the /calculate_salary body; poll the status URL and read the
+    salary records page by page from the results URL once it is done.
+    Both are the shared query job routes of the fetch_data blueprint.
+    """
+    data = request.get_json()
+    category = data.get('category')
+    month = data.get('month')
+    year = data.get('year')
 
-    logging.info(f"Processed {len(processed)} salary records.")
-    return processed
+    if not all([category, month, year]):
+        return jsonify({"error": "Missing required fields"}), 400
 
-# Salary calculation functions for each category
+    categories = ALL_CATEGORIES if category == "All" else [category]
+    snapshot = None
+    if data.get('snapshot'):
+        try:
+            snapshot = parse_snapshot(data['snapshot'])
+        except ValueError as e:
+            return jsonify({"error": "Invalid snapshot",
+                            "details": str(e)}), 400
 
-def calculate_motorcycle_salary(total_orders, target, gas_usage,
-                                days_since_joining, total_revenue, params):
-    final_target = min(math.ceil(target), days_since_joining * 13.333)
-    basic_salary_rate = params.get('motorcycle_basic_salary_rate', 53.33333)
-    bonus_rate = params.get('motorcycle_bonus_rate', 6)
-    penalty_rate = params.get('motorcycle_penalty_rate', 10)
-    gas_rate = params.get('motorcycle_gas_rate', 0.65)
-    gas_cap = params.get('motorcycle_gas_cap', 261)  # Gas cap for Motorcycle
+    try:
+        job, start_date, end_date = submit_payroll_query(
+            client, categories, int(month), int(year), snapshot)
+    except Exception as e:
+        logging.error(f"BigQuery submission failed: {e}")
+        return jsonify({"error": "Failed to submit query",
+                        "details": str(e)}), 500
 
-    basic_salary = (final_target / 13.333) * basic_salary_rate
-    bonus_orders = total_orders - final_target
-    if bonus_orders > 0:
-        bonus_amount = bonus_orders * bonus_rate
-    else:
-        bonus_amount = bonus_orders * penalty_rate
+    remember_query_job(job, kind='salary', categories=categories,
+                       month=month, year=year,
+                       custom_params=data.get('customParams', {}),
+                       start_date=start_date, end_date=end_date,
+                       snapshot=snapshot.isoformat() if snapshot else None)
+    return jsonify(query_job_handle(job)), 202
 
-    gas_deserved = min(total_orders * gas_rate, gas_cap)
-    gas_difference = gas_deserved - gas_usage
-    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+def salary_job_page(client, saved, rows, page_token, total_rows):
+    """Salary records of one result page of a /calculate_salary/jobs job.
 
+    Records are calculated per page and not saved as a payroll run.
+    """
+    snapshot = parse_snapshot(saved['snapshot']) \
+        if saved.get('snapshot') else None
+    records = calculate_payroll_page(
+        client, rows, saved['categories'], saved['start_date'],
+        saved['end_date'], saved['custom_params'], snapshot)
     return {
-        "Basic_Salary": round(basic_salary, 2),
-        "Bonus_Amount": round(bonus_amount, 2),
-        "Gas_Deserved": round(gas_deserved, 2),
-        "Gas_Difference": round(gas_difference, 2),
-        "Total_Salary": round(total_salary, 2),
-        "target": final_target
+        "data": records,
+        "meta": {
+            "categories": saved['categories'],
+            "period": {
+                "month": saved['month'],
+                "year": saved['year']
+            },
+            "count": len(records),
+            "job_id": saved['job_id'],
+            "page_token": page_token,
+            "total_rows": total_rows,
+            "snapshot": saved['snapshot']
+        }
     }
 
-def calculate_food_trial_salary(total_orders, target, gas_usage,
-                                days_since_joining, total_revenue, params):
-    target_v2 = days_since_joining * 13
-    final_target = min(target, target_v2)
-    basic_salary_rate = params.get('food_trial_basic_salary_rate',
-                                   66.66666667)
-    bonus_rate = params.get('food_trial_bonus_rate', 7)
-    penalty_rate = params.get('food_trial_penalty_rate', 10)
-    gas_rate = params.get('food_trial_gas_rate', 2.11)
-    gas_cap = params.get('food_trial_gas_cap', 826)  # Gas cap for Food
-
-    basic_salary = (final_target / 13) * basic_salary_rate
-
-    bonus_orders = total_orders - final_target
-    if bonus_orders > 0:
-        bonus_amount = bonus_orders * bonus_rate
-    else:
-        bonus_amount = bonus_orders * penalty_rate
+register_result_pages('salary', salary_job_page)
 
-    gas_deserved = min(gas_rate * total_orders, gas_cap)
-    gas_difference = gas_deserved - gas_usage
+@app.route('/calculate_salary/scenarios', methods=['POST'])
+@login_required
+def calculate_salary_scenarios():
+    try:
+        data = request.get_json()
+        category = data.get('category')
+        month = data.get('month')
+        year = data.get('year')
+        custom_params = data.get('customParams', {})
+        scenarios = data.get('scenarios', [])
 
-    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+        if not all([category, month, year]) or not scenarios:
+            logging.warning("Missing required fields in the request.")
+            return jsonify({"error": "Missing required fields"}), 400
 
-    return {
-        "Basic_Salary": round(basic_salary, 2),
-        "Bonus_Amount": round(bonus_amount, 2),
-        "Gas_Deserved": round(gas_deserved, 2),
-        "Gas_Difference": round(gas_difference, 2),
-        "Total_Salary": round(total_salary, 2),
-        "target": final_target
-    }
+        if len(scenarios) > MAX_SALARY_SCENARIOS:
+            return jsonify({"error": f"At most {MAX_SALARY_SCENARIOS} "
+                                     f"scenarios per request"}), 400
 
-def calculate_food_inhouse_new_salary(total_orders, target, gas_usage,
-                                      days_since_joining, total_revenue,
-                                      params):
-    target_v2 = days_since_joining * 15.8333333
-    final_target = min(target, target_v2)
-    basic_salary_rate = params.get('food_inhouse_new_basic_salary_rate',
-                                   66.66666667)
-    bonus_rate = params.get('food_inhouse_new_bonus_rate', 7)
-    penalty_rate = params.get('food_inhouse_new_penalty_rate', 10)
-    gas_rate = params.get('food_inhouse_new_gas_rate', 1.739)
-    gas_cap = params.get('food_inhouse_new_gas_cap', 826)  # Gas cap for Food
-
-    basic_salary = (final_target / 15.83333333) * basic_salary_rate
-
-    bonus_orders = total_orders - final_target
-    if bonus_orders > 0:
-        bonus_amount = bonus_orders * bonus_rate
-    else:
-        bonus_amount = bonus_orders * penalty_rate
+        categories = ALL_CATEGORIES if category == "All" else [category]
 
-    gas_deserved = min(gas_rate * total_orders, gas_cap)
-    gas_difference = gas_deserved - gas_usage
+        # The baseline run fetches the period's aggregates once (or reuses
+        # a stored run); every scenario is then evaluated in memory.
+        try:
+            payroll = run_payroll(
+                client, payroll_store, categories, int(month), int(year),
+                custom_params, single_scan=data.get('singleScan', True)
+            )
+        except Exception as e:
+            logging.error(f"BigQuery execution failed: {e}")
+            return jsonify({"error": "Failed to execute query",
+                            "details": str(e)}), 500
 
-    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+        if not any(entry["records"] for entry in payroll):
+            return jsonify({"message": "No results found for the given query."
+                            }), 404
 
-    return {
-        "Basic_Salary": round(basic_salary, 2),
-        "Bonus_Amount": round(bonus_amount, 2),
-        "Gas_Deserved": round(gas_deserved, 2),
-        "Gas_Difference": round(gas_difference, 2),
-        "Total_Salary": round(total_salary, 2),
-        "target": final_target
-    }
+        evaluation = evaluate_scenarios(
+            [(entry["category"], entry["records"]) for entry in payroll],
+            scenarios
+        )
+        evaluation["meta"] = {
+            "categories": categories,
+            "period": {
+                "month": month,
+                "year": year
+            },
+            "runs": [dict(entry["run"], category=entry["category"])
+                     for entry in payroll if entry["records"]]
+        }
+        return jsonify(evaluation)
 
-def calculate_food_inhouse_old_salary(total_orders, target, gas_usage,
-                                      days_since_joining, total_revenue,
-                                      params):
-    target_v2 = days_since_joining * 15.8333333
-    final_target = min(target, target_v2)
-    basic_salary_rate = params.get('food_inhouse_old_basic_salary_rate',
-                                   66.66666667)
-    penalty_rate = params.get('food_inhouse_old_penalty_rate', 10)
-    gas_rate = params.get('food_inhouse_old_gas_rate', 2.065)
-    gas_cap = params.get('food_inhouse_old_gas_cap', 826)  # Gas cap for Food
-
-    basic_salary = (final_target / 15.83333333) * basic_salary_rate
-
-    bonus_orders = total_orders - final_target
-    bonus_amount = 0
-    if bonus_orders <= 0:
-        bonus_amount = bonus_orders * penalty_rate
-    else:
-        tiers = [
-            (124, 5),
-            (100, 6),
-            (100, 7),
-            (100, 8),
-            (float('inf'), 9)
-        ]
-        remaining_orders = bonus_orders
-        for tier_limit, rate in tiers:
-            orders_in_tier = min(remaining_orders, tier_limit)
-            bonus_amount += orders_in_tier * rate
-            remaining_orders -= orders_in_tier
-            if remaining_orders <= 0:
-                break
+    except Exception as e:
+        logging.exception("Unexpected error during scenario evaluation.")
+        return jsonify({"error": "Internal server error",
+                        "details": str(e)}), 500
 
-    gas_deserved = min(gas_rate * total_orders, gas_cap)
-    gas_difference = gas_deserved - gas_usage
+@app.route('/payroll_runs/export', methods=['GET'])
+@login_required
+def export_payroll_runs():
+    """Stream stored payroll runs as CSV, XLSX, Parquet or a bank file.
 
-    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+    Takes one run_id per category (as listed in meta.runs of
+    /calculate_salary), so an "All" run exports as a single file.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Unsupported format {export_format}"}), 400
 
-    return {
-        "Basic_Salary": round(basic_salary, 2),
-        "Bonus_Amount": round(bonus_amount, 2),
-        "Gas_Deserved": round(gas_deserved, 2),
-        "Gas_Difference": round(gas_difference, 2),
-        "Total_Salary": round(total_salary, 2),
-        "target": final_target
-    }
+    run_ids = request.args.getlist('run_id', type=int)
+    if not run_ids:
+        return jsonify({"error": "Missing required fields"}), 400
 
-def calculate_ecommerce_wh_salary(total_orders, target, gas_usage,
-                                  days_since_joining, total_revenue, params):
-    target2 = days_since_joining * 16.66667
-    final_target = min(target, target2)
-    basic_salary_rate = params.get('ecommerce_wh_basic_salary_rate',
-                                   66.666667)
-    bonus_rate = params.get('ecommerce_wh_bonus_rate', 8)
-    penalty_rate = params.get('ecommerce_wh_penalty_rate', 10)
-    gas_rate = params.get('ecommerce_wh_gas_rate', 15.03)
-    gas_cap = params.get('ecommerce_wh_gas_cap', 452)  # Gas cap for Ecommerce
-
-    basic_salary = (final_target / 16.6666667) * basic_salary_rate
-
-    bonus_orders = total_orders - final_target
-    if bonus_orders > 0:
-        bonus_amount = bonus_orders * bonus_rate
-    else:
-        bonus_amount = bonus_orders * penalty_rate
+    runs = [payroll_store.get_run(run_id) for run_id in run_ids]
+    if not all(runs):
+        return jsonify({"error": "Payroll run not found"}), 404
 
-    diesel_deserved = min((final_target / 16.666667) * gas_rate, gas_cap)
-    gas_difference = diesel_deserved - gas_usage
+    exporter, mimetype, extension = EXPORT_FORMATS[export_format]
+    records = itertools.chain.from_iterable(
+        payroll_store.iter_run_results(run_id) for run_id in run_ids)
+    prefix = "bank_payouts" if export_format == "bank" else "salary_data"
+    filename = f"{prefix}_{runs[0]['start_date']}_{runs[0]['end_date']}.{extension}"
 
-    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+    def generate():
+        try:
+            yield from exporter(records)
+        except Exception:
+            logging.exception("Payroll export failed.")
+            raise
 
-    return {
-        "Basic_Salary": round(basic_salary, 2),
-        "Bonus_Amount": round(bonus_amount, 2),
-        "Gas_Deserved": round(diesel_deserved, 2),
-        "Gas_Difference": round(gas_difference, 2),
-        "Total_Salary": round(total_salary, 2),
-        "target": final_target
-    }
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
-def calculate_ecommerce_salary(total_orders, target, gas_usage,
-                               days_since_joining, total_revenue, params):
-    target2 = days_since_joining * 221
-    final_target = min(target, target2)
-    revenue_coefficient = params.get('ecommerce_revenue_coefficient',
-                                     0.3016591252)
-    basic_salary_rate = params.get('ecommerce_basic_salary_rate',
-                                   66.66666667)
-    gas_cap = params.get('ecommerce_gas_cap', 452)  # Gas cap for Ecommerce
-
-    revenue_based_salary = total_revenue * revenue_coefficient
-    target_based_salary = (final_target / 221) * basic_salary_rate
-    basic_salary = min(revenue_based_salary, target_based_salary)
-
-    bonus_revenue = max(0, total_revenue - final_target)
-    if bonus_revenue <= 4000:
-        bonus_amount = bonus_revenue * 0.55
-    else:
-        bonus_amount = (4000 * 0.55) + ((bonus_revenue - 4000) * 0.5)
+@app.route('/payroll_runs/records', methods=['GET'])
+@login_required
+def payroll_runs_records():
+    """Stored salary records of runs, one page at a time.
 
-    diesel_deserved = min(0.068 * total_revenue,
-                          (final_target / 221) * 15.06, gas_cap)
-    gas_difference = diesel_deserved - gas_usage
+    Pass meta.next back as after for the following page; meta.total is
+    only counted for the first page.
+    """
+    run_ids = request.args.getlist('run_id', type=int)
+    if not run_ids:
+        return jsonify({"error": "Missing required fields"}), 400
 
-    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+    runs = [payroll_store.get_run(run_id) for run_id in run_ids]
+    if not all(runs):
+        return jsonify({"error": "Payroll run not found"}), 404
 
-    return {
-        "Basic_Salary": round(basic_salary, 2),
-        "Bonus_Amount": round(bonus_amount, 2),
-        "Gas_Deserved": round(diesel_deserved, 2),
-        "Gas_Difference": round(gas_difference, 2),
-        "Total_Salary": round(total_salary, 2),
-        "target": final_target
+    after = request.args.get('after')
+    try:
+        after = tuple(int(part) for part in after.split(':')) if after else None
+    except ValueError:
+        return jsonify({"error": "Invalid page cursor"}), 400
+    if after is not None and len(after) != 2:
+        return jsonify({"error": "Invalid page cursor"}), 400
+
+    limit = min(max(request.args.get('limit', RUN_RECORDS_PAGE_SIZE, type=int), 1),
+                MAX_RUN_RECORDS_PAGE_SIZE)
+    records, last = payroll_store.results_page(run_ids, after, limit)
+    meta = {
+        "count": len(records),
+        "next": f"{last[0]}:{last[1]}" if last else None
     }
+    if after is None:
+        # Counted once, on the first page
+        meta["total"] = sum(payroll_store.result_count(run_id)
+                            for run_id in run_ids)
+    return jsonify({"data": records, "meta": meta})
 
-def calculate_ajeer_salary(total_orders, target, gas_usage,
-                           days_since_joining, total_revenue, params):
-    basic_salary_rate = params.get('ajeer_basic_salary_rate', 53.33333)
-    penalty_rate = params.get('ajeer_penalty_rate', 10)
-    gas_rate = params.get('ajeer_gas_rate', 2.065)
-    gas_cap = params.get('ajeer_gas_cap', 826)  # Assuming same as Food
+@app.route('/payroll_runs/summary', methods=['GET'])
+@login_required
+def payroll_runs_summary():
+    """Dashboard aggregates of stored runs, without the courier rows."""
+    run_ids = request.args.getlist('run_id', type=int)
+    if not run_ids:
+        return jsonify({"error": "Missing required fields"}), 400
+
+    runs = [payroll_store.get_run(run_id) for run_id in run_ids]
+    if not all(runs):
+        return jsonify({"error": "Payroll run not found"}), 404
+
+    bins = min(max(request.args.get('bins', 20, type=int), 1), 200)
+    top = min(max(request.args.get('top', 10, type=int), 0), 100)
+    try:
+        frame = payroll_store.results_frame(run_ids, SUMMARY_COLUMNS)
+        summary = summarize_payroll(frame, bins=bins, top=top)
+    except Exception as e:
+        logging.exception("Payroll summary failed.")
+        return jsonify({"error": "Internal server error",
+                        "details": str(e)}), 500
 
-    basic_salary = (target / 13.333333333333334) * basic_salary_rate
+    summary["meta"] = {
+        "runs": [{"run_id": run["run_id"], "category": run["category"],
+                  "version": run["version"]} for run in runs],
+        "period": {"start_date": runs[0]["start_date"],
+                   "end_date": runs[0]["end_date"]}
+    }
+    return jsonify(summary)
+
+def payroll_side_run_ids(side):
+    """Run ids of one side of a diff: given run_ids, or a period/params run."""
+    if side.get('run_ids'):
+        return [int(run_id) for run_id in side['run_ids']]
+
+    category = side.get('category')
+    month = side.get('month')
+    year = side.get('year')
+    if not all([category, month, year]):
+        return []
+    categories = ALL_CATEGORIES if category == "All" else [category]
+    snapshot = parse_snapshot(side['snapshot']) if side.get('snapshot') \
+        else None
+    payroll = run_payroll(client, payroll_store, categories, int(month),
+                          int(year), side.get('customParams', {}),
+                          single_scan=side.get('singleScan', True),
+                          snapshot=snapshot)
+    return [entry["run"]["run_id"] for entry in payroll
+            if entry["run"]["run_id"]]
+
+@app.route('/payroll_runs/diff', methods=['POST'])
+@login_required
+def payroll_runs_diff():
+    """Per-courier salary deltas between two runs, periods or param sets.
 
-    bonus_orders = total_orders - target
-    bonus_amount = 0
-    if bonus_orders <= 0:
-        bonus_amount = bonus_orders * penalty_rate
-    else:
-        tiers = [
-            (299, 6),
-            (100, 7),
-            (100, 8),
-            (float('inf'), 9)
-        ]
-        remaining_orders = bonus_orders
-        for tier_limit, rate in tiers:
-            orders_in_tier = min(remaining_orders, tier_limit)
-            bonus_amount += orders_in_tier * rate
-            remaining_orders -= orders_in_tier
-            if remaining_orders <= 0:
-                break
+    base and compare each take either {"run_ids": [...]} or
+    {"category", "month", "year", "customParams", "snapshot"}.
+    """
+    try:
+        data = request.get_json() or {}
+        base = data.get('base') or {}
+        compare = data.get('compare') or {}
 
-    gas_deserved = min(gas_rate * total_orders, gas_cap)
-    gas_difference = gas_deserved - gas_usage
+        try:
+            base_ids = payroll_side_run_ids(base)
+            compare_ids = payroll_side_run_ids(compare)
+        except ValueError as e:
+            return jsonify({"error": "Invalid request",
+                            "details": str(e)}), 400
+        except Exception as e:
+            logging.error(f"BigQuery execution failed: {e}")
+            return jsonify({"error": "Failed to execute query",
+                            "details": str(e)}), 500
 
-    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+        if not base_ids or not compare_ids:
+            logging.warning("Missing required fields in the request.")
+            return jsonify({"error": "Missing required fields"}), 400
 
-    return {
-        "Basic_Salary": round(basic_salary, 2),
-        "Bonus_Amount": round(bonus_amount, 2),
-        "Gas_Deserved": round(gas_deserved, 2),
-        "Gas_Difference": round(gas_difference, 2),
-        "Total_Salary": round(total_salary, 2),
-        "target": target
-    }
+        runs = {run_id: payroll_store.get_run(run_id)
+                for run_id in base_ids + compare_ids}
+        if not all(runs.values()):
+            return jsonify({"error": "Payroll run not found"}), 404
+
+        diff = diff_payroll(
+            payroll_store.results_frame(base_ids, DIFF_COLUMNS),
+            payroll_store.results_frame(compare_ids, DIFF_COLUMNS),
+            top=min(max(int(data.get('top', 20)), 0), 100),
+            include_unchanged=data.get('includeUnchanged', False)
+        )
 
+        def side_meta(run_ids):
+            return [{"run_id": run_id,
+                     "category": runs[run_id]["category"],
+                     "start_date": runs[run_id]["start_date"],
+                     "end_date": runs[run_id]["end_date"],
+                     "version": runs[run_id]["version"],
+                     "snapshot": runs[run_id]["snapshot"]}
+                    for run_id in run_ids]
 
+        diff["meta"] = {"base": side_meta(base_ids),
+                        "compare": side_meta(compare_ids)}
+        return jsonify(diff)
+
+    except Exception as e:
+        logging.exception("Unexpected error during payroll diff.")
+        return jsonify({"error": "Internal server error",
+                        "details": str(e)}), 500
+
+@app.route('/payroll_runs/payslips', methods=['POST'])
+@login_required
+def start_payslips():
+    """Start a bulk payslip job for stored runs; poll its status URL."""
+    data = request.get_json() or {}
+    run_ids = [int(run_id) for run_id in data.get('run_ids', [])]
+    if not run_ids:
+        return jsonify({"error": "Missing required fields"}), 400
+
+    if not all(payroll_store.get_run(run_id) for run_id in run_ids):
+        return jsonify({"error": "Payroll run not found"}), 404
+
+    total = sum(payroll_store.result_count(run_id) for run_id in run_ids)
+    job = payslip_jobs.create(run_ids, total, job_owner())
+    records = itertools.chain.from_iterable(
+        payroll_store.iter_run_results(run_id) for run_id in run_ids)
+    try:
+        start_payslip_job(payslip_jobs, job, records)
+    except PayslipQueueFull as e:
+        job["status"] = "failed"
+        job["errors"].append(str(e))
+        payslip_jobs.save(job)
+        return jsonify({"error": "Too many payslip jobs are running, "
+                                 "please try again later",
+                        "details": str(e)}), 503
+    return jsonify(dict(job, status_url=url_for(
+        'payslip_status', job_id=job["job_id"]))), 202
+
+@app.route('/payroll_runs/payslips/<job_id>', methods=['GET'])
+@login_required
+def payslip_status(job_id):
+    job = payslip_jobs.get(job_id, job_owner())
+    if not job:
+        return jsonify({"error": "Payslip job not found"}), 404
+    if job["status"] == "done":
+        job["download_url"] = url_for('download_payslips', job_id=job_id)
+    return jsonify(job)
+
+@app.route('/payroll_runs/payslips/<job_id>/download', methods=['GET'])
+@login_required
+def download_payslips(job_id):
+    job = payslip_jobs.get(job_id, job_owner())
+    if not job:
+        return jsonify({"error": "Payslip job not found"}), 404
+    if job["status"] != "done":
+        return jsonify({"error": "Payslip job is not finished",
+                        "status": job["status"]}), 409
+
+    return send_file(payslip_jobs.zip_path(job_id),
+                     mimetype='application/zip',
+                     as_attachment=True,
+                     download_name=f'payslips_{job_id}.zip')
 
 @app.route('/')
 @login_required
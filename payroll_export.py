@@ -0,0 +1,217 @@
+"""Streaming exports of stored payroll runs.
+
+Every exporter takes an iterable of salary records and yields the file in
+chunks, so a run is never held in memory as a whole.
+"""
+import csv
+import io
+import logging
+import os
+import tempfile
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+
+# Records buffered per yielded chunk / Parquet row group
+EXPORT_BATCH_SIZE = 1000
+
+# Bytes read per chunk when streaming a spooled file
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Same columns as createCSVContent in static/js/app.js
+EXPORT_COLUMNS = [
+    ('BARQ ID', 'BARQ_ID'),
+    ('Name', 'Name'),
+    ('IBAN', 'iban'),
+    ('ID Number', 'id_number'),
+    ('Joining Date', 'joining_Date'),
+    ('Status', 'Status'),
+    ('Sponsorship Status', 'Sponsorshipstatus'),
+    ('Project', 'PROJECT'),
+    ('Supervisor', 'Supervisor'),
+    ('Total Orders', 'Total_Orders'),
+    ('Total Revenue', 'Total_Revenue'),
+    ('Gas Usage', 'Gas_Usage'),
+    ('Basic Salary', 'Basic_Salary'),
+    ('Bonus Amount', 'Bonus_Amount'),
+    ('Gas Deserved', 'Gas_Deserved'),
+    ('Gas Difference', 'Gas_Difference'),
+    ('Total Salary', 'Total_Salary'),
+    ('Start Period', 'period.start_date'),
+    ('End Period', 'period.end_date'),
+    ('Target', 'target'),
+    ('Days Since Joining', 'days_since_joining'),
+    ('Category', 'category')
+]
+
+# Export columns written as numbers in XLSX and Parquet; the rest are text
+NUMERIC_EXPORT_KEYS = {
+    'Total_Orders', 'Total_Revenue', 'Gas_Usage', 'Basic_Salary',
+    'Bonus_Amount', 'Gas_Deserved', 'Gas_Difference', 'Total_Salary',
+    'target', 'days_since_joining'
+}
+
+BANK_FILE_HEADER = ['IBAN', 'ID Number', 'Beneficiary Name', 'Amount',
+                    'Reference']
+
+
+def _value(record, key):
+    for part in key.split('.'):
+        record = record.get(part) if isinstance(record, dict) else None
+    return record
+
+
+def export_row(record):
+    return [_value(record, key) for _, key in EXPORT_COLUMNS]
+
+
+def _batches(records, size=EXPORT_BATCH_SIZE):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _csv_chunks(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for batch in _batches(rows):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_csv(records):
+    """Yield the salary CSV in text chunks."""
+    return _csv_chunks([header for header, _ in EXPORT_COLUMNS],
+                       (export_row(record) for record in records))
+
+
+def iter_bank_file(records, reference=None):
+    """Yield a bank payout CSV in text chunks.
+
+    One transfer per courier with a positive Total_Salary and an IBAN,
+    followed by a TOTAL line with the transfer count and amount.
+    """
+    reference = reference or f"SALARY-{datetime.now().strftime('%Y%m%d')}"
+    totals = {"count": 0, "amount": 0, "skipped": 0}
+
+    def transfers():
+        for record in records:
+            amount = record.get('Total_Salary') or 0
+            if not record.get('iban') or amount <= 0:
+                totals["skipped"] += 1
+                continue
+            totals["count"] += 1
+            totals["amount"] += amount
+            yield [str(record['iban']).replace(' ', ''),
+                   record.get('id_number'), record.get('Name'),
+                   f"{amount:.2f}", f"{reference}-{record.get('BARQ_ID')}"]
+
+    yield from _csv_chunks(BANK_FILE_HEADER, transfers())
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(['TOTAL', totals["count"], '',
+                                 f"{totals['amount']:.2f}", reference])
+    yield buffer.getvalue()
+    if totals["skipped"]:
+        logging.info(f"Bank file skipped {totals['skipped']} couriers "
+                     f"without IBAN or payable salary.")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object whose contents are drained after each write."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_parquet(records):
+    """Yield a Parquet file in byte chunks, one row group per batch."""
+    fields = [(key.replace('.', '_'), key, key in NUMERIC_EXPORT_KEYS)
+              for _, key in EXPORT_COLUMNS]
+    schema = pa.schema([(name, pa.float64() if numeric else pa.string())
+                        for name, _, numeric in fields])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for batch in _batches(records):
+            columns = {}
+            for name, key, numeric in fields:
+                convert = float if numeric else str
+                columns[name] = [
+                    None if value is None else convert(value)
+                    for value in (_value(record, key) for record in batch)]
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def iter_xlsx(records):
+    """Yield an XLSX workbook in byte chunks.
+
+    Rows are written with openpyxl's write-only mode and the workbook is
+    spooled to a temporary file, since the zip container can only be
+    finished once all rows are known.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Salaries")
+    sheet.append([header for header, _ in EXPORT_COLUMNS])
+    for record in records:
+        sheet.append([
+            None if value is None
+            else float(value) if key in NUMERIC_EXPORT_KEYS else str(value)
+            for (_, key), value in zip(EXPORT_COLUMNS, export_row(record))])
+
+    handle, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(handle)
+    try:
+        workbook.save(path)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(FILE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+# format -> (exporter, mimetype, file extension)
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "text/csv", "csv"),
+    "xlsx": (iter_xlsx, "application/vnd.openxmlformats-officedocument."
+                        "spreadsheetml.sheet", "xlsx"),
+    "parquet": (iter_parquet, "application/vnd.apache.parquet", "parquet"),
+    "bank": (iter_bank_file, "text/csv", "csv")
+}
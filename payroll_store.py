@@ -0,0 +1,505 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from salary import TARGETS_TABLE, get_period, fetch_payroll_rows, calculate_salary_details_batch, target_schedule
+
+# Tables whose changes invalidate stored payroll inputs
+SOURCE_TABLES = ["master_saned.ultimate", TARGETS_TABLE]
+
+# Older versions of a run key beyond this many are pruned on save
+KEEP_VERSIONS = 5
+
+# Superseded live versions older than this are pruned on save, whatever
+# their key
+SUPERSEDED_RUN_DAYS = 30
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, default=_json_default)
+
+
+def stored_form(value):
+    """value as it reads back from the store: JSON types, sorted keys."""
+    return json.loads(_dumps(value))
+
+
+def params_hash(params):
+    """Stable hash of one category's customParams."""
+    return hashlib.sha256(_dumps(params or {}).encode('utf-8')).hexdigest()
+
+
+def row_fingerprint(row):
+    """Hash of a courier's input aggregates as returned by the query."""
+    return hashlib.sha1(_dumps(row).encode('utf-8')).hexdigest()
+
+
+def source_version(client):
+    """Last-modified stamp of the payroll source tables, or None.
+
+    The target schedule only rechecks its table every few minutes, so it
+    is reloaded here when it is behind the stamp; a run stamped with this
+    version is then calculated with the targets it names. None when the
+    schedule can't be brought up to date.
+    """
+    try:
+        modified = {table_id: client.get_table(table_id).modified.isoformat()
+                    for table_id in SOURCE_TABLES}
+        if modified[TARGETS_TABLE] != target_schedule.version:
+            target_schedule.refresh(client, force=True)
+        if modified[TARGETS_TABLE] != target_schedule.version:
+            logging.error("Target schedule is behind the targets table.")
+            return None
+        return ";".join(f"{table_id}@{stamp}"
+                        for table_id, stamp in modified.items())
+    except Exception as e:
+        logging.error(f"Error reading payroll source table metadata: {e}")
+        return None
+
+
+class PayrollRunStore:
+    """SQLite store of payroll runs keyed by category, period and params.
+
+    Each key keeps numbered versions; a version holds every courier's input
+    aggregates and calculated salary record. Saving a version prunes all
+    but the newest KEEP_VERSIONS of its key, and superseded versions of
+    any key older than SUPERSEDED_RUN_DAYS. Runs pinned to a snapshot
+    timestamp are kept apart from live runs and are never pruned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            # Exports read a run for minutes; in WAL mode that never
+            # blocks saving or touching runs
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS payroll_runs (
+                    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    category TEXT NOT NULL,
+                    start_date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    params_hash TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    params TEXT NOT NULL,
+                    source_version TEXT,
+                    generated_date TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    recomputed INTEGER NOT NULL,
+                    snapshot TEXT,
+                    UNIQUE (category, start_date, end_date, params_hash,
+                            version)
+                );
+                CREATE TABLE IF NOT EXISTS payroll_run_rows (
+                    run_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    inputs TEXT NOT NULL,
+                    result TEXT,
+                    PRIMARY KEY (run_id, position)
+                );
+                CREATE TABLE IF NOT EXISTS provisional_periods (
+                    category TEXT NOT NULL,
+                    start_date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    accrued_through TEXT NOT NULL,
+                    target REAL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (category, start_date)
+                );
+                CREATE TABLE IF NOT EXISTS provisional_accruals (
+                    category TEXT NOT NULL,
+                    start_date TEXT NOT NULL,
+                    barq_id TEXT NOT NULL,
+                    row TEXT NOT NULL,
+                    PRIMARY KEY (category, start_date, barq_id)
+                );
+            """)
+            columns = [row["name"] for row in conn.execute(
+                "PRAGMA table_info(payroll_runs)")]
+            if "snapshot" not in columns:
+                conn.execute("ALTER TABLE payroll_runs ADD COLUMN snapshot TEXT")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_run(self, run_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM payroll_runs WHERE run_id = ?",
+                               (run_id,)).fetchone()
+        return dict(row) if row else None
+
+    def latest_run(self, category, start_date, end_date, key_hash,
+                   snapshot=None):
+        with self._connect() as conn:
+            row = conn.execute("""
+                SELECT * FROM payroll_runs
+                WHERE category = ? AND start_date = ? AND end_date = ?
+                AND params_hash = ? AND snapshot IS ?
+                ORDER BY version DESC LIMIT 1
+            """, (category, start_date, end_date, key_hash,
+                  snapshot)).fetchone()
+        return dict(row) if row else None
+
+    def run_rows(self, run_id):
+        """All stored rows of a run as dicts with parsed inputs/result."""
+        with self._connect() as conn:
+            rows = conn.execute("""
+                SELECT fingerprint, inputs, result FROM payroll_run_rows
+                WHERE run_id = ? ORDER BY position
+            """, (run_id,)).fetchall()
+        return [{
+            "fingerprint": row["fingerprint"],
+            "inputs": json.loads(row["inputs"]),
+            "result": json.loads(row["result"]) if row["result"] else None
+        } for row in rows]
+
+    def run_results(self, run_id):
+        return [row["result"] for row in self.run_rows(run_id)
+                if row["result"] is not None]
+
+    def result_count(self, run_id):
+        with self._connect() as conn:
+            return conn.execute("""
+                SELECT COUNT(*) FROM payroll_run_rows
+                WHERE run_id = ? AND result IS NOT NULL
+            """, (run_id,)).fetchone()[0]
+
+    def iter_run_results(self, run_id, batch_size=1000):
+        """Yield a run's salary records without loading the whole run."""
+        with self._connect() as conn:
+            cursor = conn.execute("""
+                SELECT result FROM payroll_run_rows
+                WHERE run_id = ? AND result IS NOT NULL ORDER BY position
+            """, (run_id,))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield json.loads(row["result"])
+
+    def results_page(self, run_ids, after=None, limit=1000):
+        """One page of the salary records of runs, in results_frame order.
+
+        after is the (run_id, position) key of the last record of the
+        previous page, so each page is a seek on the primary key. Returns
+        (records, after for the next page, or None on the last page).
+        """
+        after_run, after_position = after or (None, -1)
+        rows = []
+        with self._connect() as conn:
+            for run_id in sorted(set(run_ids)):
+                if after_run is not None and run_id < after_run:
+                    continue
+                rows += conn.execute("""
+                    SELECT run_id, position, result FROM payroll_run_rows
+                    WHERE run_id = ? AND position > ? AND result IS NOT NULL
+                    ORDER BY position LIMIT ?
+                """, (run_id, after_position if run_id == after_run else -1,
+                      limit + 1 - len(rows))).fetchall()
+                if len(rows) > limit:
+                    break
+        more = len(rows) > limit
+        rows = rows[:limit]
+        last = (rows[-1]["run_id"], rows[-1]["position"]) if more else None
+        return [json.loads(row["result"]) for row in rows], last
+
+    def results_frame(self, run_ids, columns):
+        """Selected result fields of runs as a DataFrame, read in SQLite."""
+        fields = ", ".join(f"json_extract(result, '$.{column}') AS {column}"
+                           for column in columns)
+        placeholders = ", ".join("?" for _ in run_ids)
+        with self._connect() as conn:
+            return pd.read_sql_query(f"""
+                SELECT {fields} FROM payroll_run_rows
+                WHERE run_id IN ({placeholders}) AND result IS NOT NULL
+                ORDER BY run_id, position
+            """, conn, params=list(run_ids))
+
+    def touch_run(self, run_id, source):
+        with self._connect() as conn:
+            conn.execute("UPDATE payroll_runs SET source_version = ? "
+                         "WHERE run_id = ?", (source, run_id))
+
+    def save_run(self, category, start_date, end_date, params, source,
+                 generated_date, rows, recomputed, snapshot=None):
+        """Store a new version of a run; rows are fingerprint/inputs/result."""
+        key_hash = params_hash(params)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("""
+                SELECT COALESCE(MAX(version), 0) + 1 FROM payroll_runs
+                WHERE category = ? AND start_date = ? AND end_date = ?
+                AND params_hash = ?
+            """, (category, start_date, end_date, key_hash)).fetchone()[0]
+            cursor = conn.execute("""
+                INSERT INTO payroll_runs (
+                    category, start_date, end_date, params_hash, version,
+                    params, source_version, generated_date, created_at,
+                    row_count, recomputed, snapshot)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (category, start_date, end_date, key_hash, version,
+                  _dumps(params or {}), source, generated_date,
+                  datetime.now().isoformat(), len(rows), recomputed,
+                  snapshot))
+            run_id = cursor.lastrowid
+            conn.executemany("""
+                INSERT INTO payroll_run_rows
+                    (run_id, position, fingerprint, inputs, result)
+                VALUES (?, ?, ?, ?, ?)
+            """, ((run_id, position, row["fingerprint"],
+                   _dumps(row["inputs"]),
+                   _dumps(row["result"]) if row["result"] is not None
+                   else None)
+                  for position, row in enumerate(rows)))
+            self._prune(conn, category, start_date, end_date, key_hash,
+                        version)
+        logging.info(f"Stored payroll run {run_id} ({category} "
+                     f"{start_date}..{end_date} v{version}, "
+                     f"{recomputed}/{len(rows)} recomputed).")
+        return self.get_run(run_id)
+
+    def provisional_state(self, category, start_date):
+        with self._connect() as conn:
+            row = conn.execute("""
+                SELECT * FROM provisional_periods
+                WHERE category = ? AND start_date = ?
+            """, (category, start_date)).fetchone()
+        return dict(row) if row else None
+
+    def provisional_rows(self, category, start_date):
+        """Running aggregates of a provisional period keyed by BARQ_ID."""
+        with self._connect() as conn:
+            rows = conn.execute("""
+                SELECT barq_id, row FROM provisional_accruals
+                WHERE category = ? AND start_date = ?
+            """, (category, start_date)).fetchall()
+        return {row["barq_id"]: json.loads(row["row"]) for row in rows}
+
+    def save_provisional(self, category, start_date, end_date,
+                         previous_through, accrued_through, target, rows,
+                         rebuild=False):
+        """Store accrued rows and advance a provisional period.
+
+        Only succeeds if the period is still accrued through
+        previous_through, so concurrent refreshes never add a day twice.
+        Returns False when another refresh got there first.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            current = conn.execute("""
+                SELECT accrued_through FROM provisional_periods
+                WHERE category = ? AND start_date = ?
+            """, (category, start_date)).fetchone()
+            if not rebuild and (current[0] if current else None) \
+                    != previous_through:
+                return False
+            if rebuild:
+                conn.execute("""
+                    DELETE FROM provisional_accruals
+                    WHERE category = ? AND start_date = ?
+                """, (category, start_date))
+            conn.executemany("""
+                INSERT OR REPLACE INTO provisional_accruals
+                    (category, start_date, barq_id, row)
+                VALUES (?, ?, ?, ?)
+            """, ((category, start_date, barq_id, _dumps(row))
+                  for barq_id, row in rows.items()))
+            conn.execute("""
+                INSERT OR REPLACE INTO provisional_periods
+                    (category, start_date, end_date, accrued_through, target,
+                     updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (category, start_date, end_date, accrued_through, target,
+                  datetime.now().isoformat()))
+        return True
+
+    def _prune(self, conn, category, start_date, end_date, key_hash,
+               version):
+        stale = [row[0] for row in conn.execute("""
+            SELECT run_id FROM payroll_runs
+            WHERE category = ? AND start_date = ? AND end_date = ?
+            AND params_hash = ? AND version <= ? AND snapshot IS NULL
+        """, (category, start_date, end_date, key_hash,
+              version - KEEP_VERSIONS))]
+        cutoff = (datetime.now()
+                  - timedelta(days=SUPERSEDED_RUN_DAYS)).isoformat()
+        stale += [row[0] for row in conn.execute("""
+            SELECT run_id FROM payroll_runs AS run
+            WHERE snapshot IS NULL AND created_at < ? AND EXISTS (
+                SELECT 1 FROM payroll_runs AS newer
+                WHERE newer.category = run.category
+                AND newer.start_date = run.start_date
+                AND newer.end_date = run.end_date
+                AND newer.params_hash = run.params_hash
+                AND newer.snapshot IS NULL
+                AND newer.version > run.version)
+        """, (cutoff,)) if row[0] not in stale]
+        for run_id in stale:
+            conn.execute("DELETE FROM payroll_run_rows WHERE run_id = ?",
+                         (run_id,))
+            conn.execute("DELETE FROM payroll_runs WHERE run_id = ?",
+                         (run_id,))
+        if stale:
+            logging.info(f"Pruned {len(stale)} superseded payroll runs.")
+
+
+def _calculate_rows(inputs, category, start_date, end_date, params,
+                    previous, today=None):
+    """Calculate rows, reusing previous results for unchanged fingerprints.
+
+    previous maps fingerprint -> list of stored results.
+    """
+    rows = []
+    pending = []
+    for row in inputs:
+        fingerprint = row_fingerprint(row)
+        reusable = previous.get(fingerprint)
+        result = reusable.pop() if reusable else None
+        rows.append({"fingerprint": fingerprint, "inputs": row,
+                     "result": result})
+        if result is None:
+            pending.append((rows[-1], dict(row)))
+
+    processed = calculate_salary_details_batch(
+        [work for _, work in pending], category, start_date, end_date, params,
+        today)
+    processed_ids = {id(result) for result in processed}
+    for row, work in pending:
+        if id(work) in processed_ids:
+            # Same types as the results reused from the store
+            row["result"] = stored_form(work)
+    return rows, len(pending)
+
+
+def run_payroll(client, store, categories, month, year, custom_params,
+                single_scan=True, refresh=False, snapshot=None):
+    """Calculate payroll for categories through the run store.
+
+    Categories whose source tables are unchanged since their latest stored
+    run are served without querying BigQuery. Otherwise the aggregates are
+    fetched and only couriers whose aggregates changed are recalculated.
+    A snapshot (an aware UTC datetime) pins the source tables to that time
+    and days_since_joining to its date; a stored pinned run is served
+    as-is however old it is. Returns a list of dicts with category,
+    period, records and run; records are in their stored JSON form
+    whether they were reused or recalculated.
+    """
+    pinned = snapshot.isoformat() if snapshot is not None else None
+    today = snapshot.date() if snapshot is not None else None
+    source = f"snapshot@{pinned}" if pinned else source_version(client)
+    generated_date = datetime.now().strftime('%Y-%m-%d')
+
+    plans = []
+    for category in categories:
+        start_date, end_date = get_period(category, month, year)
+        params = custom_params.get(category, {})
+        latest = store.latest_run(category, start_date, end_date,
+                                  params_hash(params), pinned)
+        fresh = (not refresh and latest is not None and source is not None
+                 and latest["source_version"] == source)
+        plans.append({"category": category, "start_date": start_date,
+                      "end_date": end_date, "params": params,
+                      "latest": latest, "fresh": fresh})
+
+    to_fetch = [plan["category"] for plan in plans if not plan["fresh"]]
+    fetched = {}
+    if to_fetch:
+        for category, _, _, rows in fetch_payroll_rows(
+                client, to_fetch, month, year, single_scan=single_scan,
+                snapshot=snapshot):
+            fetched[category] = rows
+
+    payroll = []
+    for plan in plans:
+        category = plan["category"]
+        latest = plan["latest"]
+        previous_rows = store.run_rows(latest["run_id"]) if latest else []
+        same_day = (latest is not None and not refresh
+                    and (pinned is not None
+                         or latest["generated_date"] == generated_date))
+
+        if plan["fresh"] and same_day:
+            records = [row["result"] for row in previous_rows
+                       if row["result"] is not None]
+            payroll.append(_payroll_entry(plan, records, latest, 0))
+            continue
+
+        if category in fetched:
+            inputs = fetched[category]
+        else:
+            inputs = [row["inputs"] for row in previous_rows]
+
+        previous = {}
+        if same_day:
+            for row in previous_rows:
+                if row["result"] is not None:
+                    previous.setdefault(row["fingerprint"], []).append(
+                        row["result"])
+
+        rows, recomputed = _calculate_rows(
+            inputs, category, plan["start_date"], plan["end_date"],
+            plan["params"], previous, today)
+
+        unchanged = same_day and recomputed == 0 and len(rows) == len(
+            previous_rows) and all(
+                row["fingerprint"] == old["fingerprint"]
+                for row, old in zip(rows, previous_rows))
+        if unchanged:
+            store.touch_run(latest["run_id"], source)
+            run = dict(latest, source_version=source)
+        else:
+            run = store.save_run(category, plan["start_date"],
+                                 plan["end_date"], plan["params"], source,
+                                 generated_date, rows, recomputed, pinned)
+
+        records = [row["result"] for row in rows if row["result"] is not None]
+        payroll.append(_payroll_entry(plan, records, run, recomputed))
+    return payroll
+
+
+def _payroll_entry(plan, records, run, recomputed):
+    return {
+        "category": plan["category"],
+        "start_date": plan["start_date"],
+        "end_date": plan["end_date"],
+        "records": records,
+        "run": {
+            "run_id": run["run_id"] if run else None,
+            "version": run["version"] if run else None,
+            "source_version": run["source_version"] if run else None,
+            "snapshot": run["snapshot"] if run else None,
+            "recomputed": recomputed,
+            "count": len(records)
+        }
+    }
@@ -0,0 +1,313 @@
+"""Bulk payslip PDFs for stored payroll runs.
+
+A payslip job renders every record of one or more runs with the payslip
+template in a process pool and writes the PDFs into a ZIP on disk. Job
+progress is kept in a JSON file next to the ZIP so any worker can report
+it and stream the finished archive. A job belongs to the user who
+started it; other users are told it does not exist.
+
+Each worker process builds its jobs one at a time with a single shared
+render pool and refuses new jobs past PAYSLIP_MAX_PENDING_JOBS. Queued
+and running jobs carry a heartbeat; a job whose heartbeat stops (its
+worker was restarted) is reported as failed.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime
+
+import pdfkit
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
+LOGO_PATH = os.path.join(BASE_DIR, "static", "images", "logo3.png")
+PAYSLIP_TEMPLATE = "payslip.html"
+
+# Records handed to the pool at a time; bounds memory for large runs
+PAYSLIP_CHUNK_SIZE = 200
+
+# Render processes per worker process, shared by all of its jobs
+PAYSLIP_WORKERS = min(4, os.cpu_count() or 1)
+
+# Jobs a worker process builds at once; later ones wait in its queue
+PAYSLIP_CONCURRENT_JOBS = 1
+
+# Jobs a worker process holds (building and queued) before refusing more
+PAYSLIP_MAX_PENDING_JOBS = 4
+
+# How often a worker stamps the heartbeat of its queued and running jobs
+PAYSLIP_HEARTBEAT_SECONDS = 15
+
+# Queued or running jobs with an older heartbeat lost their worker
+PAYSLIP_STALE_SECONDS = 120
+
+PDF_OPTIONS = {
+    "page-size": "A4",
+    "margin-top": "0.5in",
+    "margin-bottom": "0.5in",
+    "margin-left": "0.5in",
+    "margin-right": "0.5in",
+    "encoding": "UTF-8",
+    "enable-local-file-access": "",
+    "quiet": ""
+}
+
+# Compiled once per worker process by _init_worker
+_template = None
+
+
+def _currency(value):
+    try:
+        return f"{float(value):,.2f} SAR"
+    except (TypeError, ValueError):
+        return ""
+
+
+def _payslip_date(value):
+    if not value:
+        return ""
+    if isinstance(value, (date, datetime)):
+        return value.strftime('%d/%m/%Y')
+    try:
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d').strftime(
+            '%d/%m/%Y')
+    except ValueError:
+        return str(value)
+
+
+def payslip_environment():
+    environment = Environment(loader=FileSystemLoader(TEMPLATE_DIR),
+                              autoescape=select_autoescape(["html"]))
+    environment.filters["currency"] = _currency
+    environment.filters["payslip_date"] = _payslip_date
+    return environment
+
+
+def _init_worker():
+    global _template
+    _template = payslip_environment().get_template(PAYSLIP_TEMPLATE)
+
+
+def payslip_filename(record):
+    period = record.get("period") or {}
+    return f"payslip_{record.get('BARQ_ID')}_{period.get('start_date')}.pdf"
+
+
+def render_payslip(record):
+    """Render one payslip; returns (filename, pdf bytes or None, error)."""
+    if _template is None:
+        _init_worker()
+    try:
+        html = _template.render(record=record,
+                                logo_url=f"file://{LOGO_PATH}")
+        return payslip_filename(record), pdfkit.from_string(
+            html, False, options=PDF_OPTIONS), None
+    except Exception as e:
+        return payslip_filename(record), None, str(e)
+
+
+class PayslipQueueFull(Exception):
+    """Raised when a worker already holds PAYSLIP_MAX_PENDING_JOBS jobs."""
+
+
+class PayslipJobStore:
+    """Payslip job status files and ZIP archives in one directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _status_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def zip_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.zip")
+
+    def get(self, job_id, owner):
+        """A job of this owner, or None; queued or running jobs without
+        a recent heartbeat are marked failed."""
+        try:
+            with open(self._status_path(job_id)) as f:
+                job = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if job.get("owner") != owner:
+            return None
+        if job["status"] in ("queued", "running") and \
+                time.time() - job.get("heartbeat", 0) > PAYSLIP_STALE_SECONDS:
+            logging.warning(f"Payslip job {job_id} has no heartbeat, "
+                            f"marking it failed.")
+            job["status"] = "failed"
+            job["errors"].append("The worker building this job stopped.")
+            job["finished_at"] = datetime.now().isoformat()
+            self.save(job)
+        return job
+
+    def save(self, job):
+        path = self._status_path(job["job_id"])
+        with self._lock:
+            job["heartbeat"] = time.time()
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(job, f)
+            os.replace(temp_path, path)
+        return job
+
+    def create(self, run_ids, total, owner):
+        return self.save({
+            "job_id": uuid.uuid4().hex,
+            "owner": owner,
+            "run_ids": run_ids,
+            "status": "queued",
+            "total": total,
+            "done": 0,
+            "failed": 0,
+            "errors": [],
+            "created_at": datetime.now().isoformat(),
+            "finished_at": None
+        })
+
+
+def _chunks(records, size=PAYSLIP_CHUNK_SIZE):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def build_payslip_zip(store, job, records, pool):
+    """Render all records into the job's ZIP, saving progress per chunk."""
+    job["status"] = "running"
+    store.save(job)
+    temp_path = f"{store.zip_path(job['job_id'])}.tmp"
+    try:
+        with zipfile.ZipFile(temp_path, "w",
+                             zipfile.ZIP_DEFLATED) as archive:
+            for chunk in _chunks(records):
+                for filename, pdf, error in pool.map(render_payslip, chunk):
+                    if pdf is None:
+                        job["failed"] += 1
+                        if len(job["errors"]) < 20:
+                            job["errors"].append(f"{filename}: {error}")
+                        continue
+                    archive.writestr(filename, pdf)
+                    job["done"] += 1
+                store.save(job)
+        os.replace(temp_path, store.zip_path(job["job_id"]))
+        job["status"] = "done"
+    except Exception as e:
+        logging.exception(f"Payslip job {job['job_id']} failed.")
+        job["status"] = "failed"
+        job["errors"].append(str(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    job["finished_at"] = datetime.now().isoformat()
+    store.save(job)
+    logging.info(f"Payslip job {job['job_id']} {job['status']}: "
+                 f"{job['done']} rendered, {job['failed']} failed.")
+    return job
+
+
+class PayslipRunner:
+    """Bounded queue of this process's payslip jobs.
+
+    Jobs are built by PAYSLIP_CONCURRENT_JOBS threads with one shared
+    render pool, so concurrent requests don't multiply processes. A
+    heartbeat thread stamps the jobs the process holds. Everything is
+    rebuilt in a forked child.
+    """
+
+    def __init__(self, workers=PAYSLIP_WORKERS,
+                 concurrent_jobs=PAYSLIP_CONCURRENT_JOBS,
+                 max_pending=PAYSLIP_MAX_PENDING_JOBS):
+        self.workers = workers
+        self.concurrent_jobs = concurrent_jobs
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pid = None
+        self._jobs = {}
+        self._executor = None
+        self._pool = None
+
+    def _ensure(self):
+        # Called with the lock held
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._jobs = {}
+        self._pool = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrent_jobs, thread_name_prefix="payslips")
+        threading.Thread(target=self._heartbeat, name="payslip-heartbeat",
+                         daemon=True).start()
+
+    def _render_pool(self):
+        with self._lock:
+            self._ensure()
+            if self._pool is None:
+                # Spawned, not forked: this runs beside request threads
+                # that may hold the logging, SQLite or BigQuery locks
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_init_worker,
+                    mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def submit(self, store, job, records):
+        """Queue a job; raises PayslipQueueFull when the queue is full."""
+        with self._lock:
+            self._ensure()
+            if len(self._jobs) >= self.max_pending:
+                raise PayslipQueueFull(
+                    f"{len(self._jobs)} payslip jobs are already pending.")
+            self._jobs[job["job_id"]] = (store, job)
+            self._executor.submit(self._run, store, job, records)
+
+    def _run(self, store, job, records):
+        try:
+            build_payslip_zip(store, job, records, self._render_pool())
+        except Exception as e:
+            logging.exception(f"Payslip job {job['job_id']} could not start.")
+            job["status"] = "failed"
+            job["errors"].append(str(e))
+            job["finished_at"] = datetime.now().isoformat()
+            store.save(job)
+        finally:
+            with self._lock:
+                self._jobs.pop(job["job_id"], None)
+                if job["status"] == "failed" and self._pool is not None:
+                    # A crashed render process breaks the pool for good
+                    self._pool.shutdown(wait=False)
+                    self._pool = None
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(PAYSLIP_HEARTBEAT_SECONDS)
+            with self._lock:
+                jobs = list(self._jobs.values())
+            for store, job in jobs:
+                try:
+                    store.save(job)
+                except OSError as e:
+                    logging.warning(f"Could not stamp payslip job "
+                                    f"{job['job_id']}: {e}")
+
+
+# Shared by every request of the process
+payslip_runner = PayslipRunner()
+
+
+def start_payslip_job(store, job, records):
+    """Queue build_payslip_zip for a job on this process's runner."""
+    payslip_runner.submit(store, job, records)
@@ -0,0 +1,176 @@
+"""Provisional (mid-period) payroll accrued one day at a time.
+
+Each courier's running aggregates for the current period are kept in the
+payroll store. A refresh only queries master_saned.ultimate for the days
+after the last accrued day, adds them to the running totals and re-runs
+the category formulas with the newest day's target from the target
+schedule.
+"""
+import logging
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from salary import (ALL_CATEGORIES, get_period, generate_query,
+                    generate_all_query, target_schedule,
+                    calculate_salary_details_batch)
+
+# Aggregates of _base_query that are summed across days
+ACCRUED_COLUMNS = ["Total_Orders", "Total_Revenue", "Gas_Usage"]
+
+
+def _day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _number(value):
+    if value is None:
+        return 0
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def provisional_window(category, month, year, as_of=None):
+    """Period of a category and the last day to accrue through.
+
+    as_of defaults to yesterday, the last complete day, and is capped at
+    the period end. Returns (start_date, end_date, as_of) as strings.
+    """
+    start_date, end_date = get_period(category, month, year)
+    as_of = _day(as_of) if as_of else date.today() - timedelta(days=1)
+    as_of = min(as_of, _day(end_date))
+    return start_date, end_date, as_of.strftime('%Y-%m-%d')
+
+
+def fetch_day_rows(client, categories, start_date, end_date):
+    """Aggregates per courier for a day range, keyed by category.
+
+    Several categories of one period are fetched with the combined query.
+    """
+    rows = {category: [] for category in categories}
+    if len(categories) > 1 and all(category in ALL_CATEGORIES
+                                   for category in categories):
+        query = generate_all_query(start_date, end_date, categories)
+        for row in client.query(query).result():
+            row = dict(row)
+            rows[row.pop('category')].append(row)
+        return rows
+
+    for category in categories:
+        query = generate_query(category, start_date, end_date)
+        rows[category] = [dict(row) for row in client.query(query).result()]
+    return rows
+
+
+def accrue_rows(accruals, rows):
+    """Add new days' rows to the running aggregates in place.
+
+    Courier attributes (name, status, supervisor, ...) are taken from the
+    newest rows. Returns the BARQ_IDs that changed.
+    """
+    changed = set()
+    for row in rows:
+        barq_id = str(row['BARQ_ID'])
+        current = accruals.get(barq_id)
+        merged = dict(row)
+        for column in ACCRUED_COLUMNS:
+            merged[column] = _number(row.get(column)) + (
+                _number(current.get(column)) if current else 0)
+        accruals[barq_id] = merged
+        changed.add(barq_id)
+    return changed
+
+
+def run_provisional_payroll(client, store, categories, month, year,
+                            custom_params, as_of=None, rebuild=False):
+    """Provisional payroll for the period-to-date of each category.
+
+    Only days after the stored accrued_through are queried; rebuild
+    rescans the period from its first day. Returns a list of dicts with
+    category, period, records and provisional accrual details.
+    """
+    plans = []
+    for category in categories:
+        start_date, end_date, through = provisional_window(
+            category, month, year, as_of)
+        state = None if rebuild else store.provisional_state(
+            category, start_date)
+        if state:
+            scan_from = (_day(state["accrued_through"])
+                         + timedelta(days=1)).strftime('%Y-%m-%d')
+        else:
+            scan_from = start_date
+        plans.append({"category": category, "start_date": start_date,
+                      "end_date": end_date, "through": through,
+                      "state": state, "scan_from": scan_from,
+                      "scan": scan_from <= through})
+
+    # Categories needing the same day range share one query
+    groups = {}
+    for plan in plans:
+        if plan["scan"]:
+            groups.setdefault((plan["scan_from"], plan["through"]),
+                              []).append(plan["category"])
+    fetched = {}
+    for (scan_from, through), group in groups.items():
+        logging.info(f"Accruing {', '.join(group)} from {scan_from} to "
+                     f"{through}.")
+        fetched.update(fetch_day_rows(client, group, scan_from, through))
+
+    payroll = []
+    for plan in plans:
+        category = plan["category"]
+        state = plan["state"]
+        accruals = store.provisional_rows(category, plan["start_date"]) \
+            if state else {}
+        target = state["target"] if state else None
+        new_rows = 0
+
+        if plan["scan"]:
+            rows = fetched.get(category, [])
+            new_rows = len(rows)
+            target = target_schedule.target(client, category,
+                                            plan["through"])
+            changed = accrue_rows(accruals, rows)
+            saved = store.save_provisional(
+                category, plan["start_date"], plan["end_date"],
+                state["accrued_through"] if state else None, plan["through"],
+                target, {barq_id: accruals[barq_id] for barq_id in changed},
+                rebuild=rebuild or not state)
+            if not saved:
+                # Another refresh advanced the period; use its result
+                logging.info(f"Provisional {category} was refreshed "
+                             f"concurrently, reloading.")
+                state = store.provisional_state(category, plan["start_date"])
+                accruals = store.provisional_rows(category,
+                                                  plan["start_date"])
+                target = state["target"]
+            else:
+                state = {"accrued_through": plan["through"]}
+
+        inputs = [dict(row, TARGET=target) for row in accruals.values()]
+        accrued_through = state["accrued_through"] if state else None
+        # Days since joining count to the accrual date, not the wall clock,
+        # so a figure recomputed later for the same date is the same
+        records = calculate_salary_details_batch(
+            inputs, category, plan["start_date"], plan["end_date"],
+            custom_params.get(category, {}),
+            _day(accrued_through) if accrued_through else None)
+        for record in records:
+            record["accrued_through"] = accrued_through
+
+        payroll.append({
+            "category": category,
+            "start_date": plan["start_date"],
+            "end_date": plan["end_date"],
+            "records": records,
+            "provisional": {
+                "accrued_through": accrued_through,
+                "scanned": [plan["scan_from"], plan["through"]]
+                if plan["scan"] else None,
+                "new_rows": new_rows,
+                "couriers": len(accruals),
+                "target": target
+            }
+        })
+    return payroll
@@ -0,0 +1,688 @@
+"""Result cache for BigQuery queries.
+
+Results are cached in two layers keyed by the SQL text and its parameters:
+
+- QueryCache, an in-process LRU with a time limit per query class and a
+  memory budget, and
+- SharedQueryCache, a SQLite file on local disk shared by every gunicorn
+  worker, so a result fetched by one worker is reused by all of them and
+  survives worker restarts.
+
+Only the app's own read queries are cached; user-supplied SQL is not.
+Entries remember the tables they read. A write through execute_query
+drops the cached results of every table it touched in both layers; other
+workers pick the invalidation up from the shared file within a second.
+
+Misses go through SingleFlight, so identical queries that arrive while one
+is running wait for that BigQuery job instead of starting another.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+
+from google.cloud.bigquery import Row
+
+# (class name, pattern, seconds to keep) checked in order, first match wins
+QUERY_CLASSES = [
+    ("metadata", re.compile(r"\bINFORMATION_SCHEMA\b", re.I), 3600),
+    ("lookup", re.compile(r"^\s*SELECT\s+DISTINCT\b", re.I), 900),
+    ("metric", re.compile(r"^\s*SELECT\s+COUNT\s*\(", re.I), 300),
+    ("series", re.compile(r"\bGROUP\s+BY\b", re.I), 300),
+    ("default", None, 60)
+]
+
+# Seconds to keep table lists and schemas
+METADATA_TTL = 3600
+
+# Comments, string literals and quoted identifiers, blanked out before
+# looking for statement keywords
+SQL_NOISE_PATTERN = re.compile(
+    r"--[^\n]*|#[^\n]*|/\*.*?\*/|'{3}.*?'{3}|\"{3}.*?\"{3}"
+    r"|'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\"|`[^`]*`", re.S)
+
+# DML, DDL and scripting keywords; none of them can appear in a read
+WRITE_PATTERN = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|CREATE|DROP|ALTER|TRUNCATE|DECLARE|SET"
+    r"|BEGIN|CALL|EXECUTE|EXPORT|LOAD|GRANT|REVOKE)\b", re.I)
+
+# Statement types BigQuery reports for jobs that only read
+READ_STATEMENT_TYPES = {"SELECT"}
+
+# dataset.table after FROM/JOIN/INTO/UPDATE/TABLE, with optional project
+TABLE_PATTERN = re.compile(
+    r"\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+`?(?:[\w-]+\.)?(\w+\.\w+)\b`?",
+    re.I)
+
+# Total estimated size of rows cached in memory per process
+CACHE_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Results larger than this share of the budget are not cached
+CACHE_MAX_ENTRY_SHARE = 0.25
+
+# Shared cache file and the compressed bytes it may hold
+SHARED_CACHE_PATH = os.path.join("sys", "query_cache.sqlite")
+SHARED_CACHE_BUDGET = 256 * 1024 * 1024
+
+# How often a worker looks for invalidations made by other workers
+INVALIDATION_CHECK_SECONDS = 1
+
+# Invalidation log entries older than this are pruned
+INVALIDATION_LOG_SECONDS = 24 * 3600
+
+# Running jobs older than this are not joined by other workers
+RUNNING_JOB_SECONDS = 600
+
+# Skip rewriting an entry's access time when it was touched this recently
+ACCESS_UPDATE_SECONDS = 30
+
+
+def query_class(query):
+    """(class name, seconds to keep) of a read query."""
+    for name, pattern, ttl in QUERY_CLASSES:
+        if pattern is None or pattern.search(query):
+            return name, ttl
+
+
+def is_write(query):
+    """Whether a query may change data.
+
+    Write keywords count anywhere outside comments and strings, so DML
+    after a WITH clause is found; a multi-statement script counts as a
+    write. When in doubt a query is a write, which only skips caching.
+    """
+    code = SQL_NOISE_PATTERN.sub(" ", query)
+    statements = [part for part in code.split(";") if part.strip()]
+    return len(statements) > 1 or bool(WRITE_PATTERN.search(code))
+
+
+def is_write_statement(statement_type, query):
+    """Whether a finished job changed data, by BigQuery's statement type.
+
+    Falls back to parsing the query when the type is unknown.
+    """
+    if statement_type:
+        return statement_type not in READ_STATEMENT_TYPES
+    return is_write(query)
+
+
+def query_tables(query):
+    """Lowercased dataset.table names a query reads or writes."""
+    return frozenset(match.lower() for match in TABLE_PATTERN.findall(query))
+
+
+def cache_key(query, params=None):
+    key = " ".join(query.split())
+    if params:
+        key += "\n" + json.dumps([param.to_api_repr() for param in params],
+                                 sort_keys=True, default=str)
+    return key
+
+
+def statement_rows(job):
+    """(statement type, rows) of a finished job."""
+    rows = list(job.result())
+    return job.statement_type, rows
+
+
+def estimate_size(rows):
+    """Rough size in bytes of a list of rows."""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        values = row.values() if isinstance(row, Row) else [row]
+        size += 64 + sum(sys.getsizeof(value) for value in values)
+    return size
+
+
+def _encode(value):
+    """JSON-safe form of a BigQuery value; non-JSON types carry a tag."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Decimal):
+        return {"$": "decimal", "v": str(value)}
+    if isinstance(value, datetime):
+        return {"$": "datetime", "v": value.isoformat()}
+    if isinstance(value, date):
+        return {"$": "date", "v": value.isoformat()}
+    if isinstance(value, dt_time):
+        return {"$": "time", "v": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"$": "bytes", "v": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return {"$": "dict",
+                "v": {key: _encode(item) for key, item in value.items()}}
+    raise TypeError(f"Cannot cache a value of type {type(value).__name__}")
+
+
+_DECODERS = {
+    "decimal": Decimal,
+    "datetime": datetime.fromisoformat,
+    "date": date.fromisoformat,
+    "time": dt_time.fromisoformat,
+    "bytes": base64.b64decode,
+    "dict": lambda value: {key: _decode(item) for key, item in value.items()}
+}
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if isinstance(value, dict):
+        return _DECODERS[value["$"]](value["v"])
+    return value
+
+
+def serialize_rows(rows):
+    """Compressed bytes of a result; BigQuery rows keep one field map.
+
+    Results are written as JSON with tagged values, so reading the shared
+    file never runs code.
+    """
+    rows = list(rows)
+    if rows and all(isinstance(row, Row) for row in rows):
+        payload = {"kind": "rows", "fields": rows[0]._xxx_field_to_index,
+                   "values": [_encode(list(row.values())) for row in rows]}
+    else:
+        payload = {"kind": "values", "values": _encode(rows)}
+    return zlib.compress(b"J" + json.dumps(payload).encode("utf-8"), 1)
+
+
+def deserialize_rows(data):
+    data = zlib.decompress(data)
+    if data[:1] != b"J":
+        raise ValueError("Unknown shared cache payload format")
+    payload = json.loads(data[1:])
+    if payload["kind"] == "rows":
+        fields = payload["fields"]
+        return [Row(tuple(_decode(row)), fields) for row in payload["values"]]
+    return _decode(payload["values"])
+
+
+class QueryCache:
+    """Thread-safe in-process LRU of query results with expiry."""
+
+    def __init__(self, memory_budget=CACHE_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry["size"]
+
+    def get(self, key):
+        """Cached rows for a key, or None when missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires"] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # Copied so callers can't change cached results
+            return list(entry["rows"])
+
+    def put(self, key, rows, ttl, tables, name="default"):
+        size = estimate_size(rows)
+        if ttl <= 0 or size > self.memory_budget * CACHE_MAX_ENTRY_SHARE:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "rows": list(rows),
+                "tables": frozenset(tables),
+                "class": name,
+                "size": size,
+                "expires": time.monotonic() + ttl
+            }
+            self._size += size
+            while self._size > self.memory_budget:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def invalidate(self, tables):
+        """Drop every entry that read one of the given tables."""
+        tables = {table.lower() for table in tables}
+        if not tables:
+            return 0
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if entry["tables"] & tables]
+            for key in stale:
+                self._remove(key)
+            self.invalidations += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "memory_budget": self.memory_budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+class SharedQueryCache:
+    """SQLite file of compressed query results shared across processes.
+
+    Each entry is written with its table names in one transaction. When
+    the stored bytes exceed the budget, expired entries and then the least
+    recently read ones are deleted. Invalidations are appended to a log so
+    the in-memory caches of other workers can follow them.
+    """
+
+    def __init__(self, path=SHARED_CACHE_PATH, budget=SHARED_CACHE_BUDGET):
+        self.path = path
+        self.budget = budget
+        self._ready = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _setup(self):
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS cache_entries (
+                        key TEXT PRIMARY KEY,
+                        class TEXT NOT NULL,
+                        payload BLOB NOT NULL,
+                        size INTEGER NOT NULL,
+                        expires REAL NOT NULL,
+                        accessed REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS cache_entries_accessed
+                        ON cache_entries (accessed);
+                    CREATE TABLE IF NOT EXISTS cache_tables (
+                        table_name TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        PRIMARY KEY (table_name, key)
+                    );
+                    CREATE TABLE IF NOT EXISTS cache_invalidations (
+                        generation INTEGER PRIMARY KEY AUTOINCREMENT,
+                        table_name TEXT NOT NULL,
+                        created REAL NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS running_jobs (
+                        key TEXT PRIMARY KEY,
+                        job_id TEXT NOT NULL,
+                        location TEXT,
+                        pid INTEGER NOT NULL,
+                        started REAL NOT NULL
+                    );
+                """)
+            self._ready = True
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """(rows, seconds left, tables) for a key, or None."""
+        self._setup()
+        digest = self._digest(key)
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT payload, expires, accessed FROM cache_entries "
+                "WHERE key = ?", (digest,)).fetchone()
+            if row is None or row[1] <= now:
+                return None
+            tables = [table for table, in conn.execute(
+                "SELECT table_name FROM cache_tables WHERE key = ?",
+                (digest,))]
+            if row[2] < now - ACCESS_UPDATE_SECONDS:
+                conn.execute("UPDATE cache_entries SET accessed = ? "
+                             "WHERE key = ?", (now, digest))
+        return deserialize_rows(row[0]), row[1] - now, tables
+
+    def put(self, key, rows, ttl, tables, name="default"):
+        payload = serialize_rows(rows)
+        if len(payload) > self.budget * CACHE_MAX_ENTRY_SHARE:
+            return False
+        self._setup()
+        digest = self._digest(key)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM cache_tables WHERE key = ?", (digest,))
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries "
+                "(key, class, payload, size, expires, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, name, payload, len(payload), now + ttl, now))
+            conn.executemany(
+                "INSERT OR IGNORE INTO cache_tables (table_name, key) "
+                "VALUES (?, ?)", [(table, digest) for table in tables])
+            self._evict(conn, now)
+        return True
+
+    def _evict(self, conn, now):
+        total = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+        if total <= self.budget:
+            return
+        expired = conn.execute(
+            "SELECT key, size FROM cache_entries WHERE expires <= ?",
+            (now,)).fetchall()
+        victims = [key for key, _ in expired]
+        total -= sum(size for _, size in expired)
+        if total > self.budget:
+            for key, size in conn.execute(
+                    "SELECT key, size FROM cache_entries WHERE expires > ? "
+                    "ORDER BY accessed", (now,)):
+                victims.append(key)
+                total -= size
+                if total <= self.budget:
+                    break
+        self._delete(conn, victims)
+        logging.info(f"Shared query cache evicted {len(victims)} entries.")
+
+    @staticmethod
+    def _delete(conn, keys):
+        conn.executemany("DELETE FROM cache_entries WHERE key = ?",
+                         [(key,) for key in keys])
+        conn.executemany("DELETE FROM cache_tables WHERE key = ?",
+                         [(key,) for key in keys])
+
+    def invalidate(self, tables):
+        """Drop the entries of the given tables and log the invalidation."""
+        tables = sorted({table.lower() for table in tables})
+        if not tables:
+            return 0
+        self._setup()
+        now = time.time()
+        marks = ",".join("?" * len(tables))
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            keys = [row[0] for row in conn.execute(
+                f"SELECT DISTINCT key FROM cache_tables "
+                f"WHERE table_name IN ({marks})", tables)]
+            self._delete(conn, keys)
+            conn.executemany(
+                "INSERT INTO cache_invalidations (table_name, created) "
+                "VALUES (?, ?)", [(table, now) for table in tables])
+            conn.execute("DELETE FROM cache_invalidations WHERE created < ?",
+                         (now - INVALIDATION_LOG_SECONDS,))
+        return len(keys)
+
+    def invalidations_since(self, generation):
+        """(latest generation, tables invalidated after generation)."""
+        self._setup()
+        with self._connect() as conn:
+            if generation is None:
+                row = conn.execute(
+                    "SELECT COALESCE(MAX(generation), 0) "
+                    "FROM cache_invalidations").fetchone()
+                return row[0], set()
+            rows = conn.execute(
+                "SELECT generation, table_name FROM cache_invalidations "
+                "WHERE generation > ?", (generation,)).fetchall()
+        if not rows:
+            return generation, set()
+        return max(row[0] for row in rows), {row[1] for row in rows}
+
+    def claim_job(self, key, job_id, location):
+        """Record a running BigQuery job for a key so other workers join it."""
+        self._setup()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO running_jobs "
+                "(key, job_id, location, pid, started) VALUES (?, ?, ?, ?, ?)",
+                (self._digest(key), job_id, location, os.getpid(), time.time()))
+
+    def running_job(self, key):
+        """(job_id, location) of a recent job running for a key, or None."""
+        self._setup()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT job_id, location FROM running_jobs "
+                "WHERE key = ? AND started > ?",
+                (self._digest(key), time.time() - RUNNING_JOB_SECONDS)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def release_job(self, key, job_id):
+        self._setup()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM running_jobs WHERE key = ? AND job_id = ?",
+                         (self._digest(key), job_id))
+
+    def stats(self):
+        self._setup()
+        with self._connect() as conn:
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) "
+                "FROM cache_entries").fetchone()
+            running = conn.execute(
+                "SELECT COUNT(*) FROM running_jobs").fetchone()[0]
+        return {"entries": entries, "bytes": size, "budget": self.budget,
+                "running_jobs": running}
+
+
+class SingleFlight:
+    """Coalesces identical concurrent queries onto one BigQuery job.
+
+    The first caller of a key runs the query; callers in the same process
+    that arrive while it runs wait for it and get its rows. Workers in
+    other processes find the leader's job id in the shared cache file and
+    wait on that job instead of starting their own.
+    """
+
+    def __init__(self, shared=None):
+        self.shared = shared
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.counters = {"executed": 0, "merged": 0, "joined": 0,
+                         "failed": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _shared_call(self, method, *args):
+        if self.shared is None:
+            return None
+        try:
+            return getattr(self.shared, method)(*args)
+        except sqlite3.Error as e:
+            logging.error(f"Error tracking running query jobs: {e}")
+            return None
+
+    def _execute(self, client, key, query, job_config):
+        running = self._shared_call("running_job", key)
+        if running:
+            job_id, location = running
+            try:
+                job = client.get_job(job_id, location=location)
+                result = statement_rows(job)
+                self._count("joined")
+                return result
+            except Exception as e:
+                logging.warning(f"Could not join running job {job_id}, "
+                                f"running the query again: {e}")
+
+        job = client.query(query, job_config=job_config)
+        self._shared_call("claim_job", key, job.job_id, job.location)
+        try:
+            result = statement_rows(job)
+        finally:
+            self._shared_call("release_job", key, job.job_id)
+        self._count("executed")
+        return result
+
+    def run(self, client, key, query, job_config=None):
+        """(statement type, rows) of a query, shared with identical calls
+        already running; each caller gets its own list of rows."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event(), "result": None,
+                          "error": None, "waiters": 0}
+                self._flights[key] = flight
+            else:
+                flight["waiters"] += 1
+                self.counters["merged"] += 1
+
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            statement_type, rows = flight["result"]
+            return statement_type, list(rows)
+
+        try:
+            flight["result"] = self._execute(client, key, query, job_config)
+            statement_type, rows = flight["result"]
+            return statement_type, list(rows)
+        except Exception as e:
+            flight["error"] = e
+            self._count("failed")
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight["done"].set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._flights),
+                        waiting=sum(flight["waiters"]
+                                    for flight in self._flights.values()))
+
+
+query_cache = QueryCache()
+shared_cache = SharedQueryCache()
+single_flight = SingleFlight(shared_cache)
+
+# Last invalidation generation this process has applied
+_sync = {"generation": None, "checked": 0.0}
+_sync_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    # Flights and locks of the parent's threads do not exist in a child
+    def _reset_after_fork():
+        global _sync_lock
+        query_cache._lock = threading.Lock()
+        shared_cache._lock = threading.Lock()
+        single_flight._lock = threading.Lock()
+        single_flight._flights = {}
+        _sync_lock = threading.Lock()
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _follow_invalidations():
+    """Apply invalidations made by other workers to the memory layer."""
+    now = time.monotonic()
+    if now - _sync["checked"] < INVALIDATION_CHECK_SECONDS:
+        return
+    with _sync_lock:
+        if now - _sync["checked"] < INVALIDATION_CHECK_SECONDS:
+            return
+        _sync["checked"] = now
+        generation, tables = shared_cache.invalidations_since(
+            _sync["generation"])
+        _sync["generation"] = generation
+    if tables:
+        query_cache.invalidate(tables)
+
+
+def lookup(key):
+    """Cached rows from memory or the shared file, or None."""
+    try:
+        _follow_invalidations()
+    except sqlite3.Error as e:
+        logging.error(f"Error reading query cache invalidations: {e}")
+    rows = query_cache.get(key)
+    if rows is not None:
+        return rows
+    try:
+        shared = shared_cache.get(key)
+    except (sqlite3.Error, ValueError, KeyError, zlib.error) as e:
+        logging.error(f"Error reading shared query cache: {e}")
+        return None
+    if shared is None:
+        return None
+    rows, ttl, tables = shared
+    query_cache.put(key, rows, ttl, tables)
+    return rows
+
+
+def store(key, rows, ttl, tables, name="default"):
+    """Cache rows in both layers."""
+    query_cache.put(key, rows, ttl, tables, name)
+    try:
+        shared_cache.put(key, rows, ttl, tables, name)
+    except (sqlite3.Error, TypeError) as e:
+        logging.error(f"Error writing shared query cache: {e}")
+
+
+def invalidate(tables):
+    """Drop cached results of tables in this and every other worker."""
+    dropped = query_cache.invalidate(tables)
+    try:
+        dropped += shared_cache.invalidate(tables)
+    except sqlite3.Error as e:
+        logging.error(f"Error invalidating shared query cache: {e}")
+    if dropped:
+        logging.info(f"Query cache dropped {dropped} results of "
+                     f"{', '.join(sorted(tables))}.")
+    return dropped
+
+
+def stats():
+    """Counters of both cache layers and of query coalescing."""
+    try:
+        shared = shared_cache.stats()
+    except sqlite3.Error as e:
+        shared = {"error": str(e)}
+    return {"pid": os.getpid(), "memory": query_cache.stats(),
+            "shared": shared, "single_flight": single_flight.stats()}
@@ -0,0 +1,104 @@
+"""Server-side registry of BigQuery jobs started for a user.
+
+BigQuery keeps the job itself; the registry only records who started it,
+where its result table is and what a page of it needs (the SQL, or the
+period and parameters of a salary job). Entries live in a SQLite file
+shared by every worker, so concurrent requests from one user never
+overwrite each other's jobs, and they are dropped after
+QUERY_JOB_RETENTION_HOURS, once BigQuery has expired the results.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+QUERY_JOBS_PATH = os.path.join("sys", "query_jobs.sqlite")
+
+# Query result tables expire after about a day
+QUERY_JOB_RETENTION_HOURS = 48
+
+
+class QueryJobStore:
+    """Query jobs keyed by job id and owner in a SQLite file."""
+
+    def __init__(self, path=QUERY_JOBS_PATH):
+        self.path = path
+        self._ready = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _setup(self):
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS query_jobs (
+                        job_id TEXT PRIMARY KEY,
+                        owner TEXT NOT NULL,
+                        location TEXT,
+                        destination TEXT,
+                        finished INTEGER NOT NULL DEFAULT 0,
+                        details TEXT NOT NULL,
+                        created REAL NOT NULL
+                    )
+                """)
+            self._ready = True
+
+    @staticmethod
+    def _job(row):
+        return dict(json.loads(row["details"]), job_id=row["job_id"],
+                    location=row["location"], destination=row["destination"],
+                    finished=bool(row["finished"]))
+
+    def save(self, job, owner, **details):
+        """Record a job for its owner; returns it as get does."""
+        self._setup()
+        now = time.time()
+        destination = str(job.destination) if job.destination else None
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO query_jobs (job_id, owner, location, "
+                "destination, finished, details, created) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?)",
+                (job.job_id, owner, job.location, destination,
+                 json.dumps(details, default=str), now))
+            conn.execute("DELETE FROM query_jobs WHERE created < ?",
+                         (now - QUERY_JOB_RETENTION_HOURS * 3600,))
+        return dict(details, job_id=job.job_id, location=job.location,
+                    destination=destination, finished=False)
+
+    def get(self, job_id, owner):
+        """A job of this owner, or None."""
+        self._setup()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM query_jobs WHERE job_id = ? AND owner = ?",
+                (job_id, owner)).fetchone()
+        return self._job(row) if row else None
+
+    def finish(self, job_id, destination):
+        """Mark a job finished once; False if another request did first."""
+        self._setup()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE query_jobs SET finished = 1, destination = ? "
+                "WHERE job_id = ? AND finished = 0", (destination, job_id))
+        return cursor.rowcount == 1
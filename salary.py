@@ -0,0 +1,1597 @@
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+# Bonus tiers as (orders in tier, rate per order), paid in order above target
+FOOD_INHOUSE_OLD_BONUS_TIERS = [
+    (124, 5),
+    (100, 6),
+    (100, 7),
+    (100, 8),
+    (float('inf'), 9)
+]
+
+AJEER_BONUS_TIERS = [
+    (299, 6),
+    (100, 7),
+    (100, 8),
+    (float('inf'), 9)
+]
+
+# Revenue above target: 0.55 on the first 4000, 0.5 on the rest
+ECOMMERCE_BONUS_TIERS = [
+    (4000, 0.55),
+    (float('inf'), 0.5)
+]
+
+def get_period(category, month, year):
+    """Calculate start and end dates based on category."""
+    if category == "Ajeer":
+        if month == 12:
+            start_date = f"{year}-12-15"
+            end_date = f"{year + 1}-01-14"
+        else:
+            start_date = f"{year}-{month:02d}-15"
+            end_date = f"{year}-{(month % 12) + 1:02d}-14"
+    else:
+        if month == 1:
+            start_date = f"{year - 1}-12-25"
+            end_date = f"{year}-{month:02d}-24"
+        else:
+            start_date = f"{year}-{month - 1:02d}-25"
+            end_date = f"{year}-{month:02d}-24"
+    logging.debug(f"Period for category '{category}' from {start_date} "
+                  f"to {end_date}.")
+    return start_date, end_date
+
+# Categories covered by a category == "All" request; they share one period
+ALL_CATEGORIES = [
+    "Motorcycle", "Food Trial", "Food In-House New",
+    "Food In-House Old", "Ecommerce WH", "Ecommerce"
+]
+
+# Rows per BigQuery result page when payroll rows are read page by page
+PAYROLL_PAGE_SIZE = 5000
+
+# Target column and ultimate row filter for each category
+CATEGORY_QUERIES = {
+    "Motorcycle": {
+        "target": "t.motorcycle",
+        "condition": "u.PROJECT = 'Motorcycle'"
+    },
+    "Food Trial": {
+        "target": "t.Food_Trial",
+        "condition": ("u.PROJECT = 'Food' AND "
+                      "u.Sponsorshipstatus = 'Trial'")
+    },
+    "Food In-House New": {
+        "target": "t.Food_Inhouse",
+        "condition": ("u.PROJECT = 'Food' AND "
+                      "u.Sponsorshipstatus = 'Inhouse' AND "
+                      "u.joining_Date >= '2024-01-01'")
+    },
+    "Food In-House Old": {
+        "target": "t.Food_Inhouse",
+        "condition": ("u.PROJECT = 'Food' AND "
+                      "u.Sponsorshipstatus = 'Inhouse' AND "
+                      "u.joining_Date < '2024-01-01'")
+    },
+    "Ecommerce WH": {
+        "target": "t.Ecommerce_WH",
+        "condition": "u.PROJECT = 'Ecommerce WH'"
+    },
+    "Ecommerce": {
+        "target": "t.Ecommerce",
+        "condition": "u.PROJECT = 'Ecommerce'"
+    },
+    "Ajeer": {
+        "target": "t.Ajeer",
+        "condition": "u.Sponsorshipstatus = 'Ajeer'"
+    }
+}
+
+
+def parse_snapshot(value):
+    """Normalize a snapshot timestamp to an aware UTC datetime.
+
+    Accepts a datetime, an ISO 8601 string or "now". Naive values are
+    taken as UTC. Raises ValueError for unparsable or future timestamps.
+    """
+    if isinstance(value, datetime):
+        snapshot = value
+    elif value == "now":
+        snapshot = datetime.now(timezone.utc)
+    else:
+        snapshot = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if snapshot.tzinfo is None:
+        snapshot = snapshot.replace(tzinfo=timezone.utc)
+    snapshot = snapshot.astimezone(timezone.utc).replace(microsecond=0)
+    if snapshot > datetime.now(timezone.utc):
+        raise ValueError(f"Snapshot {snapshot.isoformat()} is in the future")
+    return snapshot
+
+
+def _snapshot_clause(snapshot):
+    """FOR SYSTEM_TIME AS OF clause pinning a table to a snapshot."""
+    if snapshot is None:
+        return ""
+    return (f" FOR SYSTEM_TIME AS OF TIMESTAMP "
+            f"'{snapshot:%Y-%m-%d %H:%M:%S}+00'")
+
+
+def _base_query(start_date, end_date):
+    return f"""
+    WITH CurrentPeriod AS (
+        SELECT DATE '{start_date}' AS StartPeriod,
+               DATE '{end_date}' AS EndPeriod
+    )
+    SELECT 
+        u.BARQ_ID,
+        u.iban,
+        u.id_number,
+        FORMAT_DATE('%Y-%m-%d', u.joining_Date) AS joining_Date,
+        u.Name,
+        u.Status,
+        u.Sponsorshipstatus,
+        u.PROJECT,
+        u.Supervisor,
+        SUM(u.total_Orders) AS Total_Orders,
+        SUM(u.Total_revenue) AS Total_Revenue,
+        SUM(u.Gas_Usage_without_vat) AS Gas_Usage"""
+
+
+def generate_query(category, start_date, end_date, snapshot=None):
+    """Build BigQuery SQL based on category.
+
+    With a snapshot (see parse_snapshot) the ultimate table is read as of
+    that time, so the result never changes.
+    """
+    if category not in CATEGORY_QUERIES:
+        logging.error(f"Invalid category provided: {category}")
+        raise ValueError(f"Invalid category: {category}")
+
+    query_parts = CATEGORY_QUERIES[category]
+
+    query = f"""
+    {_base_query(start_date, end_date)}
+    FROM master_saned.ultimate AS u{_snapshot_clause(snapshot)}
+    WHERE {query_parts['condition']}
+    AND u.Date BETWEEN DATE '{start_date}' AND DATE '{end_date}'
+    GROUP BY 
+        u.BARQ_ID,
+        u.iban,
+        u.id_number,
+        u.joining_Date,
+        u.Name,
+        u.Status,
+        u.Sponsorshipstatus,
+        u.PROJECT,
+        u.Supervisor
+    """
+    logging.debug(f"Generated BigQuery:\n{query}")
+    return query
+
+
+def generate_all_query(start_date, end_date, categories=None,
+                       snapshot=None):
+    """Build one BigQuery SQL covering several categories of one period.
+
+    Each row is assigned to its category with CASE logic, so the period
+    is scanned once instead of once per category.
+    """
+    categories = categories or ALL_CATEGORIES
+    for category in categories:
+        if category not in ALL_CATEGORIES:
+            logging.error(f"Invalid category for a combined query: "
+                          f"{category}")
+            raise ValueError(f"Invalid category: {category}")
+
+    category_cases = "\n".join(
+        f"            WHEN {CATEGORY_QUERIES[category]['condition']} "
+        f"THEN '{category}'"
+        for category in categories)
+    conditions = " OR ".join(
+        f"({CATEGORY_QUERIES[category]['condition']})"
+        for category in categories)
+
+    query = f"""
+    {_base_query(start_date, end_date)},
+        CASE
+{category_cases}
+        END AS category
+    FROM master_saned.ultimate AS u{_snapshot_clause(snapshot)}
+    WHERE ({conditions})
+    AND u.Date BETWEEN DATE '{start_date}' AND DATE '{end_date}'
+    GROUP BY 
+        u.BARQ_ID,
+        u.iban,
+        u.id_number,
+        u.joining_Date,
+        u.Name,
+        u.Status,
+        u.Sponsorshipstatus,
+        u.PROJECT,
+        u.Supervisor,
+        category
+    """
+    logging.debug(f"Generated combined BigQuery:\n{query}")
+    return query
+
+
+# Daily targets per category, one row per day of the month
+TARGETS_TABLE = "master_saned.targets"
+
+# Seconds between checks of the targets table's last-modified time
+TARGET_SCHEDULE_CHECK_SECONDS = 300
+
+
+class TargetSchedule:
+    """In-process copy of master_saned.targets keyed by day of month.
+
+    The table is only reloaded when its last-modified time changes, and
+    that is checked at most every check_seconds. A category's target for a
+    period is the value for the day of the period's end date, as the old
+    LEFT JOIN on EXTRACT(DAY FROM end_date) = t.Day did.
+    """
+
+    def __init__(self, check_seconds=TARGET_SCHEDULE_CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self.version = None
+        self.days = {}
+        self.checked_at = None
+        self.snapshots = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(client, snapshot=None):
+        rows = client.query(f"SELECT * FROM {TARGETS_TABLE}"
+                            f"{_snapshot_clause(snapshot)}").result()
+        return {
+            int(row['Day']): {key.lower(): value
+                              for key, value in dict(row).items()}
+            for row in rows
+        }
+
+    def refresh(self, client, force=False):
+        """Reload the schedule if the targets table changed."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self.checked_at is not None and \
+                    now - self.checked_at < self.check_seconds:
+                return self.version
+            try:
+                version = client.get_table(TARGETS_TABLE).modified.isoformat()
+                if force or version != self.version:
+                    self.days = self._load(client)
+                    self.version = version
+                    logging.info(f"Loaded target schedule {version} "
+                                 f"({len(self.days)} days).")
+            except Exception as e:
+                if not self.days:
+                    raise
+                logging.error(f"Error refreshing target schedule, keeping "
+                              f"version {self.version}: {e}")
+            self.checked_at = now
+            return self.version
+
+    def snapshot_days(self, client, snapshot):
+        """The schedule as of a snapshot; pinned copies never expire."""
+        key = snapshot.isoformat()
+        with self._lock:
+            if key not in self.snapshots:
+                self.snapshots[key] = self._load(client, snapshot)
+            return self.snapshots[key]
+
+    def target(self, client, category, end_date, snapshot=None):
+        """Target of a category for a period ending on end_date."""
+        if snapshot is None:
+            self.refresh(client)
+            days = self.days
+        else:
+            days = self.snapshot_days(client, snapshot)
+        column = CATEGORY_QUERIES[category]['target'].split('.', 1)[1]
+        day = datetime.strptime(end_date, '%Y-%m-%d').day
+        return days.get(day, {}).get(column.lower())
+
+    def targets(self, client, categories, end_date, snapshot=None):
+        return {category: self.target(client, category, end_date, snapshot)
+                for category in categories}
+
+
+# Shared by every salary path of the process
+target_schedule = TargetSchedule()
+
+
+def apply_targets(rows, target):
+    """Set each aggregate row's TARGET from the target schedule."""
+    for row in rows:
+        row['TARGET'] = target
+    return rows
+
+
+def iter_payroll_pages(client, categories, month, year, single_scan=True,
+                       page_size=PAYROLL_PAGE_SIZE, snapshot=None):
+    """Yield (category, start_date, end_date, rows) per BigQuery result page.
+
+    With single_scan, categories sharing a period are fetched with one
+    query and each page is split by category. A snapshot pins the source
+    tables to that time.
+    """
+    if single_scan and len(categories) > 1 and all(
+            category in ALL_CATEGORIES for category in categories):
+        start_date, end_date = get_period(categories[0], month, year)
+        targets = target_schedule.targets(client, categories, end_date,
+                                          snapshot)
+        query = generate_all_query(start_date, end_date, categories,
+                                   snapshot)
+        result = client.query(query).result(page_size=page_size)
+        for page in result.pages:
+            rows_by_category = {}
+            for row in page:
+                row = dict(row)
+                rows_by_category.setdefault(row['category'], []).append(row)
+            for category in categories:
+                if category in rows_by_category:
+                    yield (category, start_date, end_date, apply_targets(
+                        rows_by_category[category], targets[category]))
+        return
+
+    for category in categories:
+        start_date, end_date = get_period(category, month, year)
+        target = target_schedule.target(client, category, end_date, snapshot)
+        query = generate_query(category, start_date, end_date, snapshot)
+        result = client.query(query).result(page_size=page_size)
+        for page in result.pages:
+            yield category, start_date, end_date, apply_targets(
+                [dict(row) for row in page], target)
+
+
+def fetch_payroll_rows(client, categories, month, year, single_scan=True,
+                       snapshot=None):
+    """Run the payroll queries for the given categories.
+
+    Returns a list of (category, start_date, end_date, rows). With
+    single_scan, categories sharing a period are fetched with one query.
+    """
+    rows_by_category = {category: [] for category in categories}
+    for category, _, _, rows in iter_payroll_pages(
+            client, categories, month, year, single_scan=single_scan,
+            snapshot=snapshot):
+        rows_by_category[category].extend(rows)
+    return [(category,) + get_period(category, month, year)
+            + (rows_by_category[category],) for category in categories]
+
+
+def submit_payroll_query(client, categories, month, year, snapshot=None):
+    """Start the payroll query for one period without waiting for it.
+
+    Several categories are fetched with the combined query, so they must
+    share a period. Returns (job, start_date, end_date).
+    """
+    start_date, end_date = get_period(categories[0], month, year)
+    if len(categories) > 1:
+        query = generate_all_query(start_date, end_date, categories,
+                                   snapshot)
+    else:
+        query = generate_query(categories[0], start_date, end_date, snapshot)
+    return client.query(query), start_date, end_date
+
+
+def calculate_payroll_page(client, rows, categories, start_date, end_date,
+                           custom_params, snapshot=None):
+    """Salary records for one result page of submit_payroll_query."""
+    rows_by_category = {}
+    for row in rows:
+        row = dict(row)
+        category = row.pop('category', None) if len(categories) > 1 \
+            else categories[0]
+        rows_by_category.setdefault(category, []).append(row)
+    targets = target_schedule.targets(client, categories, end_date, snapshot)
+    today = snapshot.date() if snapshot else None
+    records = []
+    for category in categories:
+        if category in rows_by_category:
+            records.extend(calculate_salary_details_batch(
+                apply_targets(rows_by_category[category], targets[category]),
+                category, start_date, end_date,
+                custom_params.get(category, {}), today))
+    return records
+
+def calculate_salary_details(results, category, start_date, end_date,
+                             custom_params):
+    """Calculate salary components based on category and query results."""
+    processed = []
+
+    for result in results:
+        total_orders = result.get('Total_Orders', 0)
+        target = result.get('TARGET', 0)
+        gas_usage = result.get('Gas_Usage', 0)
+        joining_date = result.get('joining_Date')
+        total_revenue = result.get('Total_Revenue', 0)
+        status = result.get('Status', '')
+
+        # Calculate days since joining
+        try:
+            joining_date_obj = datetime.strptime(joining_date, '%Y-%m-%d')
+            days_since_joining = (datetime.now() - joining_date_obj).days + 1
+        except Exception as e:
+            logging.error(f"Error processing joining date '{joining_date}': "
+                          f"{e}")
+            continue  # Skip this record if date processing fails
+
+        # Initialize salary components
+        salary_components = {
+            "Basic_Salary": 0,
+            "Bonus_Amount": 0,
+            "Gas_Deserved": 0,
+            "Gas_Difference": 0,
+            "Total_Salary": 0
+        }
+
+        # Define calculation functions for each category
+        calculation_functions = {
+            "Motorcycle": calculate_motorcycle_salary,
+            "Food Trial": calculate_food_trial_salary,
+            "Food In-House New": calculate_food_inhouse_new_salary,
+            "Food In-House Old": calculate_food_inhouse_old_salary,
+            "Ecommerce WH": calculate_ecommerce_wh_salary,
+            "Ecommerce": calculate_ecommerce_salary,
+            "Ajeer": calculate_ajeer_salary
+        }
+
+        calc_func = calculation_functions.get(category)
+        if calc_func:
+            salary_components = calc_func(
+                total_orders, target, gas_usage, days_since_joining,
+                total_revenue, custom_params
+            )
+        else:
+            logging.warning(f"No calculation function defined for category: "
+                            f"{category}")
+            continue  # Skip if no calculation function is defined
+
+        # Update the result with calculated components
+        result.update(salary_components)
+
+        # Add period information
+        result.update({
+            "period": {
+                "start_date": start_date,
+                "end_date": end_date
+            },
+            "days_since_joining": days_since_joining,
+            "generated_date": datetime.now().strftime('%Y-%m-%d'),
+            "category": category
+        })
+
+        processed.append(result)
+
+    logging.info(f"Processed {len(processed)} salary records.")
+    return processed
+
+# Salary calculation functions for each category
+
+def calculate_motorcycle_salary(total_orders, target, gas_usage,
+                                days_since_joining, total_revenue, params):
+    final_target = min(math.ceil(target), days_since_joining * 13.333)
+    basic_salary_rate = params.get('motorcycle_basic_salary_rate', 53.33333)
+    bonus_rate = params.get('motorcycle_bonus_rate', 6)
+    penalty_rate = params.get('motorcycle_penalty_rate', 10)
+    gas_rate = params.get('motorcycle_gas_rate', 0.65)
+    gas_cap = params.get('motorcycle_gas_cap', 261)  # Gas cap for Motorcycle
+
+    basic_salary = (final_target / 13.333) * basic_salary_rate
+    bonus_orders = total_orders - final_target
+    if bonus_orders > 0:
+        bonus_amount = bonus_orders * bonus_rate
+    else:
+        bonus_amount = bonus_orders * penalty_rate
+
+    gas_deserved = min(total_orders * gas_rate, gas_cap)
+    gas_difference = gas_deserved - gas_usage
+    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+
+    return {
+        "Basic_Salary": round(basic_salary, 2),
+        "Bonus_Amount": round(bonus_amount, 2),
+        "Gas_Deserved": round(gas_deserved, 2),
+        "Gas_Difference": round(gas_difference, 2),
+        "Total_Salary": round(total_salary, 2),
+        "target": final_target
+    }
+
+def calculate_food_trial_salary(total_orders, target, gas_usage,
+                                days_since_joining, total_revenue, params):
+    target_v2 = days_since_joining * 13
+    final_target = min(target, target_v2)
+    basic_salary_rate = params.get('food_trial_basic_salary_rate',
+                                   66.66666667)
+    bonus_rate = params.get('food_trial_bonus_rate', 7)
+    penalty_rate = params.get('food_trial_penalty_rate', 10)
+    gas_rate = params.get('food_trial_gas_rate', 2.11)
+    gas_cap = params.get('food_trial_gas_cap', 826)  # Gas cap for Food
+
+    basic_salary = (final_target / 13) * basic_salary_rate
+
+    bonus_orders = total_orders - final_target
+    if bonus_orders > 0:
+        bonus_amount = bonus_orders * bonus_rate
+    else:
+        bonus_amount = bonus_orders * penalty_rate
+
+    gas_deserved = min(gas_rate * total_orders, gas_cap)
+    gas_difference = gas_deserved - gas_usage
+
+    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+
+    return {
+        "Basic_Salary": round(basic_salary, 2),
+        "Bonus_Amount": round(bonus_amount, 2),
+        "Gas_Deserved": round(gas_deserved, 2),
+        "Gas_Difference": round(gas_difference, 2),
+        "Total_Salary": round(total_salary, 2),
+        "target": final_target
+    }
+
+def calculate_food_inhouse_new_salary(total_orders, target, gas_usage,
+                                      days_since_joining, total_revenue,
+                                      params):
+    target_v2 = days_since_joining * 15.8333333
+    final_target = min(target, target_v2)
+    basic_salary_rate = params.get('food_inhouse_new_basic_salary_rate',
+                                   66.66666667)
+    bonus_rate = params.get('food_inhouse_new_bonus_rate', 7)
+    penalty_rate = params.get('food_inhouse_new_penalty_rate', 10)
+    gas_rate = params.get('food_inhouse_new_gas_rate', 1.739)
+    gas_cap = params.get('food_inhouse_new_gas_cap', 826)  # Gas cap for Food
+
+    basic_salary = (final_target / 15.83333333) * basic_salary_rate
+
+    bonus_orders = total_orders - final_target
+    if bonus_orders > 0:
+        bonus_amount = bonus_orders * bonus_rate
+    else:
+        bonus_amount = bonus_orders * penalty_rate
+
+    gas_deserved = min(gas_rate * total_orders, gas_cap)
+    gas_difference = gas_deserved - gas_usage
+
+    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+
+    return {
+        "Basic_Salary": round(basic_salary, 2),
+        "Bonus_Amount": round(bonus_amount, 2),
+        "Gas_Deserved": round(gas_deserved, 2),
+        "Gas_Difference": round(gas_difference, 2),
+        "Total_Salary": round(total_salary, 2),
+        "target": final_target
+    }
+
+def calculate_food_inhouse_old_salary(total_orders, target, gas_usage,
+                                      days_since_joining, total_revenue,
+                                      params):
+    target_v2 = days_since_joining * 15.8333333
+    final_target = min(target, target_v2)
+    basic_salary_rate = params.get('food_inhouse_old_basic_salary_rate',
+                                   66.66666667)
+    penalty_rate = params.get('food_inhouse_old_penalty_rate', 10)
+    gas_rate = params.get('food_inhouse_old_gas_rate', 2.065)
+    gas_cap = params.get('food_inhouse_old_gas_cap', 826)  # Gas cap for Food
+
+    basic_salary = (final_target / 15.83333333) * basic_salary_rate
+
+    bonus_orders = total_orders - final_target
+    bonus_amount = 0
+    if bonus_orders <= 0:
+        bonus_amount = bonus_orders * penalty_rate
+    else:
+        tiers = FOOD_INHOUSE_OLD_BONUS_TIERS
+        remaining_orders = bonus_orders
+        for tier_limit, rate in tiers:
+            orders_in_tier = min(remaining_orders, tier_limit)
+            bonus_amount += orders_in_tier * rate
+            remaining_orders -= orders_in_tier
+            if remaining_orders <= 0:
+                break
+
+    gas_deserved = min(gas_rate * total_orders, gas_cap)
+    gas_difference = gas_deserved - gas_usage
+
+    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+
+    return {
+        "Basic_Salary": round(basic_salary, 2),
+        "Bonus_Amount": round(bonus_amount, 2),
+        "Gas_Deserved": round(gas_deserved, 2),
+        "Gas_Difference": round(gas_difference, 2),
+        "Total_Salary": round(total_salary, 2),
+        "target": final_target
+    }
+
+def calculate_ecommerce_wh_salary(total_orders, target, gas_usage,
+                                  days_since_joining, total_revenue, params):
+    target2 = days_since_joining * 16.66667
+    final_target = min(target, target2)
+    basic_salary_rate = params.get('ecommerce_wh_basic_salary_rate',
+                                   66.666667)
+    bonus_rate = params.get('ecommerce_wh_bonus_rate', 8)
+    penalty_rate = params.get('ecommerce_wh_penalty_rate', 10)
+    gas_rate = params.get('ecommerce_wh_gas_rate', 15.03)
+    gas_cap = params.get('ecommerce_wh_gas_cap', 452)  # Gas cap for Ecommerce
+
+    basic_salary = (final_target / 16.6666667) * basic_salary_rate
+
+    bonus_orders = total_orders - final_target
+    if bonus_orders > 0:
+        bonus_amount = bonus_orders * bonus_rate
+    else:
+        bonus_amount = bonus_orders * penalty_rate
+
+    diesel_deserved = min((final_target / 16.666667) * gas_rate, gas_cap)
+    gas_difference = diesel_deserved - gas_usage
+
+    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+
+    return {
+        "Basic_Salary": round(basic_salary, 2),
+        "Bonus_Amount": round(bonus_amount, 2),
+        "Gas_Deserved": round(diesel_deserved, 2),
+        "Gas_Difference": round(gas_difference, 2),
+        "Total_Salary": round(total_salary, 2),
+        "target": final_target
+    }
+
+def calculate_ecommerce_salary(total_orders, target, gas_usage,
+                               days_since_joining, total_revenue, params):
+    target2 = days_since_joining * 221
+    final_target = min(target, target2)
+    revenue_coefficient = params.get('ecommerce_revenue_coefficient',
+                                     0.3016591252)
+    basic_salary_rate = params.get('ecommerce_basic_salary_rate',
+                                   66.66666667)
+    gas_cap = params.get('ecommerce_gas_cap', 452)  # Gas cap for Ecommerce
+
+    revenue_based_salary = total_revenue * revenue_coefficient
+    target_based_salary = (final_target / 221) * basic_salary_rate
+    basic_salary = min(revenue_based_salary, target_based_salary)
+
+    bonus_revenue = max(0, total_revenue - final_target)
+    if bonus_revenue <= 4000:
+        bonus_amount = bonus_revenue * 0.55
+    else:
+        bonus_amount = (4000 * 0.55) + ((bonus_revenue - 4000) * 0.5)
+
+    diesel_deserved = min(0.068 * total_revenue,
+                          (final_target / 221) * 15.06, gas_cap)
+    gas_difference = diesel_deserved - gas_usage
+
+    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+
+    return {
+        "Basic_Salary": round(basic_salary, 2),
+        "Bonus_Amount": round(bonus_amount, 2),
+        "Gas_Deserved": round(diesel_deserved, 2),
+        "Gas_Difference": round(gas_difference, 2),
+        "Total_Salary": round(total_salary, 2),
+        "target": final_target
+    }
+
+def calculate_ajeer_salary(total_orders, target, gas_usage,
+                           days_since_joining, total_revenue, params):
+    basic_salary_rate = params.get('ajeer_basic_salary_rate', 53.33333)
+    penalty_rate = params.get('ajeer_penalty_rate', 10)
+    gas_rate = params.get('ajeer_gas_rate', 2.065)
+    gas_cap = params.get('ajeer_gas_cap', 826)  # Assuming same as Food
+
+    basic_salary = (target / 13.333333333333334) * basic_salary_rate
+
+    bonus_orders = total_orders - target
+    bonus_amount = 0
+    if bonus_orders <= 0:
+        bonus_amount = bonus_orders * penalty_rate
+    else:
+        tiers = AJEER_BONUS_TIERS
+        remaining_orders = bonus_orders
+        for tier_limit, rate in tiers:
+            orders_in_tier = min(remaining_orders, tier_limit)
+            bonus_amount += orders_in_tier * rate
+            remaining_orders -= orders_in_tier
+            if remaining_orders <= 0:
+                break
+
+    gas_deserved = min(gas_rate * total_orders, gas_cap)
+    gas_difference = gas_deserved - gas_usage
+
+    total_salary = max(0, basic_salary + bonus_amount + gas_difference)
+
+    return {
+        "Basic_Salary": round(basic_salary, 2),
+        "Bonus_Amount": round(bonus_amount, 2),
+        "Gas_Deserved": round(gas_deserved, 2),
+        "Gas_Difference": round(gas_difference, 2),
+        "Total_Salary": round(total_salary, 2),
+        "target": target
+    }
+
+
+# Batch (columnar) salary engine. Mirrors the scalar functions above over
+# whole columns; the scalar functions stay the reference implementation.
+
+SALARY_COMPONENTS = [
+    "Basic_Salary", "Bonus_Amount", "Gas_Deserved", "Gas_Difference",
+    "Total_Salary"
+]
+
+# Query columns the salary formulas read
+SALARY_INPUT_COLUMNS = [
+    "joining_Date", "Total_Orders", "TARGET", "Gas_Usage", "Total_Revenue"
+]
+
+SALARY_PARAM_DEFAULTS = {
+    "Motorcycle": {
+        "motorcycle_basic_salary_rate": 53.33333,
+        "motorcycle_bonus_rate": 6,
+        "motorcycle_penalty_rate": 10,
+        "motorcycle_gas_rate": 0.65,
+        "motorcycle_gas_cap": 261
+    },
+    "Food Trial": {
+        "food_trial_basic_salary_rate": 66.66666667,
+        "food_trial_bonus_rate": 7,
+        "food_trial_penalty_rate": 10,
+        "food_trial_gas_rate": 2.11,
+        "food_trial_gas_cap": 826
+    },
+    "Food In-House New": {
+        "food_inhouse_new_basic_salary_rate": 66.66666667,
+        "food_inhouse_new_bonus_rate": 7,
+        "food_inhouse_new_penalty_rate": 10,
+        "food_inhouse_new_gas_rate": 1.739,
+        "food_inhouse_new_gas_cap": 826
+    },
+    "Food In-House Old": {
+        "food_inhouse_old_basic_salary_rate": 66.66666667,
+        "food_inhouse_old_penalty_rate": 10,
+        "food_inhouse_old_gas_rate": 2.065,
+        "food_inhouse_old_gas_cap": 826
+    },
+    "Ecommerce WH": {
+        "ecommerce_wh_basic_salary_rate": 66.666667,
+        "ecommerce_wh_bonus_rate": 8,
+        "ecommerce_wh_penalty_rate": 10,
+        "ecommerce_wh_gas_rate": 15.03,
+        "ecommerce_wh_gas_cap": 452
+    },
+    "Ecommerce": {
+        "ecommerce_revenue_coefficient": 0.3016591252,
+        "ecommerce_basic_salary_rate": 66.66666667,
+        "ecommerce_gas_cap": 452
+    },
+    "Ajeer": {
+        "ajeer_basic_salary_rate": 53.33333,
+        "ajeer_penalty_rate": 10,
+        "ajeer_gas_rate": 2.065,
+        "ajeer_gas_cap": 826
+    }
+}
+
+
+def resolve_salary_params(category, custom_params):
+    """Merge customParams over the default rates for a category."""
+    params = dict(SALARY_PARAM_DEFAULTS.get(category, {}))
+    for key, value in (custom_params or {}).items():
+        params[key] = float(value)
+    return params
+
+
+def tiered_bonus(excess, tiers):
+    """Pay excess per tier using cumulative tier breakpoints."""
+    limits = np.array([limit for limit, _ in tiers], dtype=float)
+    rates = np.array([rate for _, rate in tiers], dtype=float)
+    floors = np.concatenate(([0.0], np.cumsum(limits)[:-1]))
+    in_tier = np.clip(excess[:, np.newaxis] - floors, 0, limits)
+    return (in_tier * rates).sum(axis=1)
+
+
+def round_cents(values):
+    """Round like the builtin round(x, 2), including half-cent ties."""
+    rounded = np.round(values, 2)
+    scaled = values * 100
+    ties = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if ties.any():
+        rounded[ties] = [round(float(value), 2) for value in values[ties]]
+    return rounded
+
+
+def _order_bonus(bonus_orders, bonus_rate, penalty_rate):
+    return np.where(bonus_orders > 0, bonus_orders * bonus_rate,
+                    bonus_orders * penalty_rate)
+
+
+def _salary_columns(basic_salary, bonus_amount, gas_deserved, gas_usage,
+                    final_target):
+    gas_difference = gas_deserved - gas_usage
+    total_salary = np.maximum(0, basic_salary + bonus_amount + gas_difference)
+    return {
+        "Basic_Salary": basic_salary,
+        "Bonus_Amount": bonus_amount,
+        "Gas_Deserved": gas_deserved,
+        "Gas_Difference": gas_difference,
+        "Total_Salary": total_salary,
+        "target": final_target
+    }
+
+
+def batch_motorcycle_salary(total_orders, target, gas_usage,
+                            days_since_joining, total_revenue, params):
+    final_target = np.minimum(np.ceil(target), days_since_joining * 13.333)
+    basic_salary = ((final_target / 13.333)
+                    * params['motorcycle_basic_salary_rate'])
+    bonus_amount = _order_bonus(total_orders - final_target,
+                                params['motorcycle_bonus_rate'],
+                                params['motorcycle_penalty_rate'])
+    gas_deserved = np.minimum(total_orders * params['motorcycle_gas_rate'],
+                              params['motorcycle_gas_cap'])
+    return _salary_columns(basic_salary, bonus_amount, gas_deserved,
+                           gas_usage, final_target)
+
+
+def batch_food_trial_salary(total_orders, target, gas_usage,
+                            days_since_joining, total_revenue, params):
+    final_target = np.minimum(target, days_since_joining * 13)
+    basic_salary = (final_target / 13) * params['food_trial_basic_salary_rate']
+    bonus_amount = _order_bonus(total_orders - final_target,
+                                params['food_trial_bonus_rate'],
+                                params['food_trial_penalty_rate'])
+    gas_deserved = np.minimum(params['food_trial_gas_rate'] * total_orders,
+                              params['food_trial_gas_cap'])
+    return _salary_columns(basic_salary, bonus_amount, gas_deserved,
+                           gas_usage, final_target)
+
+
+def batch_food_inhouse_new_salary(total_orders, target, gas_usage,
+                                  days_since_joining, total_revenue, params):
+    final_target = np.minimum(target, days_since_joining * 15.8333333)
+    basic_salary = ((final_target / 15.83333333)
+                    * params['food_inhouse_new_basic_salary_rate'])
+    bonus_amount = _order_bonus(total_orders - final_target,
+                                params['food_inhouse_new_bonus_rate'],
+                                params['food_inhouse_new_penalty_rate'])
+    gas_deserved = np.minimum(
+        params['food_inhouse_new_gas_rate'] * total_orders,
+        params['food_inhouse_new_gas_cap'])
+    return _salary_columns(basic_salary, bonus_amount, gas_deserved,
+                           gas_usage, final_target)
+
+
+def batch_food_inhouse_old_salary(total_orders, target, gas_usage,
+                                  days_since_joining, total_revenue, params):
+    final_target = np.minimum(target, days_since_joining * 15.8333333)
+    basic_salary = ((final_target / 15.83333333)
+                    * params['food_inhouse_old_basic_salary_rate'])
+    bonus_orders = total_orders - final_target
+    bonus_amount = np.where(
+        bonus_orders <= 0,
+        bonus_orders * params['food_inhouse_old_penalty_rate'],
+        tiered_bonus(bonus_orders, FOOD_INHOUSE_OLD_BONUS_TIERS))
+    gas_deserved = np.minimum(
+        params['food_inhouse_old_gas_rate'] * total_orders,
+        params['food_inhouse_old_gas_cap'])
+    return _salary_columns(basic_salary, bonus_amount, gas_deserved,
+                           gas_usage, final_target)
+
+
+def batch_ecommerce_wh_salary(total_orders, target, gas_usage,
+                              days_since_joining, total_revenue, params):
+    final_target = np.minimum(target, days_since_joining * 16.66667)
+    basic_salary = ((final_target / 16.6666667)
+                    * params['ecommerce_wh_basic_salary_rate'])
+    bonus_amount = _order_bonus(total_orders - final_target,
+                                params['ecommerce_wh_bonus_rate'],
+                                params['ecommerce_wh_penalty_rate'])
+    diesel_deserved = np.minimum(
+        (final_target / 16.666667) * params['ecommerce_wh_gas_rate'],
+        params['ecommerce_wh_gas_cap'])
+    return _salary_columns(basic_salary, bonus_amount, diesel_deserved,
+                           gas_usage, final_target)
+
+
+def batch_ecommerce_salary(total_orders, target, gas_usage,
+                           days_since_joining, total_revenue, params):
+    final_target = np.minimum(target, days_since_joining * 221)
+    revenue_based_salary = (total_revenue
+                            * params['ecommerce_revenue_coefficient'])
+    target_based_salary = ((final_target / 221)
+                           * params['ecommerce_basic_salary_rate'])
+    basic_salary = np.minimum(revenue_based_salary, target_based_salary)
+    bonus_revenue = np.maximum(0, total_revenue - final_target)
+    bonus_amount = tiered_bonus(bonus_revenue, ECOMMERCE_BONUS_TIERS)
+    diesel_deserved = np.minimum(
+        np.minimum(0.068 * total_revenue, (final_target / 221) * 15.06),
+        params['ecommerce_gas_cap'])
+    return _salary_columns(basic_salary, bonus_amount, diesel_deserved,
+                           gas_usage, final_target)
+
+
+def batch_ajeer_salary(total_orders, target, gas_usage,
+                       days_since_joining, total_revenue, params):
+    basic_salary = ((target / 13.333333333333334)
+                    * params['ajeer_basic_salary_rate'])
+    bonus_orders = total_orders - target
+    bonus_amount = np.where(
+        bonus_orders <= 0,
+        bonus_orders * params['ajeer_penalty_rate'],
+        tiered_bonus(bonus_orders, AJEER_BONUS_TIERS))
+    gas_deserved = np.minimum(params['ajeer_gas_rate'] * total_orders,
+                              params['ajeer_gas_cap'])
+    return _salary_columns(basic_salary, bonus_amount, gas_deserved,
+                           gas_usage, target)
+
+
+BATCH_CALCULATION_FUNCTIONS = {
+    "Motorcycle": batch_motorcycle_salary,
+    "Food Trial": batch_food_trial_salary,
+    "Food In-House New": batch_food_inhouse_new_salary,
+    "Food In-House Old": batch_food_inhouse_old_salary,
+    "Ecommerce WH": batch_ecommerce_wh_salary,
+    "Ecommerce": batch_ecommerce_salary,
+    "Ajeer": batch_ajeer_salary
+}
+
+
+def _numeric_column(frame, column):
+    if column not in frame:
+        return np.zeros(len(frame))
+    values = pd.to_numeric(frame[column], errors='coerce')
+    return values.fillna(0).to_numpy(dtype=float)
+
+
+def salary_input_arrays(frame, today=None):
+    """Numeric input columns of a results DataFrame for the batch formulas.
+
+    Returns (valid, inputs): a mask of rows with a parseable joining date
+    and a dict of float arrays for those rows, days_since_joining included.
+    """
+    today = pd.Timestamp(today or datetime.now().date())
+    if 'joining_Date' in frame:
+        joining_dates = pd.to_datetime(frame['joining_Date'],
+                                       format='%Y-%m-%d', errors='coerce')
+    else:
+        joining_dates = pd.Series(pd.NaT, index=frame.index)
+    valid = joining_dates.notna().to_numpy()
+    if not valid.all():
+        logging.error(f"Error processing joining date for "
+                      f"{int((~valid).sum())} records; skipping them.")
+
+    days_since_joining = (today - joining_dates[valid]).dt.days + 1
+    inputs = {
+        column: _numeric_column(frame, column)[valid]
+        for column in SALARY_INPUT_COLUMNS if column != 'joining_Date'
+    }
+    inputs['days_since_joining'] = days_since_joining.to_numpy(dtype=float)
+    return valid, inputs
+
+
+def calculate_salary_columns(inputs, category, custom_params):
+    """Salary components (rounded to cents) and target for input arrays."""
+    columns = BATCH_CALCULATION_FUNCTIONS[category](
+        inputs['Total_Orders'],
+        inputs['TARGET'],
+        inputs['Gas_Usage'],
+        inputs['days_since_joining'],
+        inputs['Total_Revenue'],
+        resolve_salary_params(category, custom_params)
+    )
+    for component in SALARY_COMPONENTS:
+        columns[component] = round_cents(columns[component])
+    return columns
+
+
+def calculate_salary_frame(frame, category, custom_params, today=None):
+    """Calculate salary components for a DataFrame of query results.
+
+    Returns a copy of the rows with a valid joining date, with
+    days_since_joining, the salary components and target added.
+    """
+    if category not in BATCH_CALCULATION_FUNCTIONS:
+        logging.warning(f"No calculation function defined for category: "
+                        f"{category}")
+        return frame.iloc[0:0].copy()
+
+    valid, inputs = salary_input_arrays(frame, today)
+    columns = calculate_salary_columns(inputs, category, custom_params)
+
+    frame = frame[valid].copy()
+    for component in SALARY_COMPONENTS:
+        frame[component] = columns[component]
+    frame['target'] = columns['target']
+    frame['days_since_joining'] = inputs['days_since_joining'].astype(int)
+    return frame
+
+
+def calculate_salary_details_batch(results, category, start_date, end_date,
+                                   custom_params, today=None):
+    """Batch version of calculate_salary_details with the same output.
+
+    today fixes the date days_since_joining is counted to, e.g. the date
+    of a pinned snapshot.
+    """
+    if not results:
+        return []
+
+    frame = pd.DataFrame({
+        column: [result.get(column) for result in results]
+        for column in SALARY_INPUT_COLUMNS
+    })
+    calculated = calculate_salary_frame(frame, category, custom_params, today)
+    generated_date = datetime.now().strftime('%Y-%m-%d')
+
+    names = SALARY_COMPONENTS + ['target']
+    rows = zip(calculated.index.tolist(),
+               zip(*(calculated[name].tolist() for name in names)),
+               calculated['days_since_joining'].tolist())
+    processed = []
+    for index, values, days_since_joining in rows:
+        result = results[index]
+        result.update(zip(names, values))
+        result.update({
+            "period": {
+                "start_date": start_date,
+                "end_date": end_date
+            },
+            "days_since_joining": days_since_joining,
+            "generated_date": generated_date,
+            "category": category
+        })
+        processed.append(result)
+
+    logging.info(f"Processed {len(processed)} salary records.")
+    return processed
+
+
+def _records_frame(records, columns):
+    return pd.DataFrame({
+        column: [record.get(column) for record in records]
+        for column in columns
+    })
+
+
+def evaluate_scenarios(payroll, scenarios, today=None):
+    """Evaluate parameter scenarios against already calculated payroll.
+
+    payroll is a list of (category, records) from one baseline run and
+    scenarios a list of {"name", "customParams"} dicts. Every scenario is
+    recalculated in memory from the records' input columns; totals and
+    per-courier component deltas are reported against the baseline.
+    """
+    datasets = []
+    for category, records in payroll:
+        if not records or category not in BATCH_CALCULATION_FUNCTIONS:
+            continue
+        frame = _records_frame(
+            records, ['BARQ_ID', 'Name'] + SALARY_INPUT_COLUMNS
+            + SALARY_COMPONENTS)
+        valid, inputs = salary_input_arrays(frame, today)
+        frame = frame[valid]
+        datasets.append({
+            "category": category,
+            "inputs": inputs,
+            "BARQ_ID": frame['BARQ_ID'].tolist(),
+            "Name": frame['Name'].tolist(),
+            "baseline": {component: _numeric_column(frame, component)
+                         for component in SALARY_COMPONENTS}
+        })
+
+    baseline_totals = {
+        component: round(float(sum(dataset["baseline"][component].sum()
+                                   for dataset in datasets)), 2)
+        for component in SALARY_COMPONENTS
+    }
+
+    results = []
+    for index, scenario in enumerate(scenarios):
+        name = scenario.get('name') or f"Scenario {index + 1}"
+        custom_params = scenario.get('customParams', {})
+        sums = dict.fromkeys(SALARY_COMPONENTS, 0.0)
+        couriers = []
+        for dataset in datasets:
+            category = dataset["category"]
+            columns = calculate_salary_columns(
+                dataset["inputs"], category, custom_params.get(category, {}))
+            deltas = {}
+            for component in SALARY_COMPONENTS:
+                sums[component] += float(columns[component].sum())
+                deltas[component] = np.round(
+                    columns[component] - dataset["baseline"][component], 2)
+
+            changed = np.flatnonzero(np.any(
+                [delta != 0 for delta in deltas.values()], axis=0))
+            if not len(changed):
+                continue
+            courier_columns = {
+                'BARQ_ID': [dataset['BARQ_ID'][i] for i in changed],
+                'Name': [dataset['Name'][i] for i in changed],
+                'category': [category] * len(changed),
+                'Total_Salary': columns['Total_Salary'][changed].tolist()
+            }
+            for component, delta in deltas.items():
+                courier_columns[f"{component}_delta"] = delta[changed].tolist()
+            couriers.extend(dict(zip(courier_columns, values))
+                            for values in zip(*courier_columns.values()))
+
+        scenario_totals = {component: round(total, 2)
+                           for component, total in sums.items()}
+        results.append({
+            "name": name,
+            "customParams": custom_params,
+            "totals": scenario_totals,
+            "delta": {component: round(scenario_totals[component]
+                                       - baseline_totals[component], 2)
+                      for component in SALARY_COMPONENTS},
+            "changed_count": len(couriers),
+            "couriers": couriers
+        })
+
+    return {
+        "baseline": {
+            "totals": baseline_totals,
+            "count": sum(len(dataset["BARQ_ID"]) for dataset in datasets)
+        },
+        "scenarios": results
+    }
+
+
+# Columns summarize_payroll reads from calculated salary records
+SUMMARY_COLUMNS = ['BARQ_ID', 'Name', 'category', 'Total_Orders'] + \
+    SALARY_COMPONENTS
+
+SUMMARY_PERCENTILES = [10, 25, 50, 75, 90, 95, 99]
+
+
+def _histogram(values, bins):
+    if not len(values):
+        return {"edges": [], "counts": []}
+    counts, edges = np.histogram(values, bins=bins)
+    return {"edges": np.round(edges, 2).tolist(), "counts": counts.tolist()}
+
+
+def summarize_payroll(frame, bins=20, top=10):
+    """Dashboard aggregates of calculated salary records.
+
+    frame holds SUMMARY_COLUMNS, one row per courier. Returns overall and
+    per-category totals, Total_Salary / Bonus_Amount histograms and
+    percentiles, and the top and bottom earners.
+    """
+    frame = frame.copy()
+    numeric = ['Total_Orders'] + SALARY_COMPONENTS
+    for column in numeric:
+        frame[column] = _numeric_column(frame, column)
+
+    def totals(group):
+        sums = group[numeric].sum()
+        return {
+            "count": int(len(group)),
+            **{column: round(float(sums[column]), 2) for column in numeric},
+            "average_salary": round(float(group['Total_Salary'].mean()), 2)
+            if len(group) else 0.0
+        }
+
+    distributions = {}
+    for column in ['Total_Salary', 'Bonus_Amount']:
+        values = frame[column].to_numpy()
+        distributions[column] = {
+            "histogram": _histogram(values, bins),
+            "percentiles": dict(zip(
+                (f"p{p}" for p in SUMMARY_PERCENTILES),
+                np.round(np.percentile(values, SUMMARY_PERCENTILES), 2)
+                .tolist())) if len(values) else {}
+        }
+
+    earners = frame.sort_values('Total_Salary', ascending=False,
+                                kind='stable')[
+        ['BARQ_ID', 'Name', 'category', 'Total_Orders', 'Bonus_Amount',
+         'Total_Salary']]
+    return {
+        "totals": totals(frame),
+        "by_category": {category: totals(group) for category, group
+                        in frame.groupby('category', sort=True)},
+        "distributions": distributions,
+        "top_earners": earners.head(top).to_dict('records'),
+        "bottom_earners": earners.tail(top).iloc[::-1].to_dict('records')
+    }
+
+
+# Input and salary columns compared by diff_payroll
+DIFF_VALUE_COLUMNS = ['Total_Orders', 'Total_Revenue', 'Gas_Usage',
+                      'target'] + SALARY_COMPONENTS
+
+DIFF_COLUMNS = ['BARQ_ID', 'Name', 'category'] + DIFF_VALUE_COLUMNS
+
+
+def _frame_records(frame, columns):
+    """Rows of frame as dicts with NaN as None; faster than to_dict."""
+    values = [frame[column].astype(object).where(frame[column].notna(),
+                                                 None).tolist()
+              for column in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def diff_payroll(base, compare, top=20, include_unchanged=False):
+    """Per-courier deltas between two sets of calculated salary records.
+
+    base and compare are frames with DIFF_COLUMNS, e.g. two periods or two
+    customParams sets. They are outer-joined on BARQ_ID; couriers only in
+    compare are "added", only in base "removed". Deltas are compare - base
+    with a missing side counted as zero.
+    """
+    sides = []
+    for frame in (base, compare):
+        frame = frame[DIFF_COLUMNS].drop_duplicates('BARQ_ID', keep='last')
+        frame = frame.copy()
+        for column in DIFF_VALUE_COLUMNS:
+            frame[column] = _numeric_column(frame, column)
+        sides.append(frame)
+
+    joined = sides[0].merge(sides[1], on='BARQ_ID', how='outer',
+                            suffixes=('_base', '_compare'), indicator=True)
+    in_base = (joined['_merge'] != 'right_only').to_numpy()
+    in_compare = (joined['_merge'] != 'left_only').to_numpy()
+
+    for column in DIFF_VALUE_COLUMNS:
+        joined[f"{column}_delta"] = np.round(
+            joined[f"{column}_compare"].fillna(0).to_numpy()
+            - joined[f"{column}_base"].fillna(0).to_numpy(), 2)
+
+    salary_changed = np.any([joined[f"{component}_delta"].to_numpy() != 0
+                             for component in SALARY_COMPONENTS], axis=0)
+    joined['status'] = np.select(
+        [~in_base, ~in_compare, salary_changed],
+        ['added', 'removed', 'changed'], default='unchanged')
+    joined['Name'] = joined['Name_compare'].fillna(joined['Name_base'])
+    joined['category'] = joined['category_compare'].fillna(
+        joined['category_base'])
+
+    totals = {}
+    for component in SALARY_COMPONENTS:
+        base_total = round(float(joined[f"{component}_base"].sum()), 2)
+        compare_total = round(float(joined[f"{component}_compare"].sum()), 2)
+        totals[component] = {"base": base_total, "compare": compare_total,
+                             "delta": round(compare_total - base_total, 2)}
+
+    status_counts = joined['status'].value_counts()
+    by_category = {}
+    for category, group in joined.groupby('category', sort=True):
+        by_category[category] = {
+            "count": int(len(group)),
+            "changed": int((group['status'] != 'unchanged').sum()),
+            **{f"{component}_delta": round(
+                float(group[f"{component}_delta"].sum()), 2)
+               for component in SALARY_COMPONENTS}
+        }
+
+    columns = ['BARQ_ID', 'Name', 'category', 'category_base',
+               'category_compare', 'status'] + [
+        f"{column}_{suffix}" for column in DIFF_VALUE_COLUMNS
+        for suffix in ('base', 'compare', 'delta')]
+    couriers = joined if include_unchanged else joined[
+        joined['status'] != 'unchanged']
+    movers = joined.sort_values('Total_Salary_delta', kind='stable')
+    mover_columns = ['BARQ_ID', 'Name', 'category', 'status',
+                     'Total_Salary_base', 'Total_Salary_compare',
+                     'Total_Salary_delta']
+
+    def mover_records(frame):
+        return _frame_records(frame, mover_columns)
+
+    return {
+        "summary": {
+            "totals": totals,
+            "counts": {
+                "base": int(in_base.sum()),
+                "compare": int(in_compare.sum()),
+                **{status: int(status_counts.get(status, 0))
+                   for status in ['added', 'removed', 'changed',
+                                  'unchanged']}
+            },
+            "by_category": by_category,
+            "top_increases": mover_records(
+                movers[movers['Total_Salary_delta'] > 0].iloc[::-1].head(top)),
+            "top_decreases": mover_records(
+                movers[movers['Total_Salary_delta'] < 0].head(top))
+        },
+        "couriers": _frame_records(couriers, columns)
+    }
+
+
+# SQL push-down: the batch formulas above expressed as BigQuery SQL over
+# the aggregate query, so BigQuery returns finished salary rows. The
+# Python engine stays the reference; cross_check_salary_records compares.
+
+def _sql_number(value):
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError(f"Invalid salary parameter value: {value}")
+    return repr(value)
+
+
+def _sql_round_cents(expression):
+    # FLOAT64 -> BIGNUMERIC keeps the binary value to 38 decimals, so
+    # half-even rounding there matches round(x, 2) in Python; a plain
+    # ROUND on FLOAT64 rounds halves away from zero.
+    return (f"CAST(ROUND(CAST({expression} AS BIGNUMERIC), 2, "
+            f"'ROUND_HALF_EVEN') AS FLOAT64)")
+
+
+def _sql_tiered_bonus(excess, tiers):
+    parts = []
+    floor = 0
+    for limit, rate in tiers:
+        in_tier = f"GREATEST({excess} - {_sql_number(floor)}, 0)"
+        if not math.isinf(limit):
+            in_tier = f"LEAST({in_tier}, {_sql_number(limit)})"
+            floor += limit
+        parts.append(f"{in_tier} * {_sql_number(rate)}")
+    return "(" + " + ".join(parts) + ")"
+
+
+def _sql_order_bonus(bonus_rate, penalty_rate):
+    return (f"IF(Total_Orders - final_target > 0, "
+            f"(Total_Orders - final_target) * {bonus_rate}, "
+            f"(Total_Orders - final_target) * {penalty_rate})")
+
+
+def salary_sql_expressions(category, custom_params):
+    """SQL for final_target, basic_salary, bonus_amount and gas_deserved.
+
+    final_target may be used by the other three expressions.
+    """
+    p = {key: _sql_number(value) for key, value
+         in resolve_salary_params(category, custom_params).items()}
+
+    if category == "Motorcycle":
+        return {
+            "final_target": ("LEAST(CEIL(TARGET), "
+                             "days_since_joining * 13.333)"),
+            "basic_salary": ("(final_target / 13.333) * "
+                             f"{p['motorcycle_basic_salary_rate']}"),
+            "bonus_amount": _sql_order_bonus(p['motorcycle_bonus_rate'],
+                                             p['motorcycle_penalty_rate']),
+            "gas_deserved": (f"LEAST(Total_Orders * "
+                             f"{p['motorcycle_gas_rate']}, "
+                             f"{p['motorcycle_gas_cap']})")
+        }
+    if category == "Food Trial":
+        return {
+            "final_target": "LEAST(TARGET, days_since_joining * 13)",
+            "basic_salary": ("(final_target / 13) * "
+                             f"{p['food_trial_basic_salary_rate']}"),
+            "bonus_amount": _sql_order_bonus(p['food_trial_bonus_rate'],
+                                             p['food_trial_penalty_rate']),
+            "gas_deserved": (f"LEAST({p['food_trial_gas_rate']} * "
+                             f"Total_Orders, {p['food_trial_gas_cap']})")
+        }
+    if category == "Food In-House New":
+        return {
+            "final_target": ("LEAST(TARGET, "
+                             "days_since_joining * 15.8333333)"),
+            "basic_salary": ("(final_target / 15.83333333) * "
+                             f"{p['food_inhouse_new_basic_salary_rate']}"),
+            "bonus_amount": _sql_order_bonus(
+                p['food_inhouse_new_bonus_rate'],
+                p['food_inhouse_new_penalty_rate']),
+            "gas_deserved": (f"LEAST({p['food_inhouse_new_gas_rate']} * "
+                             f"Total_Orders, "
+                             f"{p['food_inhouse_new_gas_cap']})")
+        }
+    if category == "Food In-House Old":
+        return {
+            "final_target": ("LEAST(TARGET, "
+                             "days_since_joining * 15.8333333)"),
+            "basic_salary": ("(final_target / 15.83333333) * "
+                             f"{p['food_inhouse_old_basic_salary_rate']}"),
+            "bonus_amount": (
+                f"IF(Total_Orders - final_target <= 0, "
+                f"(Total_Orders - final_target) * "
+                f"{p['food_inhouse_old_penalty_rate']}, "
+                f"{_sql_tiered_bonus('(Total_Orders - final_target)', FOOD_INHOUSE_OLD_BONUS_TIERS)})"),
+            "gas_deserved": (f"LEAST({p['food_inhouse_old_gas_rate']} * "
+                             f"Total_Orders, "
+                             f"{p['food_inhouse_old_gas_cap']})")
+        }
+    if category == "Ecommerce WH":
+        return {
+            "final_target": "LEAST(TARGET, days_since_joining * 16.66667)",
+            "basic_salary": ("(final_target / 16.6666667) * "
+                             f"{p['ecommerce_wh_basic_salary_rate']}"),
+            "bonus_amount": _sql_order_bonus(p['ecommerce_wh_bonus_rate'],
+                                             p['ecommerce_wh_penalty_rate']),
+            "gas_deserved": (f"LEAST((final_target / 16.666667) * "
+                             f"{p['ecommerce_wh_gas_rate']}, "
+                             f"{p['ecommerce_wh_gas_cap']})")
+        }
+    if category == "Ecommerce":
+        return {
+            "final_target": "LEAST(TARGET, days_since_joining * 221)",
+            "basic_salary": (
+                f"LEAST(Total_Revenue * "
+                f"{p['ecommerce_revenue_coefficient']}, "
+                f"(final_target / 221) * "
+                f"{p['ecommerce_basic_salary_rate']})"),
+            "bonus_amount": _sql_tiered_bonus(
+                "GREATEST(0, Total_Revenue - final_target)",
+                ECOMMERCE_BONUS_TIERS),
+            "gas_deserved": (f"LEAST(LEAST(0.068 * Total_Revenue, "
+                             f"(final_target / 221) * 15.06), "
+                             f"{p['ecommerce_gas_cap']})")
+        }
+    if category == "Ajeer":
+        return {
+            "final_target": "TARGET",
+            "basic_salary": ("(final_target / 13.333333333333334) * "
+                             f"{p['ajeer_basic_salary_rate']}"),
+            "bonus_amount": (
+                f"IF(Total_Orders - final_target <= 0, "
+                f"(Total_Orders - final_target) * "
+                f"{p['ajeer_penalty_rate']}, "
+                f"{_sql_tiered_bonus('(Total_Orders - final_target)', AJEER_BONUS_TIERS)})"),
+            "gas_deserved": (f"LEAST({p['ajeer_gas_rate']} * Total_Orders, "
+                             f"{p['ajeer_gas_cap']})")
+        }
+    logging.error(f"Invalid category provided: {category}")
+    raise ValueError(f"Invalid category: {category}")
+
+
+def generate_salary_query(categories, start_date, end_date, custom_params,
+                          targets, today=None, snapshot=None):
+    """Build SQL that returns finished salary rows for one period.
+
+    Wraps generate_query (one category) or generate_all_query (several)
+    and evaluates the salary formulas, tier tables and customParams in
+    BigQuery. custom_params is keyed by category like the request's and
+    targets holds each category's target from the target schedule, which
+    is inlined as a literal.
+    """
+    today = today or datetime.now().date()
+    if len(categories) == 1:
+        source = generate_query(categories[0], start_date, end_date,
+                                snapshot)
+    else:
+        source = generate_all_query(start_date, end_date, categories,
+                                    snapshot)
+
+    expressions = {
+        category: salary_sql_expressions(category,
+                                         custom_params.get(category, {}))
+        for category in categories
+    }
+
+    for category in categories:
+        expressions[category]['target'] = _sql_number(
+            targets.get(category) or 0)
+
+    def expression(name):
+        if len(categories) == 1:
+            return expressions[categories[0]][name]
+        cases = "\n".join(
+            f"                WHEN '{category}' THEN "
+            f"{expressions[category][name]}"
+            for category in categories)
+        return f"CASE category\n{cases}\n            END"
+
+    query = f"""
+    WITH Aggregates AS ({source}),
+    Inputs AS (
+        SELECT
+            * EXCEPT (Total_Orders, Gas_Usage, Total_Revenue),
+            IFNULL(Total_Orders, 0) AS Total_Orders,
+            {expression('target')} AS TARGET,
+            IFNULL(Gas_Usage, 0) AS Gas_Usage,
+            IFNULL(Total_Revenue, 0) AS Total_Revenue,
+            DATE_DIFF(DATE '{today:%Y-%m-%d}',
+                      SAFE.PARSE_DATE('%Y-%m-%d', joining_Date),
+                      DAY) + 1 AS days_since_joining
+        FROM Aggregates
+        WHERE SAFE.PARSE_DATE('%Y-%m-%d', joining_Date) IS NOT NULL
+    ),
+    Targets AS (
+        SELECT *,
+            {expression('final_target')} AS final_target
+        FROM Inputs
+    ),
+    Components AS (
+        SELECT *,
+            {expression('basic_salary')} AS basic_salary,
+            {expression('bonus_amount')} AS bonus_amount,
+            {expression('gas_deserved')} AS gas_deserved
+        FROM Targets
+    ),
+    Salaries AS (
+        SELECT *, gas_deserved - Gas_Usage AS gas_difference
+        FROM Components
+    )
+    SELECT
+        * EXCEPT (final_target, basic_salary, bonus_amount, gas_deserved,
+                  gas_difference),
+        {_sql_round_cents('basic_salary')} AS Basic_Salary,
+        {_sql_round_cents('bonus_amount')} AS Bonus_Amount,
+        {_sql_round_cents('gas_deserved')} AS Gas_Deserved,
+        {_sql_round_cents('gas_difference')} AS Gas_Difference,
+        {_sql_round_cents(
+            'GREATEST(0, basic_salary + bonus_amount + gas_difference)')}
+            AS Total_Salary,
+        final_target AS target
+    FROM Salaries
+    """
+    logging.debug(f"Generated salary push-down BigQuery:\n{query}")
+    return query
+
+
+def fetch_pushdown_payroll(client, categories, month, year, custom_params,
+                           single_scan=True, today=None, snapshot=None):
+    """Run payroll with the salaries computed inside BigQuery.
+
+    Returns a list of dicts with category, period and records, shaped like
+    the output of calculate_salary_details. A snapshot pins the source
+    tables and counts days_since_joining to the snapshot's date.
+    """
+    if snapshot is not None:
+        today = today or snapshot.date()
+    today = today or datetime.now().date()
+    generated_date = datetime.now().strftime('%Y-%m-%d')
+    if single_scan and len(categories) > 1 and all(
+            category in ALL_CATEGORIES for category in categories):
+        groups = [categories]
+    else:
+        groups = [[category] for category in categories]
+
+    records_by_category = {category: [] for category in categories}
+    for group in groups:
+        start_date, end_date = get_period(group[0], month, year)
+        query = generate_salary_query(
+            group, start_date, end_date, custom_params,
+            target_schedule.targets(client, group, end_date, snapshot),
+            today, snapshot)
+        for row in client.query(query).result():
+            record = dict(row)
+            category = record['category'] if len(group) > 1 else group[0]
+            record.update({
+                "period": {
+                    "start_date": start_date,
+                    "end_date": end_date
+                },
+                "generated_date": generated_date,
+                "category": category
+            })
+            records_by_category[category].append(record)
+
+    return [{
+        "category": category,
+        "start_date": get_period(category, month, year)[0],
+        "end_date": get_period(category, month, year)[1],
+        "records": records_by_category[category]
+    } for category in categories]
+
+
+def cross_check_salary_records(records, category, custom_params,
+                               today=None):
+    """Recalculate finished records with the batch engine and compare."""
+    if not records:
+        return {"checked": 0, "mismatches": 0, "max_difference": 0.0}
+    frame = _records_frame(records, SALARY_INPUT_COLUMNS + SALARY_COMPONENTS)
+    valid, inputs = salary_input_arrays(frame, today)
+    expected = calculate_salary_columns(inputs, category, custom_params)
+    differences = np.max([
+        np.abs(expected[component]
+               - _numeric_column(frame, component)[valid])
+        for component in SALARY_COMPONENTS
+    ], axis=0)
+    return {
+        "checked": int(valid.sum()),
+        "mismatches": int((differences >= 0.005).sum()),
+        "max_difference": round(float(differences.max(initial=0.0)), 2)
+    }
@@ -3,6 +3,7 @@ $(document).ready(function() {
     let currentCategory = null;
     let customParams = {};
     let currentData = [];
+    let currentRuns = [];
     let salaryChart = null;
     let bonusChart = null;
 
@@ -47,13 +48,24 @@ $(document).ready(function() {
             url: '/calculate_salary',
             method: 'POST',
             contentType: 'application/json',
-            data: JSON.stringify({ category, month, year, customParams }),
+            // Stored runs come back without rows; the dashboard and the
+            // table load them separately
+            data: JSON.stringify({ category, month, year, customParams, metaOnly: true }),
             success: function(response) {
+                currentRuns = (response.meta && response.meta.runs) || [];
+                $('#loadMoreRecords').addClass('d-none');
+                $('#recordsProgress').text('');
                 if (response.data && response.data.length > 0) {
                     currentData = response.data;
                     renderResults(response.data);
                     updateDashboard(response.data); // Update insights and charts
                     showToast("Salaries calculated successfully.", "success");
+                } else if (response.meta && response.meta.count > 0 && storedRuns()) {
+                    currentData = [];
+                    renderResults([]);
+                    loadDashboardSummary();
+                    loadRunRecords(null);
+                    showToast("Salaries calculated successfully.", "success");
                 } else {
                     showToast("No salary data found for the selected criteria.", "warning");
                 }
@@ -279,7 +291,14 @@ $(document).ready(function() {
         });
         tableHead.append(headerRow);
 
-        // Render table body
+        appendResults(data);
+    }
+
+    // Append rows to the table body without rebuilding what is there
+    function appendResults(data) {
+        const tableBody = $('#salaryTable tbody');
+        const headers = getHeaders();
+
         data.forEach(record => {
             const row = $('<tr></tr>');
             headers.forEach(headerObj => {
@@ -348,9 +367,58 @@ $(document).ready(function() {
         });
     }
 
+    // Bulk payslips: rendered on the server, polled until the ZIP is ready
+    $('#bulkPayslipsBtn').click(function() {
+        const btn = $(this);
+        if (currentRuns.length === 0 || !currentRuns.every(run => run.run_id)) {
+            showToast("Calculate salaries before generating payslips", "warning");
+            return;
+        }
+
+        btn.prop('disabled', true);
+        $.ajax({
+            url: '/payroll_runs/payslips',
+            method: 'POST',
+            contentType: 'application/json',
+            data: JSON.stringify({ run_ids: currentRuns.map(run => run.run_id) }),
+            success: function(job) {
+                pollPayslipJob(job.status_url, btn);
+            },
+            error: function() {
+                btn.prop('disabled', false);
+                showToast("Error starting payslip generation", "danger");
+            }
+        });
+    });
+
+    function pollPayslipJob(statusUrl, btn) {
+        $.getJSON(statusUrl, function(job) {
+            $('#bulkPayslipsProgress').text(`${job.done + job.failed} / ${job.total} payslips`);
+            if (job.status === 'done') {
+                btn.prop('disabled', false);
+                window.location.href = job.download_url;
+                showToast(`Generated ${job.done} payslips`, job.failed ? "warning" : "success");
+            } else if (job.status === 'failed') {
+                btn.prop('disabled', false);
+                showToast("Error generating payslips", "danger");
+            } else {
+                setTimeout(() => pollPayslipJob(statusUrl, btn), 1000);
+            }
+        }).fail(function() {
+            btn.prop('disabled', false);
+            showToast("Error checking payslip progress", "danger");
+        });
+    }
+
     // CSV download handler with spinner
     $('#downloadCsv').click(function() {
         const btn = $(this);
+        // Stored runs are streamed by the server instead of built in the tab
+        if (storedRuns()) {
+            window.location.href = payrollExportUrl('csv');
+            return;
+        }
+
         if (currentData.length === 0) {
             showToast("No data available to download", "warning");
             return;
@@ -387,8 +455,138 @@ $(document).ready(function() {
         });
     }, 300));
 
+    function storedRuns() {
+        return currentRuns.length > 0 && currentRuns.every(run => run.run_id);
+    }
+
+    function runParams() {
+        const params = new URLSearchParams();
+        currentRuns.forEach(run => params.append('run_id', run.run_id));
+        return params;
+    }
+
+    // Table rows of stored runs: the first page, then one more page each
+    // time the user asks for it
+    let recordsTotal = 0;
+
+    function loadRunRecords(after) {
+        const params = runParams();
+        if (after) {
+            params.append('after', after);
+        }
+        const btn = $('#loadMoreRecords').prop('disabled', true);
+        $.getJSON(`/payroll_runs/records?${params.toString()}`, function(response) {
+            if (!after) {
+                recordsTotal = response.meta.total;
+            }
+            currentData = currentData.concat(response.data);
+            appendResults(response.data);
+            $('#recordsProgress').text(`Showing ${currentData.length} of ${recordsTotal}`);
+            btn.data('after', response.meta.next)
+                .toggleClass('d-none', !response.meta.next);
+        }).fail(function() {
+            showToast("Error loading salary records", "danger");
+        }).always(function() {
+            btn.prop('disabled', false);
+        });
+    }
+
+    $('#loadMoreRecords').click(function() {
+        loadRunRecords($(this).data('after'));
+    });
+
     // Update Dashboard Section
     function updateDashboard(data) {
+        // Stored runs are summarized on the server
+        if (storedRuns()) {
+            loadDashboardSummary(data);
+            return;
+        }
+        updateDashboardFromRecords(data);
+    }
+
+    function loadDashboardSummary(data) {
+        $.getJSON(`/payroll_runs/summary?${runParams().toString()}`, function(summary) {
+            $('#totalEmployees').text(summary.totals.count);
+            $('#totalSalary').text(formatCurrency(summary.totals.Total_Salary));
+            $('#totalBonuses').text(formatCurrency(summary.totals.Bonus_Amount));
+            $('#totalOrders').text(summary.totals.Total_Orders);
+            updateHistogramCharts(summary.distributions);
+            renderSummaryDetails(summary);
+        }).fail(function() {
+            if (data) {
+                updateDashboardFromRecords(data);
+            } else {
+                showToast("Error loading the dashboard summary", "danger");
+            }
+        });
+    }
+
+    function renderSummaryDetails(summary) {
+        const percentiles = summary.distributions.Total_Salary.percentiles;
+        const percentileList = $('#salaryPercentiles').empty();
+        Object.keys(percentiles).forEach(name => {
+            percentileList.append(`<li class="list-inline-item me-3">${name.toUpperCase()}: ${formatCurrency(percentiles[name])}</li>`);
+        });
+
+        [['#topEarners', summary.top_earners], ['#bottomEarners', summary.bottom_earners]].forEach(([selector, earners]) => {
+            const body = $(selector).empty();
+            earners.forEach(earner => {
+                const row = $('<tr></tr>');
+                row.append($('<td></td>').text(earner.BARQ_ID));
+                row.append($('<td></td>').text(earner.Name || ''));
+                row.append($('<td></td>').text(earner.category || ''));
+                row.append($('<td></td>').text(formatCurrency(earner.Total_Salary)));
+                body.append(row);
+            });
+        });
+        $('#summaryDetails').removeClass('d-none');
+    }
+
+    // Histogram bins as "from - to" labels
+    function histogramLabels(edges) {
+        return edges.slice(0, -1).map((edge, i) => `${edge} - ${edges[i + 1]}`);
+    }
+
+    function histogramChart(canvasId, label, histogram, color) {
+        const ctx = document.getElementById(canvasId).getContext('2d');
+        return new Chart(ctx, {
+            type: 'bar',
+            data: {
+                labels: histogramLabels(histogram.edges),
+                datasets: [{
+                    label: label,
+                    data: histogram.counts,
+                    backgroundColor: `rgba(${color}, 0.6)`,
+                    borderColor: `rgba(${color}, 1)`,
+                    borderWidth: 1
+                }]
+            },
+            options: {
+                responsive: true,
+                maintainAspectRatio: false,
+                scales: {
+                    y: { beginAtZero: true, ticks: { color: '#e0e0e0' } },
+                    x: { ticks: { color: '#e0e0e0', maxRotation: 90, minRotation: 45 } }
+                },
+                plugins: {
+                    legend: { labels: { color: '#e0e0e0' } }
+                }
+            }
+        });
+    }
+
+    function updateHistogramCharts(distributions) {
+        if (salaryChart) salaryChart.destroy();
+        if (bonusChart) bonusChart.destroy();
+        salaryChart = histogramChart('salaryDistributionChart', 'Couriers by Total Salary',
+                                     distributions.Total_Salary.histogram, '76, 175, 80');
+        bonusChart = histogramChart('bonusDistributionChart', 'Couriers by Bonus Amount',
+                                    distributions.Bonus_Amount.histogram, '0, 188, 212');
+    }
+
+    function updateDashboardFromRecords(data) {
+        $('#summaryDetails').addClass('d-none');
         // Calculate total employees
         const totalEmployees = data.length;
         $('#totalEmployees').text(totalEmployees);
@@ -735,6 +933,12 @@ $(document).ready(function() {
     }
 
     // Create CSV content
+    function payrollExportUrl(format) {
+        const params = new URLSearchParams({ format });
+        currentRuns.forEach(run => params.append('run_id', run.run_id));
+        return `/payroll_runs/export?${params.toString()}`;
+    }
+
     function createCSVContent(data) {
         const headers = [
             'BARQ ID', 'Name', 'IBAN', 'ID Number', 'Joining Date',
@@ -0,0 +1,75 @@
+
+    WITH Aggregates AS (
+    
+    WITH CurrentPeriod AS (
+        SELECT DATE '2026-05-01' AS StartPeriod,
+               DATE '2026-05-31' AS EndPeriod
+    )
+    SELECT 
+        u.BARQ_ID,
+        u.iban,
+        u.id_number,
+        FORMAT_DATE('%Y-%m-%d', u.joining_Date) AS joining_Date,
+        u.Name,
+        u.Status,
+        u.Sponsorshipstatus,
+        u.PROJECT,
+        u.Supervisor,
+        SUM(u.total_Orders) AS Total_Orders,
+        SUM(u.Total_revenue) AS Total_Revenue,
+        SUM(u.Gas_Usage_without_vat) AS Gas_Usage
+    FROM master_saned.ultimate AS u
+    WHERE u.Sponsorshipstatus = 'Ajeer'
+    AND u.Date BETWEEN DATE '2026-05-01' AND DATE '2026-05-31'
+    GROUP BY 
+        u.BARQ_ID,
+        u.iban,
+        u.id_number,
+        u.joining_Date,
+        u.Name,
+        u.Status,
+        u.Sponsorshipstatus,
+        u.PROJECT,
+        u.Supervisor
+    ),
+    Inputs AS (
+        SELECT
+            * EXCEPT (Total_Orders, Gas_Usage, Total_Revenue),
+            IFNULL(Total_Orders, 0) AS Total_Orders,
+            400.0 AS TARGET,
+            IFNULL(Gas_Usage, 0) AS Gas_Usage,
+            IFNULL(Total_Revenue, 0) AS Total_Revenue,
+            DATE_DIFF(DATE '2026-05-31',
+                      SAFE.PARSE_DATE('%Y-%m-%d', joining_Date),
+                      DAY) + 1 AS days_since_joining
+        FROM Aggregates
+        WHERE SAFE.PARSE_DATE('%Y-%m-%d', joining_Date) IS NOT NULL
+    ),
+    Targets AS (
+        SELECT *,
+            TARGET AS final_target
+        FROM Inputs
+    ),
+    Components AS (
+        SELECT *,
+            (final_target / 13.333333333333334) * 53.33333 AS basic_salary,
+            IF(Total_Orders - final_target <= 0, (Total_Orders - final_target) * 10.0, (LEAST(GREATEST((Total_Orders - final_target) - 0.0, 0), 299.0) * 6.0 + LEAST(GREATEST((Total_Orders - final_target) - 299.0, 0), 100.0) * 7.0 + LEAST(GREATEST((Total_Orders - final_target) - 399.0, 0), 100.0) * 8.0 + GREATEST((Total_Orders - final_target) - 499.0, 0) * 9.0)) AS bonus_amount,
+            LEAST(2.065 * Total_Orders, 826.0) AS gas_deserved
+        FROM Targets
+    ),
+    Salaries AS (
+        SELECT *, gas_deserved - Gas_Usage AS gas_difference
+        FROM Components
+    )
+    SELECT
+        * EXCEPT (final_target, basic_salary, bonus_amount, gas_deserved,
+                  gas_difference),
+        CAST(ROUND(CAST(basic_salary AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64) AS Basic_Salary,
+        CAST(ROUND(CAST(bonus_amount AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64) AS Bonus_Amount,
+        CAST(ROUND(CAST(gas_deserved AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64) AS Gas_Deserved,
+        CAST(ROUND(CAST(gas_difference AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64) AS Gas_Difference,
+        CAST(ROUND(CAST(GREATEST(0, basic_salary + bonus_amount + gas_difference) AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64)
+            AS Total_Salary,
+        final_target AS target
+    FROM Salaries
+    
\ No newline at end of file
@@ -0,0 +1,119 @@
+
+    WITH Aggregates AS (
+    
+    WITH CurrentPeriod AS (
+        SELECT DATE '2026-05-01' AS StartPeriod,
+               DATE '2026-05-31' AS EndPeriod
+    )
+    SELECT 
+        u.BARQ_ID,
+        u.iban,
+        u.id_number,
+        FORMAT_DATE('%Y-%m-%d', u.joining_Date) AS joining_Date,
+        u.Name,
+        u.Status,
+        u.Sponsorshipstatus,
+        u.PROJECT,
+        u.Supervisor,
+        SUM(u.total_Orders) AS Total_Orders,
+        SUM(u.Total_revenue) AS Total_Revenue,
+        SUM(u.Gas_Usage_without_vat) AS Gas_Usage,
+        CASE
+            WHEN u.PROJECT = 'Motorcycle' THEN 'Motorcycle'
+            WHEN u.PROJECT = 'Food' AND u.Sponsorshipstatus = 'Trial' THEN 'Food Trial'
+            WHEN u.PROJECT = 'Food' AND u.Sponsorshipstatus = 'Inhouse' AND u.joining_Date >= '2024-01-01' THEN 'Food In-House New'
+            WHEN u.PROJECT = 'Food' AND u.Sponsorshipstatus = 'Inhouse' AND u.joining_Date < '2024-01-01' THEN 'Food In-House Old'
+            WHEN u.PROJECT = 'Ecommerce WH' THEN 'Ecommerce WH'
+            WHEN u.PROJECT = 'Ecommerce' THEN 'Ecommerce'
+        END AS category
+    FROM master_saned.ultimate AS u
+    WHERE ((u.PROJECT = 'Motorcycle') OR (u.PROJECT = 'Food' AND u.Sponsorshipstatus = 'Trial') OR (u.PROJECT = 'Food' AND u.Sponsorshipstatus = 'Inhouse' AND u.joining_Date >= '2024-01-01') OR (u.PROJECT = 'Food' AND u.Sponsorshipstatus = 'Inhouse' AND u.joining_Date < '2024-01-01') OR (u.PROJECT = 'Ecommerce WH') OR (u.PROJECT = 'Ecommerce'))
+    AND u.Date BETWEEN DATE '2026-05-01' AND DATE '2026-05-31'
+    GROUP BY 
+        u.BARQ_ID,
+        u.iban,
+        u.id_number,
+        u.joining_Date,
+        u.Name,
+        u.Status,
+        u.Sponsorshipstatus,
+        u.PROJECT,
+        u.Supervisor,
+        category
+    ),
+    Inputs AS (
+        SELECT
+            * EXCEPT (Total_Orders, Gas_Usage, Total_Revenue),
+            IFNULL(Total_Orders, 0) AS Total_Orders,
+            CASE category
+                WHEN 'Motorcycle' THEN 400.0
+                WHEN 'Food Trial' THEN 400.0
+                WHEN 'Food In-House New' THEN 400.0
+                WHEN 'Food In-House Old' THEN 400.0
+                WHEN 'Ecommerce WH' THEN 400.0
+                WHEN 'Ecommerce' THEN 6000.0
+            END AS TARGET,
+            IFNULL(Gas_Usage, 0) AS Gas_Usage,
+            IFNULL(Total_Revenue, 0) AS Total_Revenue,
+            DATE_DIFF(DATE '2026-05-31',
+                      SAFE.PARSE_DATE('%Y-%m-%d', joining_Date),
+                      DAY) + 1 AS days_since_joining
+        FROM Aggregates
+        WHERE SAFE.PARSE_DATE('%Y-%m-%d', joining_Date) IS NOT NULL
+    ),
+    Targets AS (
+        SELECT *,
+            CASE category
+                WHEN 'Motorcycle' THEN LEAST(CEIL(TARGET), days_since_joining * 13.333)
+                WHEN 'Food Trial' THEN LEAST(TARGET, days_since_joining * 13)
+                WHEN 'Food In-House New' THEN LEAST(TARGET, days_since_joining * 15.8333333)
+                WHEN 'Food In-House Old' THEN LEAST(TARGET, days_since_joining * 15.8333333)
+                WHEN 'Ecommerce WH' THEN LEAST(TARGET, days_since_joining * 16.66667)
+                WHEN 'Ecommerce' THEN LEAST(TARGET, days_since_joining * 221)
+            END AS final_target
+        FROM Inputs
+    ),
+    Components AS (
+        SELECT *,
+            CASE category
+                WHEN 'Motorcycle' THEN (final_target / 13.333) * 53.33333
+                WHEN 'Food Trial' THEN (final_target / 13) * 66.66666667
+                WHEN 'Food In-House New' THEN (final_target / 15.83333333) * 66.66666667
+                WHEN 'Food In-House Old' THEN (final_target / 15.83333333) * 66.66666667
+                WHEN 'Ecommerce WH' THEN (final_target / 16.6666667) * 66.666667
+                WHEN 'Ecommerce' THEN LEAST(Total_Revenue * 0.31, (final_target / 221) * 66.66666667)
+            END AS basic_salary,
+            CASE category
+                WHEN 'Motorcycle' THEN IF(Total_Orders - final_target > 0, (Total_Orders - final_target) * 7.5, (Total_Orders - final_target) * 10.0)
+                WHEN 'Food Trial' THEN IF(Total_Orders - final_target > 0, (Total_Orders - final_target) * 7.0, (Total_Orders - final_target) * 10.0)
+                WHEN 'Food In-House New' THEN IF(Total_Orders - final_target > 0, (Total_Orders - final_target) * 7.0, (Total_Orders - final_target) * 10.0)
+                WHEN 'Food In-House Old' THEN IF(Total_Orders - final_target <= 0, (Total_Orders - final_target) * 10.0, (LEAST(GREATEST((Total_Orders - final_target) - 0.0, 0), 124.0) * 5.0 + LEAST(GREATEST((Total_Orders - final_target) - 124.0, 0), 100.0) * 6.0 + LEAST(GREATEST((Total_Orders - final_target) - 224.0, 0), 100.0) * 7.0 + LEAST(GREATEST((Total_Orders - final_target) - 324.0, 0), 100.0) * 8.0 + GREATEST((Total_Orders - final_target) - 424.0, 0) * 9.0))
+                WHEN 'Ecommerce WH' THEN IF(Total_Orders - final_target > 0, (Total_Orders - final_target) * 8.0, (Total_Orders - final_target) * 10.0)
+                WHEN 'Ecommerce' THEN (LEAST(GREATEST(GREATEST(0, Total_Revenue - final_target) - 0.0, 0), 4000.0) * 0.55 + GREATEST(GREATEST(0, Total_Revenue - final_target) - 4000.0, 0) * 0.5)
+            END AS bonus_amount,
+            CASE category
+                WHEN 'Motorcycle' THEN LEAST(Total_Orders * 0.65, 261.0)
+                WHEN 'Food Trial' THEN LEAST(2.11 * Total_Orders, 826.0)
+                WHEN 'Food In-House New' THEN LEAST(1.739 * Total_Orders, 826.0)
+                WHEN 'Food In-House Old' THEN LEAST(2.065 * Total_Orders, 700.0)
+                WHEN 'Ecommerce WH' THEN LEAST((final_target / 16.666667) * 15.03, 452.0)
+                WHEN 'Ecommerce' THEN LEAST(LEAST(0.068 * Total_Revenue, (final_target / 221) * 15.06), 452.0)
+            END AS gas_deserved
+        FROM Targets
+    ),
+    Salaries AS (
+        SELECT *, gas_deserved - Gas_Usage AS gas_difference
+        FROM Components
+    )
+    SELECT
+        * EXCEPT (final_target, basic_salary, bonus_amount, gas_deserved,
+                  gas_difference),
+        CAST(ROUND(CAST(basic_salary AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64) AS Basic_Salary,
+        CAST(ROUND(CAST(bonus_amount AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64) AS Bonus_Amount,
+        CAST(ROUND(CAST(gas_deserved AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64) AS Gas_Deserved,
+        CAST(ROUND(CAST(gas_difference AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64) AS Gas_Difference,
+        CAST(ROUND(CAST(GREATEST(0, basic_salary + bonus_amount + gas_difference) AS BIGNUMERIC), 2, 'ROUND_HALF_EVEN') AS FLOAT64)
+            AS Total_Salary,
+        final_target AS target
+    FROM Salaries
+    
\ No newline at end of file
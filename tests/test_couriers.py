@@ -0,0 +1,217 @@
+"""Courier pages from the snapshot and from keyset queries.
+
+The keyset queries are run in SQLite against the same rows, with the
+courier table in an attached database named master_saned.
+"""
+import sqlite3
+from datetime import datetime, timezone
+
+import pytest
+
+import couriers
+from couriers import CourierDirectory
+
+# BARQ_IDs with runs of ties, and a courier without one
+BARQ_IDS = [1, 2, 2, 2, 3, 4, 5, 5, 6, 7, 8, 8, 9, 10, 11, None]
+
+
+class Table:
+    def __init__(self, num_rows):
+        self.modified = datetime(2026, 5, 1, tzinfo=timezone.utc)
+        self.num_rows = num_rows
+
+
+class Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self):
+        return iter(self.rows)
+
+
+class Client:
+    """BigQuery stand-in running every query in SQLite."""
+
+    def __init__(self, barq_ids=BARQ_IDS):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("ATTACH DATABASE ':memory:' AS master_saned")
+        self.conn.execute("CREATE TABLE master_saned.courier "
+                          "(BARQ_ID INTEGER, Name TEXT)")
+        self.conn.executemany(
+            "INSERT INTO master_saned.courier VALUES (?, ?)",
+            [(barq_id, f"Courier {index}")
+             for index, barq_id in enumerate(barq_ids)])
+        self.num_rows = len(barq_ids)
+        self.queries = []
+
+    def get_table(self, table_id):
+        return Table(self.num_rows)
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        params = {param.name: param.value
+                  for param in getattr(job_config, "query_parameters", [])}
+        return Result([dict(row) for row in
+                       self.conn.execute(query, params).fetchall()])
+
+
+def _directory(client, max_rows=couriers.COURIER_SNAPSHOT_MAX_ROWS):
+    directory = CourierDirectory(max_rows=max_rows)
+    # Load synchronously; the check interval then keeps page() from
+    # starting a background refresh
+    directory._refresh(client)
+    return directory
+
+
+@pytest.fixture(params=["snapshot", "keyset"])
+def directory(request):
+    client = Client()
+    max_rows = 0 if request.param == "keyset" else \
+        couriers.COURIER_SNAPSHOT_MAX_ROWS
+    directory = _directory(client, max_rows)
+    assert (directory.rows is None) == (request.param == "keyset")
+    return client, directory
+
+
+def _all_rows(client):
+    return client.query(f"SELECT * FROM {couriers.COURIER_TABLE} "
+                        f"WHERE BARQ_ID IS NOT NULL ORDER BY BARQ_ID, Name"
+                        ).result()
+
+
+def _names(rows):
+    return sorted(row["Name"] for row in rows)
+
+
+@pytest.mark.parametrize("per_page", [1, 2, 3, 5, 20])
+def test_pages_forward_cover_every_courier_once(directory, per_page):
+    client, directory = directory
+    seen, after, pages = [], None, 0
+
+    while True:
+        rows, prev_cursor, next_cursor = directory.page(
+            client, per_page, after=after)
+        seen.extend(rows)
+        assert (prev_cursor is None) == (after is None)
+        pages += 1
+        if next_cursor is None:
+            break
+        assert next_cursor == rows[-1]["BARQ_ID"]
+        after = next_cursor
+
+    assert _names(seen) == _names(_all_rows(client))
+    assert [row["BARQ_ID"] for row in seen] == \
+        sorted(barq_id for barq_id in BARQ_IDS if barq_id is not None)
+    assert pages <= len(set(BARQ_IDS))
+
+
+@pytest.mark.parametrize("per_page", [1, 2, 3, 5])
+def test_pages_backward_cover_every_courier_once(directory, per_page):
+    client, directory = directory
+    seen = []
+    before = max(barq_id for barq_id in BARQ_IDS if barq_id is not None) + 1
+
+    while before is not None:
+        rows, prev_cursor, next_cursor = directory.page(
+            client, per_page, before=before)
+        assert next_cursor == (rows[-1]["BARQ_ID"] if seen else None)
+        seen = rows + seen
+        before = prev_cursor
+
+    assert _names(seen) == _names(_all_rows(client))
+
+
+def test_pages_never_split_ties(directory):
+    client, directory = directory
+
+    forward, _, next_cursor = directory.page(client, 2)
+    backward, prev_cursor, _ = directory.page(client, 2, before=3)
+
+    assert [row["BARQ_ID"] for row in forward] == [1, 2, 2, 2]
+    assert next_cursor == 2
+    assert [row["BARQ_ID"] for row in backward] == [2, 2, 2]
+    assert prev_cursor == 2
+
+
+def test_prev_cursor_returns_to_the_same_page(directory):
+    client, directory = directory
+    first, _, after = directory.page(client, 4)
+    second, before, _ = directory.page(client, 4, after=after)
+
+    back, prev_cursor, next_cursor = directory.page(client, 4, before=before)
+
+    assert [row["BARQ_ID"] for row in second] == [3, 4, 5, 5]
+    assert _names(back) == _names(first)
+    assert prev_cursor is None
+    assert next_cursor == after
+
+
+def test_snapshot_and_keyset_pages_agree():
+    client = Client()
+    snapshot = _directory(client)
+    keyset = _directory(client, max_rows=0)
+
+    for cursors in ({}, {"after": 2}, {"after": 5}, {"after": 11},
+                    {"before": 5}, {"before": 2}, {"before": 1}):
+        from_snapshot = snapshot.page(client, 3, **cursors)
+        from_query = keyset.page(client, 3, **cursors)
+        assert _names(from_snapshot[0]) == _names(from_query[0]), cursors
+        assert from_snapshot[1:] == from_query[1:], cursors
+
+
+def test_empty_pages_past_either_end(directory):
+    client, directory = directory
+
+    assert directory.page(client, 3, after=11) == ([], None, None)
+    assert directory.page(client, 3, before=1) == ([], None, None)
+
+
+def test_snapshot_pages_do_not_query():
+    client = Client()
+    directory = _directory(client)
+    loaded = len(client.queries)
+
+    directory.page(client, 3, after=4)
+    directory.page(client, 3, before=9)
+
+    assert len(client.queries) == loaded
+
+
+def test_table_over_the_cap_is_paged_with_keyset_queries():
+    client = Client()
+
+    directory = _directory(client, max_rows=client.num_rows - 1)
+    directory.page(client, 3, after=4)
+
+    assert directory.rows is None
+    assert directory.count == len(BARQ_IDS) - 1
+    assert "@cursor" in client.queries[-1]
+
+
+def test_total_leaves_out_couriers_without_barq_id(directory):
+    client, directory = directory
+
+    assert directory.total(client) == len(BARQ_IDS) - 1
+
+
+def test_offset_page_from_the_snapshot():
+    client = Client()
+    directory = _directory(client)
+    loaded = len(client.queries)
+
+    page = directory.offset_page(client, per_page=4, page=2)
+
+    assert [row["BARQ_ID"] for row in page] == [3, 4, 5, 5]
+    assert len(client.queries) == loaded
+
+
+def test_offset_page_falls_back_to_limit_offset():
+    client = Client()
+    directory = _directory(client, max_rows=0)
+
+    page = directory.offset_page(client, per_page=4, page=2)
+
+    assert [row["BARQ_ID"] for row in page] == [3, 4, 5, 5]
+    assert "LIMIT 4 OFFSET 4" in client.queries[-1]
+    assert directory.offset_page(client, per_page=4, page=5) == []
@@ -0,0 +1,300 @@
+"""Stored payroll runs: reuse, incremental recalculation and pruning."""
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+import payroll_store
+import salary
+from payroll_store import PayrollRunStore, run_payroll
+
+MONTH, YEAR = 5, 2026
+
+
+class Table:
+    def __init__(self, modified):
+        self.modified = modified
+
+
+class Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self, page_size=None):
+        return self
+
+    @property
+    def pages(self):
+        yield self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class Client:
+    """BigQuery stand-in serving table stamps, targets and aggregates."""
+
+    def __init__(self):
+        self.modified = {
+            table_id: datetime(2026, 5, 1, tzinfo=timezone.utc)
+            for table_id in payroll_store.SOURCE_TABLES
+        }
+        self.targets = {"motorcycle": 400, "food_trial": 390}
+        self.aggregates = {
+            "Motorcycle": [_aggregate(1, 420), _aggregate(2, 380)],
+            "Food Trial": [_aggregate(3, 300)],
+        }
+        self.aggregate_queries = 0
+
+    def touch(self, table_id=salary.TARGETS_TABLE):
+        self.modified[table_id] += timedelta(minutes=1)
+
+    def get_table(self, table_id):
+        return Table(self.modified[table_id])
+
+    def query(self, query):
+        if salary.TARGETS_TABLE in query:
+            return Result([dict(self.targets, Day=day)
+                           for day in range(1, 32)])
+        self.aggregate_queries += 1
+        category = next(category for category in self.aggregates
+                        if salary.CATEGORY_QUERIES[category]['condition']
+                        in query)
+        return Result([dict(row) for row in self.aggregates[category]])
+
+
+def _aggregate(barq_id, orders):
+    return {"BARQ_ID": barq_id, "Name": f"Courier {barq_id}",
+            "joining_Date": "2025-01-10", "Status": "Active",
+            "Total_Orders": orders, "Total_Revenue": Decimal("5210.35"),
+            "Gas_Usage": Decimal("120.50")}
+
+
+class Clock(datetime):
+    current = datetime(2026, 5, 25, 9, 0)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(payroll_store, "datetime", Clock)
+    Clock.current = datetime(2026, 5, 25, 9, 0)
+    return Clock
+
+
+@pytest.fixture(autouse=True)
+def schedule(monkeypatch):
+    schedule = salary.TargetSchedule()
+    monkeypatch.setattr(salary, "target_schedule", schedule)
+    monkeypatch.setattr(payroll_store, "target_schedule", schedule)
+    return schedule
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PayrollRunStore(str(tmp_path / "payroll_runs.sqlite"))
+
+
+def source_stamp(client):
+    return ";".join(f"{table_id}@{client.modified[table_id].isoformat()}"
+                    for table_id in payroll_store.SOURCE_TABLES)
+
+
+def _run(client, store, categories=("Motorcycle",), custom_params=None,
+         **kwargs):
+    return run_payroll(client, store, list(categories), MONTH, YEAR,
+                       custom_params or {}, single_scan=False, **kwargs)
+
+
+def test_same_day_run_is_served_from_the_store(clock, store):
+    client = Client()
+    first = _run(client, store)
+
+    second = _run(client, store)
+
+    assert client.aggregate_queries == 1
+    assert second[0]["run"]["run_id"] == first[0]["run"]["run_id"]
+    assert second[0]["run"]["recomputed"] == 0
+    assert second[0]["records"] == first[0]["records"]
+
+
+def test_reused_and_recalculated_records_have_the_same_types(clock, store):
+    client = Client()
+    recalculated = _run(client, store)[0]["records"]
+
+    reused = _run(client, store)[0]["records"]
+
+    assert recalculated == reused
+    for new, old in zip(recalculated, reused):
+        assert {key: type(value) for key, value in new.items()} == \
+            {key: type(value) for key, value in old.items()}
+    assert isinstance(reused[0]["Total_Revenue"], float)
+
+
+def test_changed_source_recalculates_only_changed_couriers(clock, store):
+    client = Client()
+    first = _run(client, store)
+    client.touch("master_saned.ultimate")
+    client.aggregates["Motorcycle"][1]["Total_Orders"] = 395
+
+    second = _run(client, store)
+
+    run = second[0]["run"]
+    assert client.aggregate_queries == 2
+    assert run["version"] == 2
+    assert run["recomputed"] == 1
+    assert second[0]["records"][0] == first[0]["records"][0]
+    assert second[0]["records"][1]["Total_Orders"] == 395
+
+
+def test_changed_source_with_same_rows_keeps_the_run(clock, store):
+    client = Client()
+    first = _run(client, store)
+    client.touch("master_saned.ultimate")
+
+    second = _run(client, store)
+
+    assert second[0]["run"]["run_id"] == first[0]["run"]["run_id"]
+    assert second[0]["run"]["recomputed"] == 0
+    assert second[0]["run"]["source_version"] == source_stamp(client)
+    assert store.get_run(first[0]["run"]["run_id"])["source_version"] == \
+        source_stamp(client)
+
+
+def test_next_day_recalculates_every_courier(clock, store):
+    client = Client()
+    _run(client, store)
+    clock.current += timedelta(days=1)
+
+    second = _run(client, store)
+
+    assert client.aggregate_queries == 1
+    assert second[0]["run"]["version"] == 2
+    assert second[0]["run"]["recomputed"] == 2
+
+
+def test_refresh_recalculates_from_bigquery(clock, store):
+    client = Client()
+    _run(client, store)
+
+    second = _run(client, store, refresh=True)
+
+    assert client.aggregate_queries == 2
+    assert second[0]["run"]["recomputed"] == 2
+
+
+def test_runs_are_keyed_by_params(clock, store):
+    client = Client()
+    default = _run(client, store)
+
+    custom = _run(client, store, custom_params={
+        "Motorcycle": {"motorcycle_bonus_rate": 8}})
+
+    assert custom[0]["run"]["run_id"] != default[0]["run"]["run_id"]
+    assert custom[0]["run"]["version"] == 1
+    assert custom[0]["records"][0]["Bonus_Amount"] > \
+        default[0]["records"][0]["Bonus_Amount"]
+
+
+def test_target_change_is_used_by_the_run_it_stamps(clock, store, schedule):
+    client = Client()
+    _run(client, store)
+    client.targets["motorcycle"] = 350
+    client.touch(salary.TARGETS_TABLE)
+
+    # Within the schedule's check interval
+    second = _run(client, store)
+
+    assert second[0]["run"]["version"] == 2
+    assert {record["TARGET"] for record in second[0]["records"]} == {350}
+    assert second[0]["run"]["source_version"] == source_stamp(client)
+
+
+def test_unreadable_source_is_never_treated_as_fresh(clock, store):
+    client = Client()
+    _run(client, store)
+    client.get_table = lambda table_id: 1 / 0
+
+    second = _run(client, store)
+
+    assert client.aggregate_queries == 2
+    assert second[0]["run"]["source_version"] is None
+
+
+def test_pinned_run_is_served_as_is(clock, store):
+    client = Client()
+    snapshot = datetime(2026, 5, 24, 12, tzinfo=timezone.utc)
+    first = _run(client, store, snapshot=snapshot)
+    client.touch("master_saned.ultimate")
+    clock.current += timedelta(days=10)
+
+    second = _run(client, store, snapshot=snapshot)
+
+    assert client.aggregate_queries == 1
+    assert second[0]["run"]["run_id"] == first[0]["run"]["run_id"]
+    assert second[0]["run"]["snapshot"] == snapshot.isoformat()
+
+
+def _rows(count):
+    return [{"fingerprint": str(index), "inputs": {"BARQ_ID": index},
+             "result": {"BARQ_ID": index}} for index in range(count)]
+
+
+def _save(store, start_date="2026-04-25", params=None, snapshot=None):
+    return store.save_run("Motorcycle", start_date, "2026-05-24",
+                          params or {}, "source", "2026-05-25", _rows(2), 2,
+                          snapshot)
+
+
+def _versions(store, start_date="2026-04-25", params=None):
+    with store._connect() as conn:
+        return [row[0] for row in conn.execute("""
+            SELECT version FROM payroll_runs
+            WHERE start_date = ? AND params_hash = ? AND snapshot IS NULL
+            ORDER BY version
+        """, (start_date, payroll_store.params_hash(params or {})))]
+
+
+def test_save_keeps_the_newest_versions(clock, store):
+    runs = [_save(store) for _ in range(payroll_store.KEEP_VERSIONS + 3)]
+
+    assert _versions(store) == list(range(4, 9))
+    assert store.get_run(runs[0]["run_id"]) is None
+    assert store.run_rows(runs[0]["run_id"]) == []
+    assert len(store.run_rows(runs[-1]["run_id"])) == 2
+
+
+def test_save_prunes_old_superseded_runs_of_every_key(clock, store):
+    _save(store, "2026-03-25")
+    _save(store, "2026-03-25")
+    _save(store, "2026-02-25")
+    clock.current += timedelta(days=payroll_store.SUPERSEDED_RUN_DAYS + 1)
+
+    _save(store)
+
+    assert _versions(store, "2026-03-25") == [2]
+    assert _versions(store, "2026-02-25") == [1]
+    assert _versions(store) == [1]
+
+
+def test_save_keeps_recent_superseded_runs(clock, store):
+    _save(store, "2026-03-25")
+    _save(store, "2026-03-25")
+    clock.current += timedelta(days=payroll_store.SUPERSEDED_RUN_DAYS - 1)
+
+    _save(store)
+
+    assert _versions(store, "2026-03-25") == [1, 2]
+
+
+def test_pinned_runs_are_never_pruned(clock, store):
+    pinned = [_save(store, snapshot=f"2026-05-2{index}T00:00:00+00:00")
+              for index in range(3)]
+    clock.current += timedelta(days=payroll_store.SUPERSEDED_RUN_DAYS + 1)
+    for _ in range(payroll_store.KEEP_VERSIONS + 3):
+        _save(store)
+
+    assert all(store.get_run(run["run_id"]) for run in pinned)
@@ -0,0 +1,240 @@
+"""Provisional payroll accrued day by day into the payroll store."""
+import re
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+import provisional
+import salary
+from payroll_store import PayrollRunStore
+from provisional import accrue_rows, run_provisional_payroll
+
+MONTH, YEAR = 5, 2026
+PERIOD_START, PERIOD_END = "2026-04-25", "2026-05-24"
+
+DATE_RANGE = re.compile(
+    r"u\.Date BETWEEN DATE '([\d-]+)' AND DATE '([\d-]+)'")
+
+
+class Table:
+    modified = datetime(2026, 4, 1, tzinfo=timezone.utc)
+
+
+class Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self):
+        return iter(self.rows)
+
+
+class Client:
+    """BigQuery stand-in summing per-day courier rows like the query does.
+
+    The target of each day of the month is ten times the day.
+    """
+
+    def __init__(self, days):
+        self.days = days
+        self.scans = []
+
+    def get_table(self, table_id):
+        return Table()
+
+    def query(self, query):
+        if salary.TARGETS_TABLE in query:
+            return Result([{"Day": day, "motorcycle": day * 10}
+                           for day in range(1, 32)])
+        start, end = DATE_RANGE.search(query).groups()
+        self.scans.append((start, end))
+        totals = {}
+        for day, rows in sorted(self.days.items()):
+            if not start <= day <= end:
+                continue
+            for row in rows:
+                total = totals.setdefault(row["BARQ_ID"], dict(
+                    row, Total_Orders=0, Total_Revenue=Decimal(0),
+                    Gas_Usage=Decimal(0)))
+                total.update({key: value for key, value in row.items()
+                              if key not in provisional.ACCRUED_COLUMNS})
+                for column in provisional.ACCRUED_COLUMNS:
+                    total[column] += row[column]
+        return Result(list(totals.values()))
+
+
+def _day_rows(day, status="Active"):
+    rows = [{"BARQ_ID": 1, "Name": "Courier 1", "joining_Date": "2026-01-05",
+             "Status": status, "Total_Orders": 14,
+             "Total_Revenue": Decimal("310.25"), "Gas_Usage": Decimal("9.5")}]
+    if day >= "2026-04-27":
+        rows.append({"BARQ_ID": 2, "Name": "Courier 2",
+                     "joining_Date": "2026-04-27", "Status": "Active",
+                     "Total_Orders": 11, "Total_Revenue": Decimal("200"),
+                     "Gas_Usage": Decimal("7.25")})
+    return rows
+
+
+def _days(first, last):
+    day = date.fromisoformat(first)
+    days = {}
+    while day <= date.fromisoformat(last):
+        days[day.isoformat()] = _day_rows(day.isoformat())
+        day += timedelta(days=1)
+    return days
+
+
+@pytest.fixture(autouse=True)
+def schedule(monkeypatch):
+    schedule = salary.TargetSchedule()
+    monkeypatch.setattr(salary, "target_schedule", schedule)
+    monkeypatch.setattr(provisional, "target_schedule", schedule)
+    return schedule
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PayrollRunStore(str(tmp_path / "payroll_runs.sqlite"))
+
+
+def _refresh(client, store, as_of, **kwargs):
+    return run_provisional_payroll(client, store, ["Motorcycle"], MONTH,
+                                   YEAR, {}, as_of=as_of, **kwargs)[0]
+
+
+def _totals(result):
+    return {record["BARQ_ID"]: (record["Total_Orders"],
+                                round(record["Total_Revenue"], 2),
+                                round(record["Gas_Usage"], 2))
+            for record in result["records"]}
+
+
+def test_first_refresh_scans_the_period_to_date(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+
+    result = _refresh(client, store, "2026-04-28")
+
+    assert client.scans == [(PERIOD_START, "2026-04-28")]
+    assert _totals(result) == {1: (56, 1241.0, 38.0), 2: (22, 400.0, 14.5)}
+    assert result["provisional"]["accrued_through"] == "2026-04-28"
+    assert result["provisional"]["couriers"] == 2
+
+
+def test_refresh_only_scans_new_days_and_adds_them(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+    _refresh(client, store, "2026-04-28")
+
+    result = _refresh(client, store, "2026-05-02")
+
+    assert client.scans[1:] == [("2026-04-29", "2026-05-02")]
+    assert _totals(result) == {1: (112, 2482.0, 76.0), 2: (66, 1200.0, 43.5)}
+    assert result["provisional"]["new_rows"] == 2
+
+
+def test_running_totals_match_a_full_rebuild(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+    for as_of in ("2026-04-26", "2026-04-30", "2026-05-03", "2026-05-09"):
+        incremental = _refresh(client, store, as_of)
+
+    rebuilt = _refresh(client, store, "2026-05-09", rebuild=True)
+
+    assert client.scans[-1] == (PERIOD_START, "2026-05-09")
+    assert _totals(rebuilt) == _totals(incremental)
+    assert [record["Total_Salary"] for record in rebuilt["records"]] == \
+        [record["Total_Salary"] for record in incremental["records"]]
+
+
+def test_refresh_for_the_same_day_does_not_query(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+    first = _refresh(client, store, "2026-04-30")
+
+    second = _refresh(client, store, "2026-04-30")
+
+    assert len(client.scans) == 1
+    assert second["provisional"]["scanned"] is None
+    assert _totals(second) == _totals(first)
+    assert second["provisional"]["target"] == first["provisional"]["target"]
+
+
+def test_rebuild_picks_up_corrected_past_days(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+    _refresh(client, store, "2026-04-30")
+    client.days["2026-04-26"][0]["Total_Orders"] = 0
+
+    incremental = _refresh(client, store, "2026-05-01")
+    rebuilt = _refresh(client, store, "2026-05-01", rebuild=True)
+
+    assert _totals(incremental)[1][0] == 14 * 7
+    assert _totals(rebuilt)[1][0] == 14 * 6
+
+
+def test_target_is_the_day_of_month_of_the_accrual_date(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+
+    result = _refresh(client, store, "2026-05-03")
+
+    assert result["provisional"]["target"] == 30
+    assert store.provisional_state("Motorcycle", PERIOD_START)["target"] == 30
+    assert {record["TARGET"] for record in result["records"]} == {30}
+
+
+def test_days_since_joining_count_to_the_accrual_date(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+
+    result = _refresh(client, store, "2026-05-03")
+
+    days = {record["BARQ_ID"]: record["days_since_joining"]
+            for record in result["records"]}
+    assert days == {1: 119, 2: 7}
+    assert {record["accrued_through"] for record in result["records"]} == \
+        {"2026-05-03"}
+
+
+def test_accrual_date_is_capped_at_the_period_end(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+
+    result = _refresh(client, store, "2026-06-10")
+
+    assert client.scans == [(PERIOD_START, PERIOD_END)]
+    assert result["provisional"]["accrued_through"] == PERIOD_END
+
+
+def test_concurrent_refresh_result_is_reloaded_not_added_twice(store):
+    client = Client(_days(PERIOD_START, "2026-05-24"))
+    _refresh(client, store, "2026-04-28")
+    save_provisional = store.save_provisional
+
+    def refreshed_meanwhile(*args, **kwargs):
+        # Another worker finishes the same refresh first
+        store.save_provisional = save_provisional
+        _refresh(Client(client.days), store, "2026-05-02")
+        return save_provisional(*args, **kwargs)
+
+    store.save_provisional = refreshed_meanwhile
+    result = _refresh(client, store, "2026-05-02")
+
+    assert _totals(result) == {1: (112, 2482.0, 76.0), 2: (66, 1200.0, 43.5)}
+    assert result["provisional"]["accrued_through"] == "2026-05-02"
+    assert store.provisional_state(
+        "Motorcycle", PERIOD_START)["accrued_through"] == "2026-05-02"
+    assert _totals(_refresh(client, store, "2026-05-02")) == _totals(result)
+
+
+def test_accrue_rows_adds_to_running_totals():
+    accruals = {"1": {"BARQ_ID": 1, "Status": "Active", "Total_Orders": 5,
+                      "Total_Revenue": 100.5, "Gas_Usage": 2}}
+
+    changed = accrue_rows(accruals, [
+        {"BARQ_ID": 1, "Status": "Resigned", "Total_Orders": 3,
+         "Total_Revenue": Decimal("0.25"), "Gas_Usage": None},
+        {"BARQ_ID": 2, "Status": "Active", "Total_Orders": None,
+         "Total_Revenue": Decimal("4"), "Gas_Usage": Decimal("1.5")},
+    ])
+
+    assert changed == {"1", "2"}
+    assert accruals["1"] == {"BARQ_ID": 1, "Status": "Resigned",
+                             "Total_Orders": 8, "Total_Revenue": 100.75,
+                             "Gas_Usage": 2}
+    assert accruals["2"]["Total_Orders"] == 0
+    assert accruals["2"]["Total_Revenue"] == 4.0
+    assert accruals["2"]["Gas_Usage"] == 1.5
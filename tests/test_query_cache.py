@@ -0,0 +1,352 @@
+"""Write detection, expiry, eviction, invalidation and query coalescing."""
+import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from google.cloud.bigquery import Row
+
+import query_cache
+from query_cache import (QueryCache, SharedQueryCache, SingleFlight,
+                         is_write, is_write_statement, query_class,
+                         query_tables)
+
+
+@pytest.mark.parametrize("query", [
+    "INSERT INTO master_saned.courier (Name) VALUES ('a')",
+    "WITH stale AS (SELECT BARQ_ID FROM master_saned.courier)\n"
+    "DELETE FROM master_saned.courier WHERE BARQ_ID IN "
+    "(SELECT BARQ_ID FROM stale)",
+    "-- monthly fix\nUPDATE master_saned.courier SET Status = 'x' "
+    "WHERE TRUE",
+    "/* reads first */ MERGE master_saned.courier t USING src s ON FALSE "
+    "WHEN NOT MATCHED THEN INSERT ROW",
+    "SELECT 1; SELECT 2",
+    "DECLARE n INT64 DEFAULT 1; SELECT n",
+    "create or replace table master_saned.tmp as select 1 as a",
+    "  truncate table master_saned.tmp",
+])
+def test_is_write_finds_writes(query):
+    assert is_write(query)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM master_saned.courier",
+    "SELECT Name FROM master_saned.courier -- DELETE later\n",
+    "SELECT Name FROM master_saned.courier # UPDATE these\n",
+    "SELECT /* INSERT here? */ Name FROM master_saned.courier",
+    "SELECT 'DROP TABLE x; DELETE' AS note FROM master_saned.courier",
+    "SELECT \"it's an UPDATE\" AS note",
+    "SELECT '''multi\nline; INSERT''' AS note",
+    "SELECT `update`, `set` FROM master_saned.vehicle_logs",
+    "WITH recent AS (SELECT * FROM master_saned.ultimate) "
+    "SELECT COUNT(*) FROM recent;",
+    "SELECT Name FROM master_saned.courier WHERE Name = 'O\\'Neil; DROP'",
+])
+def test_is_write_ignores_comments_and_strings(query):
+    assert not is_write(query)
+
+
+def test_is_write_statement_trusts_bigquery_type():
+    assert not is_write_statement("SELECT", "SELECT 'DELETE'")
+    assert is_write_statement("UPDATE", "SELECT 1")
+    assert is_write_statement("SCRIPT", "SELECT 1")
+    assert is_write_statement(None, "DELETE FROM a.b WHERE TRUE")
+    assert not is_write_statement(None, "SELECT 1")
+
+
+@pytest.mark.parametrize("query, name", [
+    ("SELECT * FROM ds.INFORMATION_SCHEMA.TABLES", "metadata"),
+    ("SELECT DISTINCT Name FROM master_saned.courier", "lookup"),
+    ("SELECT COUNT(*) FROM master_saned.courier", "metric"),
+    ("SELECT Day, SUM(x) FROM master_saned.ultimate GROUP BY Day", "series"),
+    ("SELECT * FROM master_saned.courier", "default"),
+])
+def test_query_class(query, name):
+    assert query_class(query)[0] == name
+
+
+def test_query_tables():
+    query = ("SELECT * FROM `looker-barqdata-2030.master_saned.ultimate` u "
+             "JOIN master_saned.Courier c ON u.BARQ_ID = c.BARQ_ID")
+    assert query_tables(query) == {"master_saned.ultimate",
+                                   "master_saned.courier"}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(query_cache.time, "monotonic", clock)
+    return clock
+
+
+def test_memory_cache_expires_entries(clock):
+    cache = QueryCache()
+    cache.put("a", [1, 2], 60, ["ds.a"])
+
+    clock.now += 59
+    assert cache.get("a") == [1, 2]
+    clock.now += 1
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_memory_cache_returns_copies():
+    cache = QueryCache()
+    cache.put("a", [1, 2], 60, ["ds.a"])
+
+    cache.get("a").append(3)
+
+    assert cache.get("a") == [1, 2]
+
+
+def test_memory_cache_evicts_least_recently_used():
+    rows = ["x" * 1000]
+    size = query_cache.estimate_size(rows)
+    cache = QueryCache(memory_budget=size * 4)
+    for key in "abcd":
+        cache.put(key, rows, 60, [])
+    cache.get("a")
+
+    cache.put("e", rows, 60, [])
+    cache.put("f", rows, 60, [])
+
+    assert [key for key in "abcdef" if cache.get(key) is not None] == \
+        ["a", "d", "e", "f"]
+    assert cache.stats()["evictions"] == 2
+
+
+def test_memory_cache_skips_oversized_results():
+    cache = QueryCache(memory_budget=1000)
+
+    assert not cache.put("a", ["x" * 1000], 60, [])
+    assert cache.get("a") is None
+
+
+def test_memory_cache_invalidates_by_table():
+    cache = QueryCache()
+    cache.put("a", [1], 60, ["master_saned.courier"])
+    cache.put("b", [2], 60, ["master_saned.courier", "master_saned.ultimate"])
+    cache.put("c", [3], 60, ["master_saned.targets"])
+
+    assert cache.invalidate(["MASTER_SANED.Courier"]) == 2
+
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("c") == [3]
+
+
+@pytest.fixture
+def shared(tmp_path):
+    return SharedQueryCache(str(tmp_path / "cache" / "query_cache.sqlite"))
+
+
+def test_shared_cache_round_trips_bigquery_values(shared):
+    rows = [Row((1, "a", Decimal("1.10"), date(2026, 5, 31),
+                 datetime(2026, 5, 31, 8, 30), b"\x00", [1, 2], {"k": "v"}),
+                {name: index for index, name in enumerate("abcdefgh")})]
+
+    shared.put("key", rows, 60, ["ds.a"])
+    cached, ttl, tables = shared.get("key")
+
+    assert cached == rows
+    assert list(cached[0].keys()) == list("abcdefgh")
+    assert 0 < ttl <= 60
+    assert tables == ["ds.a"]
+
+
+def test_shared_cache_evicts_least_recently_read(shared, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(query_cache.time, "time", lambda: now[0])
+    payload = len(query_cache.serialize_rows([str(i) for i in range(50)]))
+    shared.budget = payload * 4
+    for key in "abcd":
+        shared.put(key, [str(i) for i in range(50)], 3600, [])
+        now[0] += 100
+    shared.get("a")
+
+    shared.put("e", [str(i) for i in range(50)], 3600, [])
+
+    assert [key for key in "abcde" if shared.get(key)] == \
+        ["a", "c", "d", "e"]
+
+
+def test_shared_cache_invalidation_is_logged_for_other_workers(shared):
+    shared.put("a", [1], 60, ["master_saned.courier"])
+    shared.put("b", [2], 60, ["master_saned.targets"])
+    generation, _ = shared.invalidations_since(None)
+
+    assert shared.invalidate(["master_saned.courier"]) == 1
+
+    assert shared.get("a") is None
+    assert shared.get("b") is not None
+    latest, tables = shared.invalidations_since(generation)
+    assert latest > generation
+    assert tables == {"master_saned.courier"}
+
+
+def test_shared_cache_reads_unknown_payloads_as_errors(shared):
+    shared.put("a", [1], 60, [])
+    with shared._connect() as conn:
+        conn.execute("UPDATE cache_entries SET payload = ?",
+                     (query_cache.zlib.compress(b"\x80\x04pickle"),))
+
+    with pytest.raises(ValueError):
+        shared.get("a")
+
+
+class Job:
+    def __init__(self, job_id, rows, release=None):
+        self.job_id = job_id
+        self.location = "US"
+        self.statement_type = "SELECT"
+        self.rows = rows
+        self.release = release
+
+    def result(self):
+        if self.release is not None:
+            assert self.release.wait(5)
+        return iter(self.rows)
+
+
+class Client:
+    """Counts queries; every job waits for release before returning."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.queries = 0
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def query(self, query, job_config=None):
+        with self._lock:
+            self.queries += 1
+            job = Job(f"job-{self.queries}", [Row((1,), {"a": 0})],
+                      self.release)
+        self.jobs[job.job_id] = job
+        return job
+
+    def get_job(self, job_id, location=None):
+        return self.jobs[job_id]
+
+
+def _run_concurrently(flight, client, count, key="key"):
+    results = [None] * count
+
+    def call(index):
+        try:
+            results[index] = flight.run(client, key, "SELECT 1")
+        except RuntimeError as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,))
+               for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def _wait_for_waiters(flight, count):
+    deadline = time.monotonic() + 5
+    while flight.stats()["waiting"] < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_single_flight_coalesces_concurrent_queries():
+    flight = SingleFlight()
+    client = Client()
+
+    threads, results = _run_concurrently(flight, client, 8)
+    _wait_for_waiters(flight, 7)
+    client.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert client.queries == 1
+    assert all(result == ("SELECT", [Row((1,), {"a": 0})])
+               for result in results)
+    assert len({id(rows) for _, rows in results}) == 8
+    assert flight.counters["executed"] == 1
+    assert flight.counters["merged"] == 7
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_single_flight_runs_different_keys_separately():
+    flight = SingleFlight()
+    client = Client()
+    client.release.set()
+
+    flight.run(client, "a", "SELECT 1")
+    flight.run(client, "b", "SELECT 1")
+    flight.run(client, "a", "SELECT 1")
+
+    assert client.queries == 3
+
+
+def test_single_flight_shares_errors_with_waiters():
+    flight = SingleFlight()
+    client = Client()
+    started = threading.Event()
+
+    def failing_query(query, job_config=None):
+        started.set()
+        assert client.release.wait(5)
+        raise RuntimeError("quota exceeded")
+
+    client.query = failing_query
+    threads, results = _run_concurrently(flight, client, 1)
+    assert started.wait(5)
+    waiter_error = []
+
+    def wait():
+        try:
+            flight.run(client, "key", "SELECT 1")
+        except RuntimeError as e:
+            waiter_error.append(str(e))
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    _wait_for_waiters(flight, 1)
+    client.release.set()
+    waiter.join(5)
+    for thread in threads:
+        thread.join(5)
+
+    assert waiter_error == ["quota exceeded"]
+    assert str(results[0]) == "quota exceeded"
+    assert flight.counters["failed"] == 1
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_single_flight_joins_a_job_started_by_another_worker(shared):
+    flight = SingleFlight(shared)
+    client = Client()
+    client.release.set()
+    running = client.query("SELECT 1")
+    shared.claim_job("key", running.job_id, running.location)
+
+    result = flight.run(client, "key", "SELECT 1")
+
+    assert result == ("SELECT", [Row((1,), {"a": 0})])
+    assert client.queries == 1
+    assert flight.counters["joined"] == 1
+
+
+def test_single_flight_releases_its_claim(shared):
+    flight = SingleFlight(shared)
+    client = Client()
+    client.release.set()
+
+    flight.run(client, "key", "SELECT 1")
+
+    assert shared.running_job("key") is None
@@ -0,0 +1,183 @@
+"""The batch salary engine must match the scalar calculators to the cent."""
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import salary
+
+TODAY = date(2026, 5, 31)
+
+SCALAR_FUNCTIONS = {
+    "Motorcycle": salary.calculate_motorcycle_salary,
+    "Food Trial": salary.calculate_food_trial_salary,
+    "Food In-House New": salary.calculate_food_inhouse_new_salary,
+    "Food In-House Old": salary.calculate_food_inhouse_old_salary,
+    "Ecommerce WH": salary.calculate_ecommerce_wh_salary,
+    "Ecommerce": salary.calculate_ecommerce_salary,
+    "Ajeer": salary.calculate_ajeer_salary,
+}
+
+# Orders above target where a bonus tier starts or ends
+TIER_OFFSETS = {
+    "Food In-House Old": [123, 124, 125, 224, 324, 424, 425, 900],
+    "Ajeer": [298, 299, 300, 399, 499, 500, 900],
+}
+
+CUSTOM_PARAMS = {
+    "Motorcycle": {"motorcycle_bonus_rate": 7.5, "motorcycle_gas_cap": 200},
+    "Food Trial": {"food_trial_penalty_rate": 12,
+                   "food_trial_gas_rate": 1.95},
+    "Food In-House New": {"food_inhouse_new_bonus_rate": 8.25},
+    "Food In-House Old": {"food_inhouse_old_basic_salary_rate": 70,
+                          "food_inhouse_old_gas_cap": 700},
+    "Ecommerce WH": {"ecommerce_wh_gas_rate": 14.5,
+                     "ecommerce_wh_bonus_rate": 9},
+    "Ecommerce": {"ecommerce_revenue_coefficient": 0.31,
+                  "ecommerce_gas_cap": 400},
+    "Ajeer": {"ajeer_penalty_rate": 11, "ajeer_gas_rate": 1.9},
+}
+
+
+def _joined(days_ago):
+    return (TODAY - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+
+
+def _order_rows(category):
+    """Rows at the target and tier boundaries, long and short tenure."""
+    target = 400
+    offsets = [-target, -1, 0, 1, 2] + TIER_OFFSETS.get(category, [])
+    rows = []
+    for days_ago in (400, 9):
+        for offset in offsets:
+            rows.append({
+                "joining_Date": _joined(days_ago),
+                "Total_Orders": target + offset,
+                "TARGET": target,
+                "Gas_Usage": 137.45,
+                "Total_Revenue": 5210.35,
+            })
+    return rows
+
+
+def _revenue_rows():
+    """Ecommerce rows at the 4000 revenue bonus breakpoint."""
+    target = 6000
+    rows = []
+    for days_ago in (400, 9):
+        for bonus_revenue in (-1, 0, 1, 3999.99, 4000, 4000.01, 9000):
+            rows.append({
+                "joining_Date": _joined(days_ago),
+                "Total_Orders": 250,
+                "TARGET": target,
+                "Gas_Usage": 88.1,
+                "Total_Revenue": target + bonus_revenue,
+            })
+    return rows
+
+
+def _rows(category):
+    if category == "Ecommerce":
+        return _revenue_rows()
+    return _order_rows(category)
+
+
+def _scalar(row, category, custom_params):
+    joined = date.fromisoformat(row["joining_Date"])
+    days_since_joining = (TODAY - joined).days + 1
+    return SCALAR_FUNCTIONS[category](
+        row["Total_Orders"], row["TARGET"], row["Gas_Usage"],
+        days_since_joining, row["Total_Revenue"], custom_params)
+
+
+@pytest.mark.parametrize("custom", [False, True], ids=["defaults", "custom"])
+@pytest.mark.parametrize("category", list(SCALAR_FUNCTIONS))
+def test_batch_matches_scalar(category, custom):
+    custom_params = CUSTOM_PARAMS[category] if custom else {}
+    rows = _rows(category)
+    expected = [_scalar(row, category, custom_params) for row in rows]
+
+    batch = salary.calculate_salary_details_batch(
+        [dict(row) for row in rows], category, "2026-05-01", "2026-05-31",
+        custom_params, today=TODAY)
+
+    assert len(batch) == len(rows)
+    for row, want, got in zip(rows, expected, batch):
+        for component in salary.SALARY_COMPONENTS:
+            assert got[component] == want[component], (row, component)
+        assert got["target"] == pytest.approx(want["target"]), row
+
+
+def test_batch_skips_unparseable_joining_dates():
+    rows = _order_rows("Motorcycle")[:2]
+    rows[0]["joining_Date"] = "not a date"
+
+    batch = salary.calculate_salary_details_batch(
+        rows, "Motorcycle", "2026-05-01", "2026-05-31", {}, today=TODAY)
+
+    assert [row["Total_Orders"] for row in batch] == [399]
+
+
+def test_batch_days_since_joining_counts_the_joining_day():
+    rows = [{"joining_Date": _joined(0), "Total_Orders": 10, "TARGET": 400,
+             "Gas_Usage": 0, "Total_Revenue": 0}]
+
+    batch = salary.calculate_salary_details_batch(
+        rows, "Food Trial", "2026-05-01", "2026-05-31", {}, today=TODAY)
+
+    assert batch[0]["days_since_joining"] == 1
+    assert batch[0]["target"] == 13
+
+
+def _scalar_tiered_bonus(excess, tiers):
+    bonus, remaining = 0, excess
+    for limit, rate in tiers:
+        in_tier = min(remaining, limit)
+        bonus += in_tier * rate
+        remaining -= in_tier
+        if remaining <= 0:
+            break
+    return bonus
+
+
+@pytest.mark.parametrize("tiers", [
+    salary.FOOD_INHOUSE_OLD_BONUS_TIERS,
+    salary.AJEER_BONUS_TIERS,
+    salary.ECOMMERCE_BONUS_TIERS,
+], ids=["food_inhouse_old", "ajeer", "ecommerce"])
+def test_tiered_bonus_breakpoints(tiers):
+    breakpoints = np.cumsum([limit for limit, _ in tiers[:-1]])
+    excess = sorted({0.0, 0.5, 1.0, 10000.0}
+                    | {float(point + delta) for point in breakpoints
+                       for delta in (-1, -0.01, 0, 0.01, 1)})
+
+    result = salary.tiered_bonus(np.array(excess), tiers)
+
+    expected = [_scalar_tiered_bonus(value, tiers) for value in excess]
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-9)
+
+
+def test_tiered_bonus_pays_each_tier_rate():
+    result = salary.tiered_bonus(np.array([124.0, 125.0, 224.0, 425.0]),
+                                 salary.FOOD_INHOUSE_OLD_BONUS_TIERS)
+
+    assert result.tolist() == [620, 626, 1220, 2729]
+
+
+@pytest.mark.parametrize("value", [
+    0.125, 0.135, 2.675, 1.005, 1.015, 0.285, 10.555, 1234.565,
+    -0.125, -2.675, -1.005, -10.555, 0.0, 0.004999, 0.995, 99.995,
+])
+def test_round_cents_matches_builtin_round(value):
+    result = salary.round_cents(np.array([value]))
+
+    assert result[0] == round(value, 2)
+
+
+def test_round_cents_rounds_whole_columns():
+    values = np.array([0.125, 0.135, 2.675, 1.005, 3.14159, -0.005])
+
+    result = salary.round_cents(values)
+
+    assert result.tolist() == [round(float(value), 2)
+                               for value in values]
@@ -0,0 +1,216 @@
+"""The SQL push-down must stay in step with the Python salary engine.
+
+The generated SQL is compared with snapshots in tests/snapshots; set
+UPDATE_SNAPSHOTS=1 to rewrite them after an intended formula change.
+The per-category expressions are also evaluated in SQLite and compared
+with the batch engine, and cross_check_salary_records is run on records
+with known mismatches.
+"""
+import os
+import re
+import sqlite3
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import salary
+
+TODAY = date(2026, 5, 31)
+START_DATE, END_DATE = "2026-05-01", "2026-05-31"
+TARGETS = {category: 400 for category in salary.SALARY_PARAM_DEFAULTS}
+TARGETS["Ecommerce"] = 6000
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(__file__), "snapshots",
+                            "salary_pushdown")
+
+CATEGORIES = list(salary.SALARY_PARAM_DEFAULTS)
+
+CUSTOM_PARAMS = {
+    "Motorcycle": {"motorcycle_bonus_rate": 7.5},
+    "Food In-House Old": {"food_inhouse_old_gas_cap": 700},
+    "Ecommerce": {"ecommerce_revenue_coefficient": 0.31},
+    "Ajeer": {"ajeer_penalty_rate": 11},
+}
+
+
+def _slug(name):
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+def _assert_snapshot(name, query):
+    path = os.path.join(SNAPSHOT_DIR, f"{_slug(name)}.sql")
+    if os.environ.get("UPDATE_SNAPSHOTS"):
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(path, "w") as file:
+            file.write(query)
+    with open(path) as file:
+        assert query == file.read(), f"{path} is out of date"
+
+
+@pytest.mark.parametrize("category", CATEGORIES)
+def test_salary_query_snapshot(category):
+    query = salary.generate_salary_query(
+        [category], START_DATE, END_DATE, {}, TARGETS, today=TODAY)
+
+    _assert_snapshot(category, query)
+
+
+def test_combined_salary_query_snapshot():
+    categories = [category for category in CATEGORIES
+                  if category in salary.ALL_CATEGORIES]
+
+    query = salary.generate_salary_query(
+        categories, START_DATE, END_DATE, CUSTOM_PARAMS, TARGETS,
+        today=TODAY)
+
+    _assert_snapshot("combined", query)
+
+
+def test_salary_query_inlines_custom_params():
+    query = salary.generate_salary_query(
+        ["Motorcycle"], START_DATE, END_DATE,
+        {"Motorcycle": {"motorcycle_bonus_rate": "7.5"}}, TARGETS,
+        today=TODAY)
+
+    assert "(Total_Orders - final_target) * 7.5" in query
+    assert "(Total_Orders - final_target) * 6.0" not in query
+
+
+def test_salary_query_rejects_non_finite_params():
+    with pytest.raises(ValueError):
+        salary.generate_salary_query(
+            ["Food Trial"], START_DATE, END_DATE,
+            {"Food Trial": {"food_trial_bonus_rate": "nan"}}, TARGETS,
+            today=TODAY)
+
+
+def test_salary_sql_expressions_rejects_unknown_category():
+    with pytest.raises(ValueError):
+        salary.salary_sql_expressions("Bicycle", {})
+
+
+# BigQuery functions used by salary_sql_expressions, in SQLite spelling
+SQLITE_FUNCTIONS = [
+    (r"\bLEAST\(", "MIN("),
+    (r"\bGREATEST\(", "MAX("),
+    (r"\bIF\(", "IIF("),
+    (r"\bCEIL\(", "ceil("),
+]
+
+
+def _sqlite(expression):
+    for pattern, replacement in SQLITE_FUNCTIONS:
+        expression = re.sub(pattern, replacement, expression)
+    return expression
+
+
+def _input_rows(category):
+    target = TARGETS[category]
+    rows = []
+    for days in (400, 10):
+        for offset in (-target, -1, 0, 1, 124, 299, 324, 500, 4000, 9000):
+            rows.append((target + offset, target, 137.45, days,
+                         target + offset * 1.5 + 5210.35))
+    return rows
+
+
+def _sqlite_components(category, custom_params, rows):
+    expressions = {name: _sqlite(sql) for name, sql in
+                   salary.salary_sql_expressions(category,
+                                                 custom_params).items()}
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE TABLE inputs (Total_Orders REAL, TARGET REAL, "
+                     "Gas_Usage REAL, days_since_joining REAL, "
+                     "Total_Revenue REAL)")
+        conn.executemany("INSERT INTO inputs VALUES (?, ?, ?, ?, ?)", rows)
+        return conn.execute(f"""
+            SELECT final_target,
+                   {expressions['basic_salary']},
+                   {expressions['bonus_amount']},
+                   {expressions['gas_deserved']}
+            FROM (SELECT *, {expressions['final_target']} AS final_target
+                  FROM inputs)
+            ORDER BY rowid
+        """).fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("custom", [False, True], ids=["defaults", "custom"])
+@pytest.mark.parametrize("category", CATEGORIES)
+def test_salary_sql_matches_batch_engine(category, custom):
+    custom_params = CUSTOM_PARAMS.get(category, {}) if custom else {}
+    rows = _input_rows(category)
+    columns = np.array(rows, dtype=float).T
+    expected = salary.BATCH_CALCULATION_FUNCTIONS[category](
+        *columns, salary.resolve_salary_params(category, custom_params))
+
+    result = np.array(_sqlite_components(category, custom_params, rows))
+
+    for index, name in enumerate(["target", "Basic_Salary", "Bonus_Amount",
+                                  "Gas_Deserved"]):
+        np.testing.assert_allclose(result[:, index], expected[name],
+                                   rtol=1e-12, atol=1e-9, err_msg=name)
+
+
+def _finished_records(category, count):
+    joining_date = (TODAY - timedelta(days=90)).strftime('%Y-%m-%d')
+    results = [{
+        "BARQ_ID": index,
+        "joining_Date": joining_date,
+        "Total_Orders": 380 + index * 7,
+        "TARGET": TARGETS[category],
+        "Gas_Usage": 120.5,
+        "Total_Revenue": 5000 + index * 250,
+    } for index in range(count)]
+    return salary.calculate_salary_details_batch(
+        results, category, START_DATE, END_DATE, {}, today=TODAY)
+
+
+def test_cross_check_accepts_matching_records():
+    records = _finished_records("Food In-House Old", 6)
+
+    check = salary.cross_check_salary_records(
+        records, "Food In-House Old", {}, today=TODAY)
+
+    assert check == {"checked": 6, "mismatches": 0, "max_difference": 0.0}
+
+
+def test_cross_check_reports_mismatches():
+    records = _finished_records("Ajeer", 6)
+    records[1]["Bonus_Amount"] += 0.01
+    records[4]["Total_Salary"] -= 12.5
+    records[5]["Gas_Deserved"] += 0.004
+
+    check = salary.cross_check_salary_records(records, "Ajeer", {},
+                                              today=TODAY)
+
+    assert check == {"checked": 6, "mismatches": 2, "max_difference": 12.5}
+
+
+def test_cross_check_uses_custom_params():
+    records = _finished_records("Motorcycle", 3)
+
+    check = salary.cross_check_salary_records(
+        records, "Motorcycle", {"motorcycle_gas_cap": 1}, today=TODAY)
+
+    assert check["checked"] == 3
+    assert check["mismatches"] == 3
+
+
+def test_cross_check_skips_records_without_joining_date():
+    records = _finished_records("Food Trial", 2)
+    records[0]["joining_Date"] = None
+
+    check = salary.cross_check_salary_records(records, "Food Trial", {},
+                                              today=TODAY)
+
+    assert check["checked"] == 1
+    assert check["mismatches"] == 0
+
+
+def test_cross_check_without_records():
+    assert salary.cross_check_salary_records([], "Ajeer", {}) == {
+        "checked": 0, "mismatches": 0, "max_difference": 0.0}